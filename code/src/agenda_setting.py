@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module providing a single command line interface to all stages of the pipeline.
+
+In more detail, each subcommand runs the main() method of a pipeline module with the remaining arguments,
+e.g. "agenda-setting preprocess --input ..." runs <preprocess_text.py>. This module only imports the
+Python standard library, and pipeline modules are imported when their subcommand is run, so that
+listing the subcommands does not load pandas, spacy or textacy. The pipeline modules load numpy, pandas
+and scipy on first use (see <lazy_imports.py>), so that e.g. the options of a subcommand are shown
+without loading them either.
+
+A warm worker keeps the pipeline modules and the spacy model loaded across invocations:
+1. "agenda-setting worker --socket /tmp/agenda-setting.sock" loads the modules and the model once and
+   listens on a Unix socket.
+2. "agenda-setting --worker /tmp/agenda-setting.sock preprocess --input ..." (or the environment variable
+   AGENDA_SETTING_WORKER) forwards the command to the worker, which runs it in the working directory of
+   the caller and sends back its output and exit code. The forwarding client starts without loading any
+   pipeline module.
+Commands are run one after another by the worker. Output of processes started by a command
+(e.g. <near_duplicates.py> with --processes) is written to the terminal of the worker.
+
+Example:
+./agenda-setting metrics code/data/media_posts_processed_final.csv code/data/rtsi_topics.xlsx 7
+"""
+import argparse
+import importlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+import traceback
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent
+sys.path[0:0] = [
+    str(SRC_DIR / "utils"),
+    str(SRC_DIR / "utils" / "text_preprocessing"),
+    str(SRC_DIR / "utils" / "calculations"),
+    str(SRC_DIR / "benchmarks"),
+]
+
+# Subcommands with the module providing their main() method and a short description
+COMMANDS = {
+    "preprocess": ("preprocess_text", "Preprocess raw posts"),
+    "lemmatize": ("lemmatize", "Lemmatize preprocessed posts"),
+    "near-duplicates": ("near_duplicates", "Detect near-duplicate posts"),
+    "ner": ("ner", "Apply NER with the Texterra API"),
+    "merge-labels": ("merge_labels", "Collapse NER results into country labels"),
+    "merge": ("merge_ner_and_posts", "Merge country labels and preprocessed posts"),
+    "metrics": ("calculate_metrics_prct_change", "Calculate metrics and percent change values"),
+    "taxonomy": ("taxonomy_metrics", "Calculate metrics for every level of entity taxonomies"),
+    "comentions": ("comentions", "Calculate country co-mentions per time slice"),
+    "sample": ("sampled_metrics", "Calculate approximate metrics from a stratified sample"),
+    "bursts": ("burst_detection", "Detect bursts of country coverage"),
+    "lead-lag": ("lead_lag", "Analyze which outlets lead the coverage of a country"),
+    "topics": ("topics", "Fit or update the online topic model"),
+    "index": ("inverted_index", "Build or query the inverted index"),
+    "sketches": ("term_sketches", "Collect streaming term statistics per time slice"),
+    "shards": ("sharded_pipeline", "Run the pipeline on shards of the corpus"),
+    "ingest": ("ingestion_daemon", "Ingest a live stream of posts into daily counts"),
+    "serve": ("metrics_server", "Serve metrics over a local HTTP interface"),
+    "generate": ("synthetic_corpus", "Generate a synthetic VK corpus"),
+    "benchmark": ("run_benchmarks", "Run the benchmark suite"),
+}
+# Subcommands that are not forwarded to the warm worker, as they would block it
+LOCAL_COMMANDS = ["serve", "ingest", "worker"]
+WORKER_ENV = "AGENDA_SETTING_WORKER"
+# Modules loaded by the warm worker at start
+WORKER_MODULES = [
+    "numpy", "pandas", "preprocess_text", "merge_labels", "merge_ner_and_posts", "calculate_metrics_prct_change",
+]
+
+
+def run(command, argv):
+    """
+    A method to run a subcommand in the current process.
+    :param command: The name of the subcommand.
+    :param argv: A list of arguments of the subcommand.
+    :return: The exit code.
+    """
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = ["agenda-setting " + command] + list(argv)
+    try:
+        module.main(argv)
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            return error.code or 0
+        print(error.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+class SocketWriter:
+    """A text stream sending everything written to it as JSON messages over a socket."""
+
+    def __init__(self, stream, key):
+        self.stream = stream
+        self.key = key
+
+    def write(self, text):
+        if text:
+            self.stream.write((json.dumps({self.key: text}) + "\n").encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """A request handler running one forwarded command in the warm worker."""
+
+    def handle(self):
+        from instrumentation import TRACER
+
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        command, argv = request["command"], request["argv"]
+        start_time = time.time()
+        stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+        sys.stdout = SocketWriter(self.wfile, "stdout")
+        sys.stderr = SocketWriter(self.wfile, "stderr")
+        try:
+            os.chdir(request["cwd"])
+            code = run(command, argv)
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            # Write the trace of this command, if requested, and start the next command with a fresh tracer
+            try:
+                TRACER.write()
+            finally:
+                TRACER.reset()
+                os.chdir(cwd)
+                sys.stdout, sys.stderr = stdout, stderr
+        self.wfile.write((json.dumps({"exit": code}) + "\n").encode("utf-8"))
+        print(command + " finished with exit code " + str(code) + " in %s seconds" % (time.time() - start_time))
+
+
+def serve_worker(path, load_model=True):
+    """
+    A method to run the warm worker.
+    :param path: Path of the Unix socket.
+    :param load_model: Whether to load the spacy model at start.
+    """
+    start_time = time.time()
+    for name in WORKER_MODULES:
+        importlib.import_module(name)
+    if load_model:
+        importlib.import_module("preprocess_text").load_tokenizer()
+    print("Worker ready in %s seconds, listening on " % (time.time() - start_time) + path)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, WorkerHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def forward(path, command, argv):
+    """
+    A method to run a subcommand in the warm worker.
+    :param path: Path of the Unix socket of the worker.
+    :param command: The name of the subcommand.
+    :param argv: A list of arguments of the subcommand.
+    :return: The exit code.
+    """
+    request = {"command": command, "argv": list(argv), "cwd": os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        for line in client.makefile("rb"):
+            message = json.loads(line.decode("utf-8"))
+            if "exit" in message:
+                return message["exit"]
+            stream = sys.stdout if "stdout" in message else sys.stderr
+            stream.write(message.get("stdout", message.get("stderr")))
+            stream.flush()
+    print("The worker closed the connection without an exit code.", file=sys.stderr)
+    return 1
+
+
+def main(argv=None):
+    """
+    A method to run a subcommand from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    :return: The exit code.
+    """
+    commands = "\n".join("  %-16s %s" % (name, COMMANDS[name][1]) for name in COMMANDS)
+    parser = argparse.ArgumentParser(
+        prog="agenda-setting", formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Run a stage of the agenda-setting pipeline.",
+        epilog="commands:\n" + commands + "\n  %-16s %s" % ("worker", "Run a warm worker")
+               + "\n\nRun 'agenda-setting <command> --help' for the options of a command.")
+    parser.add_argument("--worker", default=os.environ.get(WORKER_ENV),
+                        help="Unix socket of a warm worker to run the command in (default: $" + WORKER_ENV + ")")
+    parser.add_argument("command", choices=list(COMMANDS) + ["worker"], metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the command")
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        worker_parser = argparse.ArgumentParser(prog="agenda-setting worker",
+                                                description="Run a warm worker on a Unix socket.")
+        worker_parser.add_argument("--socket", default="/tmp/agenda-setting.sock", help="Path of the Unix socket")
+        worker_parser.add_argument("--no-model", action="store_true", help="Do not load the spacy model at start")
+        worker_args = worker_parser.parse_args(args.args)
+        serve_worker(worker_args.socket, not worker_args.no_model)
+        return 0
+    if args.worker and args.command not in LOCAL_COMMANDS:
+        return forward(args.worker, args.command, args.args)
+    return run(args.command, args.args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to benchmark the pipeline stages on synthetic corpora of several sizes.
+
+For each corpus size, a synthetic corpus is generated with <synthetic_corpus.py> (or reused if it
+already exists) and the following stages are run, each in a fresh process:
+- preprocess: text preprocessing and tokenization (<preprocess_text.py>)
+- collapse: collapsing NER results into country labels (<merge_labels.py>)
+- merge: merging country labels and posts (<merge_ner_and_posts.py>)
+- metrics<N>: post and word level metrics for a time slice of N days (<calculate_metrics_prct_change.py>)
+- correlations<N>: correlations for a time slice of N days (<basic_corrs.R>, skipped if Rscript is missing)
+
+For each stage, wall time, CPU time, throughput and peak memory (RSS) are recorded.
+Results are saved as JSON file named after the current git commit, so that runs of different
+commits can be compared with --compare.
+
+Example:
+python3 code/src/benchmarks/run_benchmarks.py --scales 15000 100000
+python3 code/src/benchmarks/run_benchmarks.py --compare old.json new.json
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parents[3]
+UTILS_DIR = BASE_DIR / "code" / "src" / "utils"
+sys.path[0:0] = [
+    str(Path(__file__).resolve().parent),
+    str(UTILS_DIR / "text_preprocessing"),
+    str(UTILS_DIR / "calculations"),
+    str(UTILS_DIR),
+]
+from instrumentation import peak_rss_mb  # noqa: E402
+
+STAGES = ["preprocess", "collapse", "merge", "metrics", "correlations"]
+DEFAULT_SCALES = [15000, 100000, 1000000, 10000000]
+DEFAULT_TIME_SLICES = [7, 5, 3, 1]
+RESULTS_DIR = "code/data/benchmarks/"
+# Relative slow down of a stage that is reported as regression by --compare
+REGRESSION_THRESHOLD = 1.1
+
+
+def stage_preprocess(work_dir, spacy_model):
+    """A method to run the text preprocessing stage."""
+    import spacy
+    import preprocess_text
+    nlp = preprocess_text.load_tokenizer() if spacy_model is None else spacy.blank("ru")
+    df = preprocess_text.load_posts(work_dir / "media_posts.csv")
+    df = preprocess_text.preprocess(df, nlp)
+    df.to_csv(work_dir / "media_posts_processed_spacy.csv", index=False)
+    return len(df)
+
+
+def stage_collapse(work_dir):
+    """A method to run the label collapsing stage."""
+    import merge_labels
+    collapsed = merge_labels.collapse_labels(merge_labels.load_ner(work_dir / "media_posts_ner.json"))
+    collapsed.to_csv(work_dir / "media_posts_ner_collapsed.csv", index=False)
+    return len(collapsed)
+
+
+def stage_merge(work_dir):
+    """A method to run the merging stage."""
+    import merge_ner_and_posts
+    vk = merge_ner_and_posts.merge_labels_and_posts(
+        merge_ner_and_posts.load_posts(work_dir / "media_posts_processed.csv"),
+        merge_ner_and_posts.load_labels(work_dir / "media_posts_ner_collapsed.csv"),
+    )
+    vk.to_csv(work_dir / "media_posts_processed_final.csv", index=False)
+    return len(vk)
+
+
+def stage_metrics(work_dir, time_slice):
+    """A method to run the metrics calculation stage for a time slice."""
+    import calculate_metrics_prct_change as metrics
+    path = work_dir / "metrics_percent_results" / (str(time_slice) + "days")
+    path.mkdir(parents=True, exist_ok=True)
+    data_all = metrics.load_posts(work_dir / "media_posts_processed_final.csv")
+    rtsi = metrics.load_rtsi(work_dir / "rtsi_topics.xlsx")
+    calendar = metrics.SliceCalendar(rtsi, time_slice)
+    res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+    results = {}
+    for name, corpus in metrics.split_subcorpora(data_all).items():
+        daily = metrics.daily_counts(corpus)
+        metrics.save_daily_counts(daily, path, name)
+        counts, _ = metrics.update_slice_counts(daily, None, calendar, path, name)
+        results[name] = metrics.slice_metrics(counts, res_rtsi)
+    metrics.save_results(results, calendar, path)
+    return len(data_all)
+
+
+def stage_correlations(work_dir, time_slice):
+    """A method to run the correlation analysis for a time slice. Returns None if Rscript is missing."""
+    if shutil.which("Rscript") is None:
+        return None
+    script = BASE_DIR / "code" / "src" / "analyses" / "correlation_analysis" / "basic_corrs.R"
+    path = work_dir / "metrics_percent_results" / (str(time_slice) + "days")
+    # <basic_corrs.R> writes to code/data/correlation_results/ relative to the working directory
+    (work_dir / "code" / "data").mkdir(parents=True, exist_ok=True)
+    rows = 0
+    for fn in ["control_pst_all", "free_pst_all", "control_wrd_all", "free_wrd_all"]:
+        fn = path / (fn + str(time_slice) + ".csv")
+        subprocess.run(["Rscript", "--vanilla", str(script), str(fn)], cwd=work_dir, check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(fn, encoding="utf-8") as f:
+            rows += sum(1 for _ in f) - 1
+    return rows
+
+
+def run_stage(stage, work_dir, time_slice=None, spacy_model=None):
+    """
+    A method to run and measure a single stage. It is meant to be run in a fresh process.
+    :param stage: The stage name, see STAGES.
+    :param work_dir: The directory of the synthetic corpus.
+    :param time_slice: The length of a time slice in days for the metrics and correlations stages.
+    :param spacy_model: None to use the default spacy pipeline, or "blank" for a blank Russian pipeline.
+    :return: A dictionary with the measurements.
+    """
+    work_dir = Path(work_dir)
+    rss_start = peak_rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    if stage == "preprocess":
+        rows = stage_preprocess(work_dir, spacy_model)
+    elif stage == "collapse":
+        rows = stage_collapse(work_dir)
+    elif stage == "merge":
+        rows = stage_merge(work_dir)
+    elif stage == "metrics":
+        rows = stage_metrics(work_dir, time_slice)
+    else:
+        rows = stage_correlations(work_dir, time_slice)
+    seconds = time.perf_counter() - wall_start
+    # Memory of the R child processes is reported separately by the OS
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "status": "skipped" if rows is None else "ok",
+        "rows": rows,
+        "seconds": seconds,
+        "cpu_seconds": time.process_time() - cpu_start + children.ru_utime + children.ru_stime,
+        "rows_per_second": rows / seconds if rows else None,
+        "rss_start_mb": rss_start,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def measure(stage, work_dir, time_slice=None, spacy_model=None):
+    """A method to run a stage in a fresh process, so that peak memory is measured per stage."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        try:
+            return executor.submit(run_stage, stage, str(work_dir), time_slice, spacy_model).result()
+        except Exception as error:
+            return {"status": "failed", "error": repr(error)}
+
+
+def git_commit():
+    """A method to get the current git commit hash or "unknown"."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(scales, stages, time_slices, seed, spacy_model, out_dir):
+    """
+    A method to run all selected stages for all corpus sizes.
+    :return: A dictionary with the environment and a list of measurements.
+    """
+    import synthetic_corpus
+    run = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": multiprocessing.cpu_count(),
+        "seed": seed,
+        "results": [],
+    }
+    for scale in scales:
+        work_dir = Path(out_dir) / ("corpus_" + str(scale))
+        if not (work_dir / "manifest.json").exists():
+            print("Generate synthetic corpus of " + str(scale) + " posts.")
+            synthetic_corpus.generate(scale, work_dir, seed)
+        for stage in stages:
+            for time_slice in (time_slices if stage in ["metrics", "correlations"] else [None]):
+                name = stage + ("" if time_slice is None else str(time_slice))
+                result = measure(stage, work_dir, time_slice, spacy_model)
+                result.update({"scale": scale, "stage": name})
+                run["results"].append(result)
+                print(name + " (" + str(scale) + " posts): " + json.dumps(result))
+    return run
+
+
+def compare(fn_old, fn_new):
+    """
+    A method to print the relative change of wall time and peak memory between two benchmark runs.
+    :param fn_old: Path to the JSON file of the baseline run.
+    :param fn_new: Path to the JSON file of the new run.
+    :return: The number of stages slower by more than REGRESSION_THRESHOLD.
+    """
+    with open(fn_old, encoding="utf-8") as f:
+        old = {(r["scale"], r["stage"]): r for r in json.load(f)["results"] if r["status"] == "ok"}
+    with open(fn_new, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    print("scale\tstage\ttime_old\ttime_new\ttime_ratio\tpeak_rss_ratio")
+    for r in new:
+        key = (r["scale"], r["stage"])
+        if r["status"] != "ok" or key not in old:
+            continue
+        time_ratio = r["seconds"] / old[key]["seconds"]
+        rss_ratio = r["peak_rss_mb"] / old[key]["peak_rss_mb"]
+        flag = ""
+        if time_ratio > REGRESSION_THRESHOLD:
+            regressions += 1
+            flag = "\tREGRESSION"
+        print("%d\t%s\t%.3f\t%.3f\t%.2f\t%.2f%s" % (key[0], key[1], old[key]["seconds"], r["seconds"],
+                                                    time_ratio, rss_ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    """
+    A method to run the benchmarks from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic corpora.")
+    parser.add_argument("--scales", nargs="+", type=int, default=DEFAULT_SCALES, help="Corpus sizes in posts")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run")
+    parser.add_argument("--time-slices", nargs="+", type=int, default=DEFAULT_TIME_SLICES,
+                        help="Time slices in days for the metrics and correlations stages")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the synthetic corpora")
+    parser.add_argument("--spacy-model", choices=["blank"], default=None,
+                        help="Use a blank Russian spacy pipeline instead of ru_core_news_sm")
+    parser.add_argument("--output-dir", default=RESULTS_DIR, help="Directory for corpora and results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    run = run_benchmarks(args.scales, args.stages, args.time_slices, args.seed, args.spacy_model,
+                         args.output_dir)
+    path = Path(args.output_dir) / "results"
+    path.mkdir(parents=True, exist_ok=True)
+    fn = path / (run["commit"] + "_" + run["date"].replace(":", "-") + ".json")
+    with open(fn, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=4)
+    print("Benchmark results written to " + str(fn) + ".")
+    print("Time consumption benchmarks: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to generate a deterministic synthetic VK corpus for benchmarking.
+
+The generated files mirror the inputs and interim files of the pipeline:
+- media_posts.csv: raw posts (tab-separated, date as unix timestamp in the fifth column)
+- media_posts_processed.csv: posts as produced by <preprocess_text.py> (lowercased tokens)
+- media_posts_ner.json: NER results as produced by <ner.py>
+- rtsi_topics.xlsx: a daily RTSI series with empty rows on weekends
+
+Post texts consist of Russian-like pseudo words drawn from a Zipfian vocabulary and
+inflected country mentions drawn from COUNTRY_GROUPS. Posts are spread over the days
+of the covered period with a weekly rhythm and random news bursts, and are assigned
+to the four outlets with realistic shares. The same seed and size always produce the same files.
+Posts are generated in chunks, so that memory use does not depend on the corpus size.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path[0:0] = [
+    str(Path(__file__).resolve().parents[1] / "utils" / "calculations"),
+    str(Path(__file__).resolve().parents[1] / "utils"),
+]
+from calculate_metrics_prct_change import OUTLETS  # noqa: E402
+from country_groups import COUNTRY_GROUPS  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+SYLLABLES = [
+    "ра", "ло", "ми", "ст", "ко", "на", "ве", "пр", "ти", "до", "ск", "ени", "ова", "ать",
+    "ный", "ого", "ски", "раз", "вы", "по", "за", "ли", "ку", "го", "ре", "сь", "ть", "ям",
+]
+NOISE = ["#новости", "@tass_agency", "https://t.co/x1y2", "2018", "15%", "$100", "😀", "—"]
+SUFFIXES = ["", "а", "у", "е", "ы", "ии", "ия", "ией", "ой", "ского"]
+# Shares of posts per outlet
+OUTLET_SHARES = {"tass": 0.4, "rt": 0.25, "meduza": 0.15, "rbc": 0.2}
+# Relative attention per country group
+COUNTRY_WEIGHTS = {
+    "russia": 10, "usa": 6, "ukraine": 5, "syria": 3, "eu_and_neighbors": 4, "near_east": 2,
+    "china": 1.5, "korea": 1.5, "cis": 1.5,
+}
+CHUNK_SIZE = 100000
+START_DATE = "2018-01-17"
+
+
+def default_days(num_posts):
+    """
+    A method to get a realistic number of covered days for a corpus size.
+    The original corpus has ~300 posts per day; large corpora cover up to three years.
+    :param num_posts: The number of posts.
+    :return: The number of days.
+    """
+    return int(np.clip(num_posts // 300, 52, 3 * 365))
+
+
+def make_vocabulary(rng, size=20000):
+    """
+    A method to create Russian-like pseudo words with Zipfian probabilities.
+    :param rng: A numpy Generator.
+    :param size: The number of distinct words.
+    :return: A tuple of a numpy array of words and a numpy array of probabilities.
+    """
+    lengths = rng.integers(1, 5, size)
+    picks = rng.integers(0, len(SYLLABLES), (size, 4))
+    words = np.array(["".join(SYLLABLES[j] for j in picks[i, :lengths[i]]) for i in range(size)], dtype=object)
+    probs = 1.0 / np.arange(1, size + 1) ** 1.1
+    return words, probs / probs.sum()
+
+
+def make_mentions():
+    """
+    A method to flatten COUNTRY_GROUPS into country name stems with sampling probabilities.
+    :return: A tuple of a list of (country, stem) pairs and a numpy array of probabilities.
+    """
+    pairs = [(country, stem) for country, stems in COUNTRY_GROUPS.items() for stem in sorted(stems)]
+    weights = np.array(
+        [COUNTRY_WEIGHTS.get(country, 0.5) / len(COUNTRY_GROUPS[country]) for country, _ in pairs]
+    )
+    return pairs, weights / weights.sum()
+
+
+def make_day_weights(rng, days):
+    """
+    A method to spread posts over days with a weekly rhythm and random news bursts.
+    :param rng: A numpy Generator.
+    :param days: The number of days.
+    :return: A numpy array of probabilities per day.
+    """
+    dates = pd.date_range(START_DATE, periods=days, freq="D")
+    weights = np.where(dates.dayofweek >= 5, 0.6, 1.0) * rng.gamma(8.0, 1 / 8.0, days)
+    bursts = rng.random(days) < 0.03
+    weights[bursts] *= rng.uniform(1.5, 3.0, bursts.sum())
+    return weights / weights.sum()
+
+
+def generate_chunk(rng, size, offset, vocabulary, mentions, day_weights):
+    """
+    A method to generate a chunk of posts.
+    :param rng: A numpy Generator for this chunk.
+    :param size: The number of posts in the chunk.
+    :param offset: The number of posts generated before this chunk, used for unique post IDs.
+    :param vocabulary: A tuple as returned by make_vocabulary().
+    :param mentions: A tuple as returned by make_mentions().
+    :param day_weights: A numpy array as returned by make_day_weights().
+    :return: A tuple of a pandas DataFrame of raw posts and a list of country mentions per post.
+    """
+    words, word_probs = vocabulary
+    pairs, pair_probs = mentions
+    outlets = list(OUTLET_SHARES)
+    outlet = rng.choice(len(outlets), size, p=list(OUTLET_SHARES.values()))
+    owner = np.array([OUTLETS[outlets[i]] for i in outlet])
+    day = rng.choice(len(day_weights), size, p=day_weights)
+    seconds = rng.integers(0, 86400, size)
+    timestamps = (pd.Timestamp(START_DATE).value // 10 ** 9) + day * 86400 + seconds
+
+    # Draw words for all posts at once and cut them into posts
+    lengths = np.maximum(rng.lognormal(3.4, 0.6, size).astype(int), 3)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    tokens = words[rng.choice(len(words), ends[-1], p=word_probs)]
+
+    # Replace random tokens with noise and inflected country mentions
+    noisy = rng.random(ends[-1]) < 0.02
+    tokens[noisy] = np.array(NOISE, dtype=object)[rng.integers(0, len(NOISE), noisy.sum())]
+    num_mentions = np.minimum(rng.poisson(0.8, size), lengths)
+    mention_posts = np.repeat(np.arange(size), num_mentions)
+    mention_pos = starts[mention_posts] + (rng.random(len(mention_posts)) * lengths[mention_posts]).astype(int)
+    mention_pairs = rng.choice(len(pairs), len(mention_posts), p=pair_probs)
+    suffixes = rng.integers(0, len(SUFFIXES), len(mention_posts))
+    post_mentions = [[] for _ in range(size)]
+    for post, pos, pair, suffix in zip(mention_posts, mention_pos, mention_pairs, suffixes):
+        stem = pairs[pair][1]
+        name = stem if " " in stem or stem.isupper() else stem + SUFFIXES[suffix]
+        name = name[0].upper() + name[1:]
+        tokens[pos] = name
+        post_mentions[post].append(name)
+
+    texts = [" ".join(tokens[s:e]) for s, e in zip(starts, ends)]
+    ids = [o + "_" + str(offset + i) for i, o in enumerate(owner)]
+    posts = pd.DataFrame({
+        "ID": ids,
+        "from_id": owner,
+        "owner_id": owner,
+        "text": texts,
+        "date": timestamps,
+    })
+    return posts, post_mentions
+
+
+def processed_text(texts):
+    """
+    A method to approximate the output of <preprocess_text.py> without spacy.
+    :param texts: A pandas Series of raw texts.
+    :return: A pandas Series of lowercased, space-separated tokens.
+    """
+    texts = texts.str.replace(r"\d+", " NUMBER ", regex=True)
+    texts = texts.str.replace(r"[^\w\s]", "", regex=True).str.lower()
+    return texts.str.replace("number", "NUMBER").str.replace(r"\s{2,}", " ", regex=True).str.strip()
+
+
+def write_rtsi(rng, days, fn):
+    """
+    A method to write a synthetic daily RTSI series with empty rows on weekends.
+    :param rng: A numpy Generator.
+    :param days: The number of days.
+    :param fn: Path of the Excel output file.
+    """
+    dates = pd.date_range(START_DATE, periods=days, freq="D")
+    close = 1250 * np.exp(np.cumsum(rng.normal(0, 0.012, days)))
+    open_ = close * (1 + rng.normal(0, 0.004, days))
+    rtsi = pd.DataFrame({"date": dates, "open": open_.round(2), "close": close.round(2)})
+    rtsi.loc[dates.dayofweek >= 5, ["open", "close"]] = np.nan
+    rtsi.to_excel(fn, index=False)
+
+
+def generate(num_posts, out_dir, seed=42, days=None):
+    """
+    A method to generate a synthetic corpus with all files needed to run the pipeline.
+    :param num_posts: The number of posts.
+    :param out_dir: The output directory.
+    :param seed: The random seed.
+    :param days: The number of covered days. Defaults to default_days(num_posts).
+    :return: A dictionary describing the generated corpus.
+    """
+    days = days or default_days(num_posts)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng([seed, 0])
+    vocabulary = make_vocabulary(rng)
+    mentions = make_mentions()
+    day_weights = make_day_weights(rng, days)
+    write_rtsi(rng, days, out_dir / "rtsi_topics.xlsx")
+
+    fn_raw = out_dir / "media_posts.csv"
+    fn_processed = out_dir / "media_posts_processed.csv"
+    with open(fn_raw, "w", encoding="utf-8") as f_raw, \
+            open(fn_processed, "w", encoding="utf-8") as f_processed, \
+            open(out_dir / "media_posts_ner.json", "w", encoding="utf-8") as f_ner:
+        f_ner.write("{")
+        for chunk, offset in enumerate(range(0, num_posts, CHUNK_SIZE)):
+            size = min(CHUNK_SIZE, num_posts - offset)
+            chunk_rng = np.random.default_rng([seed, chunk + 1])
+            posts, post_mentions = generate_chunk(chunk_rng, size, offset, vocabulary, mentions, day_weights)
+            posts.to_csv(f_raw, sep="\t", index=False, header=chunk == 0)
+
+            processed = posts.copy()
+            processed["text"] = processed_text(processed["text"])
+            processed["date"] = pd.to_datetime(processed["date"], unit="s")
+            processed.to_csv(f_processed, index=False, header=chunk == 0)
+
+            for i, (post_id, names) in enumerate(zip(posts["ID"], post_mentions)):
+                entities = {"GPE_COUNTRY": names} if names else {}
+                if chunk_rng.random() < 0.3:
+                    entities["PERSON"] = ["Путин"]
+                sep = "" if offset + i == 0 else ","
+                f_ner.write(sep + json.dumps(post_id) + ":" + json.dumps(entities, ensure_ascii=False))
+        f_ner.write("}")
+
+    manifest = {"num_posts": num_posts, "days": days, "seed": seed, "start_date": START_DATE}
+    with open(out_dir / "manifest.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main(argv=None):
+    """
+    A method to generate a synthetic corpus from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic VK corpus.")
+    parser.add_argument("--posts", type=int, default=15000, help="Number of posts")
+    parser.add_argument("--days", type=int, default=None, help="Number of covered days")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output", default="code/data/benchmarks/corpus_15000", help="Output directory")
+    args = parser.parse_args(argv)
+
+    manifest = generate(args.posts, args.output, args.seed, args.days)
+    print("Synthetic corpus written to " + args.output + ": " + json.dumps(manifest))
+    print("Time consumption corpus generation: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
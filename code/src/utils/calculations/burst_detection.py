@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to detect bursts of country coverage in the subcorpora.
+
+In more detail, this module is used to flag the periods in which a country suddenly dominates the coverage
+of a subcorpus (e.g. Ukraine in the free outlets) and to compare these bursts with the bursts in the other
+subcorpus and with RTSI moves.
+
+Bursts are detected on the daily counts stored by <calculate_metrics_prct_change.py> with a two-state
+automaton following Kleinberg (2003), "Bursty and Hierarchical Structure in Streams" (binomial model):
+- On each day, a series has d posts (or words), r of which cover the country.
+- In the base state, posts cover the country with the rate p0 of the whole period;
+  in the burst state, the rate is BURST_SCALE * p0.
+- Entering the burst state costs GAMMA * ln(n) for n days, leaving it is free.
+The state sequence with minimal cost is found with the Viterbi algorithm in linear time. All countries
+of all subcorpora are processed at once, as columns of a matrix.
+
+The streaming variant (--stream) updates the automaton as each new day arrives, e.g. after <run_daily_append.sh>.
+The base rate is the rate of all days seen so far and a day is flagged as soon as the burst state is cheaper,
+without revising earlier days. Its state is stored as JSON file next to the results; posts added
+later for days before the last processed day are not revisited.
+
+Examples:
+python3 code/src/utils/calculations/burst_detection.py --rtsi code/data/rtsi_topics.xlsx
+python3 code/src/utils/calculations/burst_detection.py --stream
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+RESULTS_DIR = "code/data/metrics_percent_results/bursts/"
+# Daily counts are the same for all time slices, the counts of time slices of 7 days are used by default
+COUNTS_DIR = metrics.RESULTS_DIR + "7days/"
+BURST_SCALE = 2.0  # Rate of the burst state relative to the base rate
+GAMMA = 1.0  # Cost factor of entering the burst state
+HORIZON = 365  # Number of days n used for the cost of entering the burst state in the streaming variant
+MAX_RATE = 0.9999
+MIN_RATE = 1e-12
+# Counts of the covered and of all posts (or words) per measure
+MEASURES = {
+    "posts": ("_posts", "num_posts"),
+    "mentions": ("_mentions", "num_words"),
+}
+
+
+def load_series(daily, measure="posts", countries=None):
+    """
+    A method to arrange the daily counts of all subcorpora as matrices with one column per series.
+    Days without posts are filled with 0.
+    :param daily: A dictionary mapping subcorpus names to pandas DataFrames of daily counts
+    as returned by metrics.daily_counts().
+    :param measure: "posts" (posts covering a country) or "mentions" (country mentions among all words).
+    :param countries: Optional list of countries. Defaults to the countries in COUNTRY_GROUPS.
+    :return: A tuple of
+    - a pandas DatetimeIndex of all days
+    - a list of (subcorpus, country) tuples labeling the series
+    - a numpy array of covered counts of shape (days, series)
+    - a numpy array of total counts of shape (days, series)
+    """
+    suffix, total = MEASURES[measure]
+    countries = countries or metrics.COUNTRIES
+    start = min(counts.index.min() for counts in daily.values())
+    end = max(counts.index.max() for counts in daily.values())
+    dates = pd.date_range(start, end, freq="D", name="date")
+    labels, covered, totals = [], [], []
+    for name, counts in daily.items():
+        counts = counts.reindex(dates, fill_value=0.0)
+        labels += [(name, country) for country in countries]
+        covered.append(counts[[country + suffix for country in countries]].to_numpy())
+        totals.append(np.repeat(counts[[total]].to_numpy(), len(countries), axis=1))
+    covered, totals = np.hstack(covered), np.hstack(totals)
+    return dates, labels, np.minimum(covered, totals), totals
+
+
+def state_costs(covered, totals, base_rate, scale=BURST_SCALE):
+    """
+    A method to compute the cost (negative binomial log-likelihood without the constant binomial coefficient)
+    of the base and the burst state.
+    :param covered: A numpy array of covered counts.
+    :param totals: A numpy array of total counts of the same shape.
+    :param base_rate: A numpy array of base rates per series, broadcastable to covered.
+    :param scale: The rate of the burst state relative to the base rate.
+    :return: A tuple of two numpy arrays with the costs of the base and the burst state.
+    """
+    costs = []
+    for rate in [base_rate, base_rate * scale]:
+        rate = np.clip(rate, MIN_RATE, MAX_RATE)
+        costs.append(-(covered * np.log(rate) + (totals - covered) * np.log1p(-rate)))
+    return costs[0], costs[1]
+
+
+def kleinberg(covered, totals, scale=BURST_SCALE, gamma=GAMMA):
+    """
+    A method to find the state sequences with minimal cost of a two-state automaton for many series at once.
+    :param covered: A numpy array of covered counts of shape (days, series).
+    :param totals: A numpy array of total counts of shape (days, series).
+    :param scale: The rate of the burst state relative to the base rate.
+    :param gamma: The cost factor of entering the burst state.
+    :return: A tuple of a boolean numpy array of burst states of shape (days, series) and a numpy array
+    of the cost savings of the burst state over the base state per day, which sum up to the weight of a burst.
+    """
+    n = len(covered)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        base_rate = np.nan_to_num(covered.sum(axis=0) / totals.sum(axis=0))
+    cost_base, cost_burst = state_costs(covered, totals, base_rate, scale)
+    enter = gamma * np.log(max(n, 2))
+
+    # Forward pass: minimal cost of ending in each state and whether the predecessor was the burst state
+    from_burst = np.zeros((n, 2, covered.shape[1]), dtype=bool)
+    base, burst = cost_base[0], enter + cost_burst[0]
+    for t in range(1, n):
+        from_burst[t, 0] = burst < base
+        from_burst[t, 1] = burst <= base + enter
+        base, burst = (np.minimum(base, burst) + cost_base[t],
+                       np.minimum(base + enter, burst) + cost_burst[t])
+
+    # Backward pass
+    states = np.zeros(covered.shape, dtype=bool)
+    state = burst < base
+    columns = np.arange(covered.shape[1])
+    for t in range(n - 1, -1, -1):
+        states[t] = state
+        state = from_burst[t, state.astype(int), columns]
+    return states, cost_base - cost_burst
+
+
+def burst_intervals(dates, labels, states, savings):
+    """
+    A method to list the bursts of all series.
+    :param dates: A pandas DatetimeIndex of days.
+    :param labels: A list of (subcorpus, country) tuples.
+    :param states: A boolean numpy array of burst states as returned by kleinberg().
+    :param savings: A numpy array of cost savings as returned by kleinberg().
+    :return: A pandas DataFrame with the columns "subcorpus", "country", "start", "end", "days" and "weight".
+    """
+    padded = np.zeros((len(states) + 2, states.shape[1]), dtype=np.int8)
+    padded[1:-1] = states
+    change = np.diff(padded, axis=0).T
+    # np.nonzero orders by series and then by day, so starts and ends of the bursts are aligned
+    series, starts = np.nonzero(change == 1)
+    _, ends = np.nonzero(change == -1)
+    ends -= 1
+    cumulative = np.vstack([np.zeros((1, states.shape[1])), np.cumsum(savings, axis=0)])
+    bursts = pd.DataFrame({
+        "subcorpus": [labels[i][0] for i in series],
+        "country": [labels[i][1] for i in series],
+        "start": dates[starts],
+        "end": dates[ends],
+        "days": ends - starts + 1,
+        "weight": cumulative[ends + 1, series] - cumulative[starts, series],
+    })
+    return bursts.sort_values(["start", "subcorpus", "country"], ignore_index=True)
+
+
+def add_overlaps(bursts):
+    """
+    A method to add the start of the first overlapping burst of the same country in another subcorpus.
+    :param bursts: A pandas DataFrame as returned by burst_intervals().
+    :return: The pandas DataFrame with a column "overlap_start" (NaT if there is no overlapping burst).
+    """
+    pairs = bursts.reset_index().merge(bursts, on="country", suffixes=("", "_other"))
+    pairs = pairs[(pairs["subcorpus"] != pairs["subcorpus_other"]) & (pairs["start"] <= pairs["end_other"])
+                  & (pairs["end"] >= pairs["start_other"])]
+    bursts["overlap_start"] = pairs.groupby("index")["start_other"].min().reindex(bursts.index)
+    return bursts
+
+
+def add_rtsi_moves(bursts, rtsi):
+    """
+    A method to add the percent change of the RTSI close value during each burst.
+    The change is measured from the last close value before the burst to the last close value of the burst.
+    :param bursts: A pandas DataFrame as returned by burst_intervals().
+    :param rtsi: A pandas DataFrame with a DatetimeIndex "date" and a column "close".
+    :return: The pandas DataFrame with a column "rtsi_pct".
+    """
+    close = rtsi["close"].dropna()
+    before = close.reindex(bursts["start"] - pd.Timedelta(days=1), method="ffill").to_numpy()
+    last = close.reindex(bursts["end"], method="ffill").to_numpy()
+    bursts["rtsi_pct"] = (last / before - 1) * 100
+    return bursts
+
+
+class BurstStream:
+    """The two-state automata of many series, updated as each new day arrives."""
+
+    def __init__(self, labels, scale=BURST_SCALE, gamma=GAMMA, horizon=HORIZON):
+        self.labels = [list(label) for label in labels]
+        self.scale = scale
+        self.gamma = gamma
+        self.horizon = horizon
+        self.last_day = None
+        self.covered = np.zeros(len(labels))
+        self.totals = np.zeros(len(labels))
+        self.costs = np.zeros((2, len(labels)))
+        self.costs[1] = gamma * np.log(horizon)
+        self.states = np.zeros(len(labels), dtype=bool)
+
+    def update(self, day, covered, totals):
+        """
+        A method to add the counts of a new day.
+        :param day: The day as pandas Timestamp.
+        :param covered: A numpy array of covered counts per series.
+        :param totals: A numpy array of total counts per series.
+        :return: A boolean numpy array marking the series entering a burst on this day.
+        """
+        self.covered += covered
+        self.totals += totals
+        with np.errstate(divide="ignore", invalid="ignore"):
+            base_rate = np.nan_to_num(self.covered / self.totals)
+        cost_base, cost_burst = state_costs(covered, totals, base_rate, self.scale)
+        enter = self.gamma * np.log(self.horizon)
+        base, burst = self.costs
+        self.costs = np.array([np.minimum(base, burst) + cost_base, np.minimum(base + enter, burst) + cost_burst])
+        # Only cost differences matter, keep the costs small
+        self.costs -= self.costs.min(axis=0)
+        states = self.costs[1] < self.costs[0]
+        entered = states & ~self.states
+        self.states = states
+        self.last_day = day
+        return entered
+
+    def to_dict(self):
+        """A method to convert the state into a dictionary that can be stored as JSON."""
+        return {
+            "labels": self.labels, "scale": self.scale, "gamma": self.gamma, "horizon": self.horizon,
+            "last_day": str(self.last_day.date()) if self.last_day is not None else None,
+            "covered": self.covered.tolist(), "totals": self.totals.tolist(), "costs": self.costs.tolist(),
+            "states": self.states.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """A method to restore a state stored with to_dict()."""
+        stream = cls(data["labels"], data["scale"], data["gamma"], data["horizon"])
+        stream.last_day = pd.Timestamp(data["last_day"]) if data["last_day"] else None
+        stream.covered = np.array(data["covered"])
+        stream.totals = np.array(data["totals"])
+        stream.costs = np.array(data["costs"])
+        stream.states = np.array(data["states"], dtype=bool)
+        return stream
+
+
+def stream_bursts(dates, labels, covered, totals, fn_state, scale=BURST_SCALE, gamma=GAMMA):
+    """
+    A method to update the stored streaming state with all days after its last day.
+    :param dates: A pandas DatetimeIndex of days.
+    :param labels: A list of (subcorpus, country) tuples.
+    :param covered: A numpy array of covered counts of shape (days, series).
+    :param totals: A numpy array of total counts of shape (days, series).
+    :param fn_state: Path of the JSON state file. A new state is created if the file does not exist.
+    :param scale: The rate of the burst state relative to the base rate (new states only).
+    :param gamma: The cost factor of entering the burst state (new states only).
+    :return: A pandas DataFrame with the columns "date", "subcorpus" and "country" of the bursts
+    entered on the new days.
+    """
+    fn_state = Path(fn_state)
+    if fn_state.exists():
+        with open(fn_state, encoding="utf-8") as f:
+            stream = BurstStream.from_dict(json.load(f))
+        if stream.labels != [list(label) for label in labels]:
+            raise ValueError("The stored state in " + str(fn_state) + " was created for other series.")
+    else:
+        stream = BurstStream(labels, scale, gamma)
+
+    alerts = []
+    for t in np.nonzero(dates > stream.last_day)[0] if stream.last_day is not None else range(len(dates)):
+        for i in np.nonzero(stream.update(dates[t], covered[t], totals[t]))[0]:
+            alerts.append((dates[t], labels[i][0], labels[i][1]))
+
+    fn_state.parent.mkdir(parents=True, exist_ok=True)
+    with open(fn_state, "w", encoding="utf-8") as f:
+        json.dump(stream.to_dict(), f)
+    return pd.DataFrame(alerts, columns=["date", "subcorpus", "country"])
+
+
+def main(argv=None):
+    """
+    A method to detect bursts of country coverage from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Detect bursts of country coverage in the subcorpora.")
+    parser.add_argument("--counts", default=COUNTS_DIR,
+                        help="Metrics output directory of a time slice containing the stored daily counts")
+    parser.add_argument("--input", help="Final CSV file of merged posts, used instead of the stored daily counts")
+    parser.add_argument("--rtsi", help="RTSI Excel file to add the RTSI change during each burst")
+    parser.add_argument("--measure", choices=list(MEASURES), default="posts", help="Coverage measure")
+    parser.add_argument("--scale", type=float, default=BURST_SCALE, help="Burst rate relative to the base rate")
+    parser.add_argument("--gamma", type=float, default=GAMMA, help="Cost factor of entering a burst")
+    parser.add_argument("--stream", action="store_true",
+                        help="Update the stored streaming state with new days and report new bursts")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Output directory")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    with span("load"):
+        if args.input:
+            subcorpora = metrics.split_subcorpora(metrics.load_posts(args.input))
+            daily = {name: metrics.daily_counts(corpus) for name, corpus in subcorpora.items()}
+        else:
+            daily = {name: metrics.load_daily_counts(args.counts, name) for name in metrics.SUBCORPORA}
+            if any(counts is None for counts in daily.values()):
+                sys.exit("No daily counts stored in " + args.counts + ". Run <calculate_metrics_prct_change.py> "
+                         "first or use --input.")
+        dates, labels, covered, totals = load_series(daily, args.measure)
+
+    path = Path(args.output)
+    path.mkdir(parents=True, exist_ok=True)
+    if args.stream:
+        with span("stream", rows=len(dates)):
+            alerts = stream_bursts(dates, labels, covered, totals, path / ("burst_state_" + args.measure + ".json"),
+                                   args.scale, args.gamma)
+        fn_alerts = path / ("burst_alerts_" + args.measure + ".csv")
+        alerts.to_csv(fn_alerts, mode="a", header=not fn_alerts.exists(), index=False, encoding="utf-8")
+        print(str(len(alerts)) + " new burst(s) saved to " + str(fn_alerts))
+        if len(alerts):
+            print(alerts.to_string(index=False))
+    else:
+        with span("kleinberg", rows=covered.size):
+            states, savings = kleinberg(covered, totals, args.scale, args.gamma)
+        bursts = add_overlaps(burst_intervals(dates, labels, states, savings))
+        if args.rtsi:
+            bursts = add_rtsi_moves(bursts, metrics.load_rtsi(args.rtsi))
+        states = pd.DataFrame(states.astype(int), index=dates, columns=[s + "_" + c for s, c in labels])
+        bursts.to_csv(path / ("bursts_" + args.measure + ".csv"), index=False, encoding="utf-8")
+        states.to_csv(path / ("burst_states_" + args.measure + ".csv"), encoding="utf-8")
+        print(str(len(bursts)) + " bursts saved to " + str(path))
+
+    print("Time consumption burst detection: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,184 +5,248 @@ In addition, the percent change of these metrics and RTSI values is calculated f
 
 This module can be run from the terminal or in combination with the utils modules using the bash script <run_calculations.sh>
 
-NOTE: When calculating percent change, NaNs are replaced with 0 as they indicate a percent change of 0%. 
+Posts are first aggregated into daily counts per outlet (number of posts, number of words and,
+for each country, the number of posts and country mentions), which are added up per subcorpus.
+The daily counts of the outlets (e.g. for <lead_lag.py>) and of the subcorpora are stored next to
+the results, and the latter are summed up into time slices. In append mode (--append), only the posts
+of a new delivery are counted, added to the stored daily counts, and only the time slices touching
+the new dates are recomputed, see <run_daily_append.sh>.
+
+With --dedup, near-duplicate posts found with <near_duplicates.py> are counted only once per outlet.
+With --words num_lemmas, word level metrics are normalized by the number of word lemmas of <lemmatize.py>
+instead of the number of tokens.
+With --alignment trading, time slices span trading days instead of calendar days, see <slice_calendar.py>.
+Both the posts and the RTSI rows are mapped to time slices by the same SliceCalendar.
+
+NOTE: When calculating percent change, NaNs are replaced with 0 as they indicate a percent change of 0%.
 inf is replaced with 100 as it always indicates that a percent change from 0 in the previous row to some value in the current row occurred.
 (percent change: (in-/decrease = (float - 0))// 0 * 100 => inf).
 """
 import argparse
-import os
 import sys
 import time
-from datetime import timedelta
 from pathlib import Path
-import numpy as np
-np.seterr(divide='ignore', invalid='ignore')
-import pandas as pd
-from country_groups import COUNTRY_GROUPS
-
-# Monitor time
-start_time = time.time()
-
-# Load data
-fn_vk = ""
-fn_rtsi = ""
-time_slice = 0
-
-if len(sys.argv) < 2:
-    print(
-        "python3 calculate_metrics_prct_change.py \
-        <media_posts_processed_final.csv \
-        rtsi_topics.xlsx time_slice>"
-    )
-else:
-    fn_vk = sys.argv[1]
-    fn_rtsi = sys.argv[2]
-    time_slice = int(sys.argv[3])
-if time_slice >= 1:
-    print(
-        "Calculate values for a time slice of " + str(time_slice) + " day(s)."
+
+from slice_calendar import ALIGNMENTS, SliceCalendar, load_alignment, save_alignment
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from country_groups import COUNTRY_GROUPS  # noqa: E402
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# VK owner IDs of the news outlets
+# Note: -26284064: TASS, -40316705: RussiaToday, -76982440: Meduza, -25232578: RBC.
+OUTLETS = {
+    "tass": "-26284064",
+    "rt": "-40316705",
+    "meduza": "-76982440",
+    "rbc": "-25232578",
+}
+# Subcorpora with their status codes: control == 0, free == 1
+SUBCORPORA = {
+    "control": (0, ["tass", "rt"]),
+    "free": (1, ["meduza", "rbc"]),
+}
+COUNTRIES = list(COUNTRY_GROUPS.keys())
+RESULTS_DIR = "code/data/metrics_percent_results/"
+
+
+def load_posts(fn_vk):
+    """
+    A method to load the final table of merged posts and country labels.
+    :param fn_vk: Path to the CSV file created by <merge_ner_and_posts.py>.
+    :return: A pandas DataFrame with a DatetimeIndex "date".
+    """
+    data_all = pd.read_csv(
+        fn_vk,
+        encoding="utf_8",
+        sep=",",
+        index_col=["date"],
+        parse_dates=["date"],
+        infer_datetime_format=True,
     )
-else:
-    print(
-        "Invalid time slice: "
-        + str(time_slice)
-        + ".\nPlease enter a valid time slice > 0."
+    data_all.index = pd.to_datetime(data_all.index, unit="s")
+    return data_all
+
+
+def load_rtsi(fn_rtsi):
+    """
+    A method to load the daily RTSI close values.
+    :param fn_rtsi: Path to the RTSI Excel file.
+    :return: A pandas DataFrame with a DatetimeIndex "date" and a column "close".
+    """
+    return pd.read_excel(
+        fn_rtsi,
+        usecols="A,C",
+        index_col=[0],
+        parse_dates=[0]
     )
-    sys.exit()
-print("Prep time slice " + str(time_slice))
-
-# Prep output
-path = Path("code/data/metrics_percent_results/" + str(time_slice) + "days/")
-path.mkdir(parents=True, exist_ok=True)
-
-# Load data
-data_all = pd.read_csv(
-    fn_vk,
-    encoding="utf_8",
-    sep=",",
-    index_col=["date"],
-    parse_dates=["date"],
-    infer_datetime_format=True,
-)
-data_all.index = pd.to_datetime(data_all.index, unit="s")
-
-rtsi = pd.read_excel(
-    fn_rtsi,
-    usecols="A,C",
-    index_col=[0],
-    parse_dates=[0]
-)
-
-# Partition data into free and control
-tass = data_all[data_all.ID.astype(str).str.contains("-26284064")]
-rt = data_all[data_all.ID.astype(str).str.startswith("-40316705")]
-control = pd.concat([tass, rt])
-
-meduza = data_all[data_all.ID.astype(str).str.startswith("-76982440")]
-rbc = data_all[data_all.ID.astype(str).str.startswith("-25232578")]
-free = pd.concat([meduza, rbc])
-subcorpora = [control, free]
-
-# Calculate percent change of RTSI for a given time slice
-# For each subcorpus:
-# - Calculate post and word level metrics for each country
-# - Calculate the percent change of these metrics for each country
-countries = list(COUNTRY_GROUPS.keys())
-results = []
-for corpus in subcorpora:
-    # RTSI prep
-    rtsi.reset_index(inplace=True)
+
+
+def split_subcorpora(data_all):
+    """
+    A method to partition posts into the control and free subcorpus.
+    :param data_all: A pandas DataFrame containing at least a column "ID".
+    :return: A dictionary mapping the subcorpus names "control" and "free" to pandas DataFrames.
+    """
+    ids = data_all.ID.astype(str)
+    subcorpora = {}
+    for name, (_, outlets) in SUBCORPORA.items():
+        subcorpora[name] = pd.concat(
+            [data_all[ids.str.startswith(OUTLETS[outlet])] for outlet in outlets]
+        )
+    return subcorpora
+
+
+def post_outlets(data_all):
+    """
+    A method to get the outlet of each post from its ID.
+    :param data_all: A pandas DataFrame containing at least a column "ID".
+    :return: A numpy array of outlet names ("" for posts of other owners).
+    """
+    ids = data_all["ID"].astype(str)
+    outlet = np.full(len(data_all), "", dtype=object)
+    for name, owner_id in OUTLETS.items():
+        outlet[ids.str.startswith(owner_id).to_numpy()] = name
+    return outlet
+
+
+def drop_near_duplicates(data_all, fn_clusters):
+    """
+    A method to keep only the earliest post of each near-duplicate cluster per outlet.
+    Republished wire copy of different outlets is still counted once for each outlet.
+    :param data_all: A pandas DataFrame with a DatetimeIndex containing at least a column "ID".
+    :param fn_clusters: Path to the near-duplicate clusters CSV file created by <near_duplicates.py>.
+    :return: The pandas DataFrame without near duplicates.
+    """
+    clusters = pd.read_csv(fn_clusters, encoding="utf-8", sep=",", dtype={"ID": str, "dup_cluster": str})
+    clusters.index = clusters["ID"].str.replace("_", "", regex=False).astype("int64")
+    keys = pd.DataFrame({
+        "cluster": data_all["ID"].map(clusters["dup_cluster"]).fillna(data_all["ID"].astype(str)).to_numpy(),
+        "outlet": post_outlets(data_all),
+    })
+    order = np.argsort(data_all.index.to_numpy(), kind="stable")
+    duplicated = np.zeros(len(data_all), dtype=bool)
+    duplicated[order] = keys.iloc[order].duplicated().to_numpy()
+    return data_all[~duplicated]
+
+
+def post_counts(corpus, words=None):
+    """
+    A method to get the contribution of each post to the daily counts.
+    :param corpus: A pandas DataFrame as described in daily_counts().
+    :param words: Optional column with the number of words per post, see daily_counts().
+    :return: A pandas DataFrame with the index of corpus and the columns of daily_counts().
+    """
+    has_id = corpus["ID"].notna()
+    if words is None:
+        num_words = corpus["text"].str.split().str.len()
+    else:
+        num_words = corpus[words]
+    counts = {
+        "num_posts": has_id.astype("float"),
+        "num_words": num_words.fillna(0).astype("float"),
+    }
+    for country in COUNTRIES:
+        mentioned = corpus[country] >= 1
+        counts[country + "_posts"] = (mentioned & has_id).astype("float")
+        counts[country + "_mentions"] = corpus[country].where(mentioned, 0).astype("float")
+    return pd.DataFrame(counts, index=corpus.index)
+
+
+def daily_counts(corpus, weights=None, words=None):
+    """
+    A method to count posts, words and country coverage per day.
+    :param corpus: A pandas DataFrame with a DatetimeIndex containing at least
+    - a column "ID" with post IDs
+    - a column "text" with preprocessed text
+    - a column for each country in COUNTRY_GROUPS with the number of country mentions
+    :param weights: Optional array of weights per post, e.g. inverse sampling probabilities.
+    :param words: Optional column with the number of words per post, e.g. "num_lemmas" of <lemmatize.py>.
+    Defaults to the number of whitespace-separated tokens in column "text".
+    :return: A pandas DataFrame indexed by day with the columns "num_posts", "num_words" and,
+    for each country, "<country>_posts" (posts mentioning the country) and
+    "<country>_mentions" (occurrences of the country, e.g. U.S.).
+    """
+    counts = post_counts(corpus, words)
+    if weights is not None:
+        counts = counts.mul(np.asarray(weights, dtype="float"), axis=0)
+    daily = counts.groupby(corpus.index.normalize()).sum()
+    daily.index.name = "date"
+    return daily
+
+
+def slice_counts(daily, calendar, slices=None):
+    """
+    A method to sum up daily counts into time slices.
+    :param daily: A pandas DataFrame of daily counts as returned by daily_counts().
+    :param calendar: A SliceCalendar defining the time slices.
+    :param slices: Optional list of time slice indices to compute. Defaults to all time slices.
+    :return: A pandas DataFrame of counts indexed by time slice index.
+    """
+    if slices is None:
+        slices = range(len(calendar))
+    ids = calendar.slice_ids(daily.index)
+    selected = np.isin(ids, list(slices))
+    counts = daily[selected].groupby(ids[selected]).sum()
+    counts = counts.reindex(list(slices), fill_value=0.0)
+    counts.index.name = "slice"
+    return counts
+
+
+def rtsi_slices(rtsi, calendar):
+    """
+    A method to aggregate RTSI values per time slice and calculate their percent change.
+    :param rtsi: A pandas DataFrame with a DatetimeIndex "date" and a column "close".
+    :param calendar: A SliceCalendar defining the time slices.
+    :return: A pandas DataFrame indexed by the last day of each time slice with the
+    columns "close", "rtsi" and "rtsi_pct".
+    """
+    ids = calendar.slice_ids(rtsi.index)
+    selected = (ids >= 0) & (ids < len(calendar))
+    rtsi = rtsi[selected].reset_index()
     d = {"date": "last", "close": "sum"}
-    res = rtsi.groupby(rtsi.index // time_slice).agg(d)
+    res = rtsi.groupby(ids[selected]).agg(d)
+    # Time slices without RTSI rows end on their last calendar day
+    res = res.reindex(range(len(calendar)))
+    res["date"] = res["date"].fillna(pd.Series(calendar.last_days(), index=res.index))
     res.set_index("date", inplace=True)
-    rtsi.set_index("date", inplace=True)
 
     # Calculate percent change of RTSI
     res["rtsi"] = res["close"]
     res["rtsi_pct"] = res["close"].pct_change() * 100
-
+    return res
+
+
+def slice_metrics(counts, res, countries=None):
+    """
+    A method to calculate post and word level metrics for each country and their percent change.
+    :param counts: A pandas DataFrame of counts per time slice as returned by slice_counts().
+    :param res: A pandas DataFrame of RTSI values per time slice as returned by rtsi_slices().
+    :param countries: Optional list of labels with "<label>_posts" and "<label>_mentions" counts,
+    e.g. terms or topics. Defaults to the countries in COUNTRY_GROUPS.
+    :return: A tuple of three pandas DataFrames:
+    - percent changes of the metrics (and the normalized post level metrics "<country>_psts")
+    - normalized post level metrics
+    - normalized word level metrics
+    """
+    res = res.copy(deep=True)
     # Prep for correlation calculation
     cov_psts = res.copy(deep=True)
     cov_wrds = res.copy(deep=True)
 
-    # Get number of total posts and words per time slice
-    num_posts = []
-    num_words = []
-    start_date = rtsi.index.min()
-    end_date = rtsi.index.min()
-    final_date = rtsi.index.max() + timedelta(days=1)
-
-    # Account for time slices > 1 day
-    if time_slice > 1:
-        end_date = end_date + timedelta(days=time_slice - 1)
-
-    while start_date < final_date:
-        # Convert to searchable type
-        start_date_searchable = str(start_date.date())
-        end_date_searchable = str(end_date.date())
-
-        # Count all posts per day
-        num_posts.append(
-            corpus.loc[start_date_searchable:end_date_searchable]
-            .ID.value_counts()
-            .sum()
-        )
-        # Count all words per post
-        corpus["num_words"] = corpus["text"].str.split().str.len()
-        num_words.append(
-            corpus.loc[start_date_searchable:end_date_searchable]
-            .num_words.sum()
-            .astype("float")
-        )
-        start_date = start_date + timedelta(days=time_slice)
-        end_date = end_date + timedelta(days=time_slice)
-
-    for country in countries:
+    num_posts = counts["num_posts"].to_numpy()
+    num_words = counts["num_words"].to_numpy()
+    for country in countries or COUNTRIES:
         # Add country variable
         res[country + "_name"] = country
 
-        # Reset vars
-        country_posts = []
-        country_words = []
-        country_mentions = []
-        temp = corpus.loc[corpus[country] >= 1]
-        start_date = rtsi.index.min()
-        end_date = rtsi.index.min()
-        final_date = rtsi.index.max() + timedelta(days=1)
-
-        # Account for time slices > 1 day
-        if time_slice > 1:
-            end_date = end_date + timedelta(days=time_slice - 1)
-
-        while start_date < final_date:
-            start_date_searchable = str(start_date.date())
-            end_date_searchable = str(end_date.date())
-            # Count posts per country on a day
-            country_posts.append(
-                temp.loc[start_date_searchable:end_date_searchable]
-                .ID.value_counts()
-                .sum()
-                .astype("float")
-            )
-            # Count words per country on a day
-            country_words.append(
-                temp.loc[start_date_searchable:end_date_searchable]
-                .text.str.split()
-                .str.len()
-                .sum()
-                .astype("float")
-            )
-            # Count occurrences of country as a string per day, e.g. U.S.
-            country_mentions.append(
-                temp.loc[start_date_searchable:end_date_searchable][
-                    country
-                ].sum()
-            )
-            start_date = start_date + timedelta(days=time_slice)
-            end_date = end_date + timedelta(days=time_slice)
-
         # Get normalized # of country coverage on post level per day per country
-        country_pst_norm = np.divide(country_posts, num_posts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            country_pst_norm = np.divide(counts[country + "_posts"].to_numpy(), num_posts)
         res[country + " pst_pct_norm"] = country_pst_norm
         # Interim results for calculating DAILY correlations:
         # Normalized absolute values needed
@@ -194,7 +258,8 @@ for corpus in subcorpora:
         )
 
         # Get normalized # of country coverage on word level per day per country
-        country_words_norm = np.divide(country_mentions, num_words)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            country_words_norm = np.divide(counts[country + "_mentions"].to_numpy(), num_words)
         res[country + " wrd_pct_norm"] = country_words_norm
         # Interim results for calculating DAILY correlations: normalized absolute values needed
         cov_wrds[country + "_wrds"] = country_words_norm
@@ -208,103 +273,243 @@ for corpus in subcorpora:
     res.fillna(0, inplace=True)
     cov_psts.fillna(0, inplace=True)
     cov_wrds.fillna(0, inplace=True)
-
-    # Store result of given subcorpus
-    results.append(res)
-    results.append(cov_psts)
-    results.append(cov_wrds)
-    del res
-
-# Add status as a column to each subcorpus
-# Codes: control == 0, free == 1
-results[0]["status"] = 0
-results[1]["status"] = 0
-results[2]["status"] = 0
-
-results[3]["status"] = 1
-results[4]["status"] = 1
-results[5]["status"] = 1
-
-# Save results as CSV files.
-for i in range(0, 6):
-    fn = ""
-    if i == 0:
-        fn = "control_pct_change_all_"
-    elif i == 1:
-        fn = "control_pst_all"
-    elif i == 2:
-        fn = "control_wrd_all"
-    elif i == 3:
-        fn = "free_pct_change_all_"
-    elif i == 4:
-        fn = "free_pst_all"
-    elif i == 5:
-        fn = "free_wrd_all"
-    else:
-        print("Something went wrong. Please try again.")
-    results[i].to_csv(
-        str(path)
-        + "/"
-        + str(fn)
-        + str(time_slice)
-        + ".csv",
-        encoding="utf-8",
-    )
-
-# Create individual country CSV files with all country coverage values and status.
-# Save each country table in control and free version as .csv file
-path_countries = Path("code/data/metrics_percent_results/" + str(time_slice) + "days/countries/")
-path_countries.mkdir(parents=True, exist_ok=True)
-
-results_country = {}
-pct_changed = [results[0], results[3]]
-
-for country in countries:
-    results_country[country] = []
-    for subcorpus in pct_changed:
-        # Select columns of a given country
-        res_country = pd.DataFrame(subcorpus["rtsi_pct"])
-        res_country["rtsi"] = pd.DataFrame(subcorpus["rtsi"])
-        country_cols = [col for col in subcorpus.columns if country in col]
-        res_country[country_cols] = subcorpus[country_cols]
-        # Remove country prefix
-        res_country.rename(
-            columns={country + "_name": "country"}, inplace=True
-        )
-        res_country.rename(
-            columns={country + " pst_pct_norm": "post"}, inplace=True
-        )
-        res_country.rename(
-            columns={country + " wrd_pct_norm": "word"}, inplace=True
-        )
-        res_country.rename(
-            columns={country + "_psts": "abs_posts"}, inplace=True
-        )
-        # Assign status of given subcorpus to given country
-        res_country["status"] = subcorpus["status"]
-        # Add country to corpus frame with all countries and stati
-        results_country[country].append(res_country)
-        # Save each country as individual .csv file
-        # Save results as CSV files.
-        if subcorpus["status"].astype(str).str.contains("0").any():
-            res_country.to_csv(
-                str(path_countries)
-                + "/"
-                + country
-                + "_control"
-                + str(time_slice)
-                + ".csv",
+    return res, cov_psts, cov_wrds
+
+
+def save_results(results, calendar, path, countries=None):
+    """
+    A method to save the metrics of all subcorpora as CSV files.
+    In addition, individual country CSV files with all country coverage values and status are saved,
+    and the alignment policy of the time slices.
+    :param results: A dictionary mapping subcorpus names to the tuples returned by slice_metrics().
+    :param calendar: The SliceCalendar of the time slices.
+    :param path: The output directory.
+    :param countries: Optional list of labels passed to slice_metrics(). Defaults to the countries in COUNTRY_GROUPS.
+    """
+    time_slice = calendar.time_slice
+    save_alignment(calendar, path)
+    for name, (res, cov_psts, cov_wrds) in results.items():
+        # Add status as a column to each subcorpus
+        status = SUBCORPORA[name][0]
+        for frame, fn in [
+            (res, name + "_pct_change_all_"),
+            (cov_psts, name + "_pst_all"),
+            (cov_wrds, name + "_wrd_all"),
+        ]:
+            frame["status"] = status
+            frame.to_csv(
+                str(path) + "/" + fn + str(time_slice) + ".csv",
                 encoding="utf-8",
             )
-        else:
+
+    # Save each country table in control and free version as .csv file
+    path_countries = Path(path) / "countries"
+    path_countries.mkdir(parents=True, exist_ok=True)
+    for country in countries or COUNTRIES:
+        for name, (subcorpus, _, _) in results.items():
+            # Select columns of a given country
+            res_country = pd.DataFrame(subcorpus["rtsi_pct"])
+            res_country["rtsi"] = pd.DataFrame(subcorpus["rtsi"])
+            # Exact column names, so that labels containing other labels are not mixed up
+            country_cols = [country + suffix for suffix in ["_name", " pst_pct_norm", "_psts", " wrd_pct_norm"]]
+            res_country[country_cols] = subcorpus[country_cols]
+            # Remove country prefix
+            res_country.rename(
+                columns={
+                    country + "_name": "country",
+                    country + " pst_pct_norm": "post",
+                    country + " wrd_pct_norm": "word",
+                    country + "_psts": "abs_posts",
+                },
+                inplace=True,
+            )
+            # Assign status of given subcorpus to given country
+            res_country["status"] = subcorpus["status"]
             res_country.to_csv(
-                str(path_countries)
-                + "/"
-                + country
-                + "_free"
-                + str(time_slice)
-                + ".csv",
+                str(path_countries) + "/" + country + "_" + name + str(time_slice) + ".csv",
                 encoding="utf-8",
             )
 
-print("Time consumption prep: --- %s seconds ---" % (time.time() - start_time))
+
+def daily_counts_file(path, name):
+    """A method to get the file name of the stored daily counts of a subcorpus or outlet."""
+    return Path(path) / "daily_counts" / ("daily_counts_" + name + ".csv")
+
+
+def load_daily_counts(path, name):
+    """
+    A method to load the stored daily counts of a subcorpus or outlet.
+    :param path: The output directory.
+    :param name: The subcorpus or outlet name.
+    :return: A pandas DataFrame of daily counts or None if no counts are stored.
+    """
+    fn = daily_counts_file(path, name)
+    if not fn.exists():
+        return None
+    return pd.read_csv(fn, encoding="utf-8", index_col=["date"], parse_dates=["date"])
+
+
+def save_daily_counts(daily, path, name):
+    """
+    A method to store the daily counts of a subcorpus or outlet.
+    :param daily: A pandas DataFrame of daily counts.
+    :param path: The output directory.
+    :param name: The subcorpus or outlet name.
+    """
+    fn = daily_counts_file(path, name)
+    fn.parent.mkdir(parents=True, exist_ok=True)
+    daily.to_csv(fn, encoding="utf-8")
+
+
+def add_daily_counts(stored, new):
+    """
+    A method to add the daily counts of new posts to stored daily counts.
+    :param stored: A pandas DataFrame of stored daily counts or None.
+    :param new: A pandas DataFrame of daily counts of new posts.
+    :return: A pandas DataFrame with the summed daily counts.
+    """
+    if stored is None:
+        return new
+    return stored.add(new, fill_value=0.0).sort_index()
+
+
+def slice_counts_file(path, name, time_slice):
+    """A method to get the file name of the stored time slice counts of a subcorpus."""
+    return Path(path) / "daily_counts" / ("slice_counts_" + name + str(time_slice) + ".csv")
+
+
+def update_slice_counts(daily, new_days, calendar, path, name):
+    """
+    A method to recompute the time slice counts touched by new days only.
+    If no counts are stored for the given time slice, or the stored counts do not match
+    the time slices or the alignment policy of the calendar, all time slices are recomputed from the daily counts.
+    :param daily: A pandas DataFrame of all daily counts of a subcorpus.
+    :param new_days: A pandas DatetimeIndex of days with new posts.
+    :param calendar: A SliceCalendar defining the time slices.
+    :param path: The output directory.
+    :param name: The subcorpus name.
+    :return: A tuple of a pandas DataFrame with the counts of all time slices and
+    the list of recomputed time slice indices.
+    """
+    fn = slice_counts_file(path, name, calendar.time_slice)
+    n = len(calendar)
+    stored = None
+    if fn.exists():
+        stored = pd.read_csv(fn, encoding="utf-8", index_col=["slice"])
+        policy = load_alignment(path, calendar.time_slice) or {}
+        if len(stored) != n or list(stored.columns) != list(daily.columns) or \
+                [policy.get(key) for key in ["alignment", "first_day"]] != \
+                [calendar.policy()[key] for key in ["alignment", "first_day"]]:
+            stored = None
+    if stored is None or new_days is None:
+        affected = list(range(n))
+        counts = slice_counts(daily, calendar)
+    else:
+        ids = calendar.slice_ids(new_days)
+        affected = sorted(set(ids[(ids >= 0) & (ids < n)].tolist()))
+        counts = stored
+        if affected:
+            counts.loc[affected] = slice_counts(daily, calendar, affected)
+    fn.parent.mkdir(parents=True, exist_ok=True)
+    counts.to_csv(fn, encoding="utf-8")
+    return counts, affected
+
+
+def main(argv=None):
+    """
+    A method to calculate metrics and percent change values for a time slice.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Calculate metrics and percent change values.")
+    parser.add_argument("input", help="Final CSV file of merged posts (new posts only in append mode)")
+    parser.add_argument("rtsi", help="RTSI Excel file")
+    parser.add_argument("time_slice", type=int, help="Length of a time slice in days")
+    parser.add_argument("--append", action="store_true",
+                        help="Add the input posts to the stored daily counts and only recompute "
+                             "the time slices touching their dates")
+    parser.add_argument("--dedup", metavar="CLUSTERS",
+                        help="Near-duplicate clusters CSV file to count each cluster once per outlet")
+    parser.add_argument("--words", metavar="COLUMN",
+                        help="Column with the number of words per post, e.g. num_lemmas of <lemmatize.py>")
+    parser.add_argument("--alignment", choices=ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    time_slice = args.time_slice
+
+    if time_slice >= 1:
+        print(
+            "Calculate values for a time slice of " + str(time_slice) + " day(s)."
+        )
+    else:
+        print(
+            "Invalid time slice: "
+            + str(time_slice)
+            + ".\nPlease enter a valid time slice > 0."
+        )
+        sys.exit()
+    print("Prep time slice " + str(time_slice))
+
+    # Prep output
+    path = Path(RESULTS_DIR + str(time_slice) + "days/")
+    path.mkdir(parents=True, exist_ok=True)
+
+    with span("calculate_metrics", time_slice=time_slice):
+        # Load data
+        with span("load") as load:
+            data_all = load_posts(args.input)
+            rtsi = load_rtsi(args.rtsi)
+            load.rows = len(data_all)
+        if args.dedup:
+            with span("dedup", rows=len(data_all)):
+                data_all = drop_near_duplicates(data_all, args.dedup)
+        calendar = SliceCalendar(rtsi, time_slice, args.alignment)
+        res_rtsi = rtsi_slices(rtsi, calendar)
+
+        # Count posts, words and country coverage per day and outlet
+        outlet_daily = {}
+        outlets = post_outlets(data_all)
+        for name in OUTLETS:
+            corpus = data_all[outlets == name]
+            with span("daily_counts", rows=len(corpus), outlet=name):
+                outlet_daily[name] = daily_counts(corpus, words=args.words)
+
+        # For each subcorpus:
+        # - Add up the daily counts of its outlets
+        # - Calculate post and word level metrics for each country per time slice
+        # - Calculate the percent change of these metrics for each country
+        results = {}
+        for name, (_, members) in SUBCORPORA.items():
+            daily = None
+            for outlet in members:
+                daily = add_daily_counts(daily, outlet_daily[outlet])
+            new_days = None
+            if args.append:
+                new_days = daily.index
+                daily = add_daily_counts(load_daily_counts(path, name), daily)
+            save_daily_counts(daily, path, name)
+            with span("slice_aggregation", rows=len(daily), subcorpus=name) as aggregation:
+                counts, affected = update_slice_counts(daily, new_days, calendar, path, name)
+                aggregation.args["slices"] = len(affected)
+            if args.append:
+                print("Recomputed " + str(len(affected)) + " time slice(s) of subcorpus " + name + ".")
+            with span("slice_metrics", rows=len(counts), subcorpus=name):
+                results[name] = slice_metrics(counts, res_rtsi)
+
+        for name, daily in outlet_daily.items():
+            if args.append:
+                daily = add_daily_counts(load_daily_counts(path, name), daily)
+            save_daily_counts(daily, path, name)
+
+        with span("write"):
+            save_results(results, calendar, path)
+
+    print("Time consumption prep: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to calculate which countries are mentioned together in the posts of a time slice.
+
+In more detail, this module is used to track which country pairs are framed together in each subcorpus,
+complementing the coverage of single countries calculated by <calculate_metrics_prct_change.py>.
+
+The posts of a subcorpus are represented as a sparse binary post x country matrix X (1 if a post mentions
+a country). The country x country co-mention matrices of all time slices are computed with a single sparse
+product: the columns of X are shifted into the block of the time slice of each post, which yields the
+matrix Y of shape (posts, time slices * countries), so that the row blocks of Y^T X are the matrices X_s^T X_s
+of the time slices s. The diagonal holds the number of posts mentioning a country.
+
+For each time slice and country pair, the following values are saved:
+- co_posts: the number of posts mentioning both countries
+- pmi: pointwise mutual information log2(co_posts * num_posts / (posts_a * posts_b)),
+  empty if no post mentions both countries
+- jaccard: co_posts / (posts_a + posts_b - co_posts)
+- pmi_change, jaccard_change: the difference to the previous time slice
+- co_posts_pct: the percent change of co_posts (NaN is replaced with 0 and inf with 100, as for the metrics)
+
+Example:
+python3 code/src/utils/calculations/comentions.py code/data/media_posts_processed_final.csv code/data/rtsi_topics.xlsx 7
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+
+
+def country_matrix(corpus, countries=None):
+    """
+    A method to build the sparse post x country matrix of a subcorpus.
+    :param corpus: A pandas DataFrame as described in metrics.daily_counts().
+    :param countries: Optional list of countries. Defaults to the countries in COUNTRY_GROUPS.
+    :return: A scipy CSR matrix with 1 for each country mentioned in a post.
+    """
+    countries = countries or metrics.COUNTRIES
+    mentioned = (corpus[countries].fillna(0).to_numpy() >= 1) & corpus["ID"].notna().to_numpy()[:, None]
+    return sparse.csr_matrix(mentioned, dtype=np.float64)
+
+
+def comention_counts(matrix, slices, num):
+    """
+    A method to calculate the co-mention matrices of all time slices with a single sparse product.
+    :param matrix: A scipy sparse post x country matrix as returned by country_matrix().
+    :param slices: A numpy array of time slice indices per post in the range [0, num).
+    :param num: The number of time slices.
+    :return: A numpy array of shape (num, countries, countries).
+    """
+    num_countries = matrix.shape[1]
+    coo = matrix.tocoo()
+    # Shift the columns of each post into the block of its time slice
+    shifted = sparse.csr_matrix(
+        (coo.data, (coo.row, slices[coo.row] * num_countries + coo.col)),
+        shape=(matrix.shape[0], num * num_countries),
+    )
+    return (shifted.T @ matrix).toarray().reshape(num, num_countries, num_countries)
+
+
+def associations(co_posts, num_posts):
+    """
+    A method to calculate normalized association scores from co-mention matrices.
+    :param co_posts: A numpy array of co-mention matrices as returned by comention_counts().
+    :param num_posts: A numpy array of the number of posts per time slice.
+    :return: A tuple of two numpy arrays of the shape of co_posts with the PMI and the Jaccard index.
+    """
+    posts = np.diagonal(co_posts, axis1=1, axis2=2)
+    posts_a, posts_b = posts[:, :, None], posts[:, None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pmi = np.log2(co_posts * num_posts[:, None, None] / (posts_a * posts_b))
+        jaccard = np.nan_to_num(co_posts / (posts_a + posts_b - co_posts))
+    pmi[co_posts == 0] = np.nan
+    return pmi, jaccard
+
+
+def comention_table(corpus, calendar, res_rtsi, countries=None):
+    """
+    A method to calculate the co-mentions and association scores of all country pairs in all time slices.
+    :param corpus: A pandas DataFrame of the posts of a subcorpus with a DatetimeIndex.
+    :param calendar: A SliceCalendar defining the time slices.
+    :param res_rtsi: A pandas DataFrame of RTSI values per time slice as returned by metrics.rtsi_slices().
+    :param countries: Optional list of countries. Defaults to the countries in COUNTRY_GROUPS.
+    :return: A pandas DataFrame indexed by the dates of the time slices with one row per country pair.
+    """
+    countries = countries or metrics.COUNTRIES
+    # Only time slices with RTSI values are part of the results, cf. rtsi_slices()
+    num = len(res_rtsi)
+    slices = calendar.slice_ids(corpus.index.normalize())
+    selected = (slices >= 0) & (slices < num) & corpus["ID"].notna().to_numpy()
+    matrix = country_matrix(corpus[selected], countries)
+    co_posts = comention_counts(matrix, slices[selected], num)
+    num_posts = np.bincount(slices[selected], minlength=num).astype(np.float64)
+    pmi, jaccard = associations(co_posts, num_posts)
+
+    first, second = np.triu_indices(len(countries), 1)
+    posts = np.diagonal(co_posts, axis1=1, axis2=2)
+    values = {
+        "co_posts": co_posts[:, first, second],
+        "pmi": pmi[:, first, second],
+        "jaccard": jaccard[:, first, second],
+    }
+    with np.errstate(divide="ignore", invalid="ignore"):
+        changes = {
+            "pmi_change": np.vstack([np.full((1, len(first)), np.nan), np.diff(values["pmi"], axis=0)]),
+            "jaccard_change": np.vstack([np.zeros((1, len(first))), np.diff(values["jaccard"], axis=0)]),
+            "co_posts_pct": (values["co_posts"][1:] / values["co_posts"][:-1] - 1) * 100,
+        }
+    changes["co_posts_pct"] = np.vstack([np.zeros((1, len(first))), changes["co_posts_pct"]])
+    changes["co_posts_pct"] = np.nan_to_num(changes["co_posts_pct"], nan=0.0, posinf=100.0, neginf=100.0)
+
+    table = pd.DataFrame({
+        "date": np.repeat(res_rtsi.index, len(first)),
+        "country_a": np.tile(np.array(countries)[first], num),
+        "country_b": np.tile(np.array(countries)[second], num),
+        "co_posts": values["co_posts"].ravel(),
+        "posts_a": posts[:, first].ravel(),
+        "posts_b": posts[:, second].ravel(),
+        "num_posts": np.repeat(num_posts, len(first)),
+        "pmi": values["pmi"].ravel(),
+        "jaccard": values["jaccard"].ravel(),
+        "pmi_change": changes["pmi_change"].ravel(),
+        "jaccard_change": changes["jaccard_change"].ravel(),
+        "co_posts_pct": changes["co_posts_pct"].ravel(),
+    })
+    return table.set_index("date")
+
+
+def main(argv=None):
+    """
+    A method to calculate country co-mentions for a time slice.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Calculate country co-mentions per time slice.")
+    parser.add_argument("input", help="Final CSV file of merged posts")
+    parser.add_argument("rtsi", help="RTSI Excel file")
+    parser.add_argument("time_slice", type=int, help="Length of a time slice in days")
+    parser.add_argument("--dedup", metavar="CLUSTERS",
+                        help="Near-duplicate clusters CSV file to count each cluster once per outlet")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    time_slice = args.time_slice
+    if time_slice < 1:
+        sys.exit("Invalid time slice: " + str(time_slice) + ".\nPlease enter a valid time slice > 0.")
+
+    path = Path(metrics.RESULTS_DIR + str(time_slice) + "days/") / "comentions"
+    path.mkdir(parents=True, exist_ok=True)
+
+    with span("comentions", time_slice=time_slice):
+        with span("load") as load:
+            data_all = metrics.load_posts(args.input)
+            rtsi = metrics.load_rtsi(args.rtsi)
+            load.rows = len(data_all)
+        if args.dedup:
+            with span("dedup", rows=len(data_all)):
+                data_all = metrics.drop_near_duplicates(data_all, args.dedup)
+        calendar = metrics.SliceCalendar(rtsi, time_slice, args.alignment)
+        res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+
+        for name, corpus in metrics.split_subcorpora(data_all).items():
+            with span("comention_table", rows=len(corpus), subcorpus=name):
+                table = comention_table(corpus, calendar, res_rtsi)
+            table["status"] = metrics.SUBCORPORA[name][0]
+            table.to_csv(path / (name + "_comentions" + str(time_slice) + ".csv"), encoding="utf-8")
+
+    print("Results saved to " + str(path))
+    print("Time consumption co-mentions: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
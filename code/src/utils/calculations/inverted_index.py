@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to build and query an inverted index over preprocessed posts.
+
+In more detail, this module is used to track ad-hoc terms (e.g. "санкции") without editing
+COUNTRY_GROUPS and rerunning the pipeline, and to retrieve sample posts for qualitative analyses.
+
+The index is built once from the final CSV file of <merge_ner_and_posts.py> and stored in a directory:
+- terms.npy: the sorted vocabulary
+- term_offsets.npy: the start of the postings of each term
+- postings.npy, frequencies.npy: post numbers and term frequencies; posts are numbered by date,
+  so the postings of each term are sorted by date
+- days.npy, outlets.npy, num_words.npy: date, outlet and number of words of each post
+- posts.jsonl, post_offsets.npy: ID, date and text of each post for sample retrieval
+Tokens longer than MAX_TERM_LENGTH characters are not indexed.
+
+All arrays are memory-mapped when the index is opened, so that queries take milliseconds.
+A query is a comma-separated list of terms; terms ending with "*" match all terms with this prefix,
+e.g. "санкци*,эмбарго". Counts per time slice are returned in the same layout as the country metrics.
+
+Examples:
+python3 code/src/utils/calculations/inverted_index.py build --input code/data/media_posts_processed_final.csv
+python3 code/src/utils/calculations/inverted_index.py counts --query "санкци*" --rtsi code/data/rtsi_topics.xlsx --time-slice 7
+python3 code/src/utils/calculations/inverted_index.py sample --query "украин*" --start 2018-02-01 --end 2018-02-07 -n 10
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+INDEX_DIR = "code/data/inverted_index/"
+RESULTS_DIR = "code/data/metrics_percent_results/terms/"
+OUTLET_NAMES = list(metrics.OUTLETS)
+CHUNK_SIZE = 100000
+MAX_TERM_LENGTH = 64  # Longer tokens, e.g. remainders of URLs, are not indexed
+EPOCH = "1970-01-01"  # Days are stored as days since EPOCH
+
+
+def day_numbers(dates):
+    """A method to convert dates to the number of days since EPOCH."""
+    return (np.asarray(dates, dtype="datetime64[D]") - np.datetime64(EPOCH, "D")).astype(np.int32)
+
+
+def outlet_codes(ids):
+    """
+    A method to encode the outlet of posts as index into OUTLET_NAMES.
+    :param ids: A pandas Series of post IDs.
+    :return: A numpy array of type int8 with -1 for unknown outlets.
+    """
+    ids = ids.astype(str)
+    codes = np.full(len(ids), -1, dtype=np.int8)
+    for code, name in enumerate(OUTLET_NAMES):
+        codes[ids.str.startswith(metrics.OUTLETS[name]).to_numpy()] = code
+    return codes
+
+
+def build_index(fn_vk, index_dir=INDEX_DIR, column="text"):
+    """
+    A method to build the inverted index over a text column of the final CSV file.
+    :param fn_vk: Path to the CSV file created by <merge_ner_and_posts.py>.
+    :param index_dir: The output directory of the index.
+    :param column: The column of space-separated tokens to index, e.g. "text" or "lemmas".
+    :return: The number of indexed posts.
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    with span("load"):
+        posts = pd.read_csv(fn_vk, encoding="utf-8", sep=",", usecols=["ID", "date", column],
+                            dtype={column: str})
+        posts["date"] = pd.to_datetime(posts["date"])
+        posts = posts.sort_values("date", kind="stable").reset_index(drop=True)
+        posts[column] = posts[column].fillna("")
+
+    vocabulary = {}
+    term_ids, post_ids, frequencies = [], [], []
+    with span("tokenize", rows=len(posts)):
+        for start in range(0, len(posts), CHUNK_SIZE):
+            tokens = posts[column].iloc[start:start + CHUNK_SIZE].str.lower().str.split().explode().dropna()
+            tokens = tokens[tokens.str.len() <= MAX_TERM_LENGTH]
+            local_ids, local_terms = pd.factorize(tokens)
+            for term in local_terms:
+                vocabulary.setdefault(term, len(vocabulary))
+            global_ids = np.fromiter((vocabulary[term] for term in local_terms), dtype=np.int64,
+                                     count=len(local_terms))[local_ids]
+            # Count each term once per post
+            keys, counts = np.unique(global_ids * len(posts) + tokens.index.to_numpy(), return_counts=True)
+            term_ids.append((keys // len(posts)).astype(np.int32))
+            post_ids.append((keys % len(posts)).astype(np.int32))
+            frequencies.append(counts.astype(np.int32))
+
+    with span("invert", rows=len(vocabulary)):
+        terms = np.array(list(vocabulary), dtype=str)
+        order = np.argsort(terms)
+        rank = np.empty(len(terms), dtype=np.int32)
+        rank[order] = np.arange(len(terms), dtype=np.int32)
+        term_ids = rank[np.concatenate(term_ids)] if term_ids else np.zeros(0, dtype=np.int32)
+        post_ids = np.concatenate(post_ids) if post_ids else np.zeros(0, dtype=np.int32)
+        frequencies = np.concatenate(frequencies) if frequencies else np.zeros(0, dtype=np.int32)
+        # Chunks are appended in date order, so a stable sort keeps the postings of each term sorted by date
+        by_term = np.argsort(term_ids, kind="stable")
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(terms)))
+
+    with span("write", rows=len(posts)):
+        np.save(index_dir / "terms.npy", terms[order])
+        np.save(index_dir / "term_offsets.npy", term_offsets)
+        np.save(index_dir / "postings.npy", post_ids[by_term])
+        np.save(index_dir / "frequencies.npy", frequencies[by_term])
+        np.save(index_dir / "days.npy", day_numbers(posts["date"].to_numpy()))
+        np.save(index_dir / "outlets.npy", outlet_codes(posts["ID"]))
+        np.save(index_dir / "num_words.npy", posts[column].str.split().str.len().to_numpy(dtype=np.int32))
+        offsets = []
+        with open(index_dir / "posts.jsonl", "wb") as f:
+            for post_id, date, text in zip(posts["ID"], posts["date"], posts[column]):
+                offsets.append(f.tell())
+                f.write(json.dumps({"ID": str(post_id), "date": str(date), "text": text},
+                                   ensure_ascii=False).encode("utf-8") + b"\n")
+        np.save(index_dir / "post_offsets.npy", np.array(offsets, dtype=np.int64))
+        with open(index_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"input": str(fn_vk), "column": column, "posts": len(posts), "terms": len(terms)}, f)
+    return len(posts)
+
+
+class InvertedIndex:
+    """A memory-mapped inverted index built with build_index()."""
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = Path(index_dir)
+        self.terms = self.load("terms")
+        self.term_offsets = self.load("term_offsets")
+        self.postings = self.load("postings")
+        self.frequencies = self.load("frequencies")
+        self.days = self.load("days")
+        self.outlets = self.load("outlets")
+        self.num_words = self.load("num_words")
+        self.post_offsets = self.load("post_offsets")
+
+    def load(self, name):
+        """A method to memory-map an array of the index."""
+        return np.load(self.index_dir / (name + ".npy"), mmap_mode="r")
+
+    def term_range(self, term):
+        """
+        A method to find the range of vocabulary entries matching a term or prefix ("term*").
+        :param term: A term, optionally ending with "*".
+        :return: A tuple of the first and the last + 1 vocabulary entry.
+        """
+        term = term.strip().lower()
+        if term.endswith("*"):
+            prefix = term[:-1]
+            return (int(np.searchsorted(self.terms, prefix, side="left")),
+                    int(np.searchsorted(self.terms, prefix + "\U0010ffff", side="left")))
+        first = int(np.searchsorted(self.terms, term, side="left"))
+        last = first + int(first < len(self.terms) and self.terms[first] == term)
+        return first, last
+
+    def lookup(self, query):
+        """
+        A method to get the posts matching a query.
+        :param query: A comma-separated list of terms or prefixes.
+        :return: A tuple of a sorted numpy array of matching post numbers and
+        a numpy array with the number of occurrences of the query terms in each of these posts.
+        """
+        # Merge overlapping ranges, e.g. of "санкци*,санкции", so that each term is counted once
+        ranges = []
+        for first, last in sorted(self.term_range(term) for term in query.split(",")):
+            if first >= last:
+                continue
+            if ranges and first <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], last)
+            else:
+                ranges.append([first, last])
+        posts, frequencies = [], []
+        for first, last in ranges:
+            start, end = self.term_offsets[first], self.term_offsets[last]
+            posts.append(np.asarray(self.postings[start:end]))
+            frequencies.append(np.asarray(self.frequencies[start:end]))
+        if not posts:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        posts, inverse = np.unique(np.concatenate(posts), return_inverse=True)
+        occurrences = np.bincount(inverse, weights=np.concatenate(frequencies)).astype(np.int64)
+        return posts, occurrences
+
+    def daily_counts(self, queries, subcorpus):
+        """
+        A method to count posts and query occurrences per day for a subcorpus.
+        :param queries: A dictionary mapping labels to queries.
+        :param subcorpus: A subcorpus name of SUBCORPORA, e.g. "control".
+        :return: A pandas DataFrame in the layout of calculate_metrics_prct_change.daily_counts()
+        with the columns "num_posts", "num_words", "<label>_posts" and "<label>_mentions".
+        """
+        selected = np.isin(self.outlets, [OUTLET_NAMES.index(o) for o in metrics.SUBCORPORA[subcorpus][1]])
+        first_day = int(self.days[0]) if len(self.days) else 0
+        num_days = int(self.days[-1]) - first_day + 1 if len(self.days) else 0
+        days = np.asarray(self.days) - first_day
+        counts = {
+            "num_posts": np.bincount(days[selected], minlength=num_days),
+            "num_words": np.bincount(days[selected], weights=self.num_words[selected], minlength=num_days),
+        }
+        for label, query in queries.items():
+            posts, occurrences = self.lookup(query)
+            keep = selected[posts]
+            counts[label + "_posts"] = np.bincount(days[posts[keep]], minlength=num_days)
+            counts[label + "_mentions"] = np.bincount(days[posts[keep]], weights=occurrences[keep],
+                                                      minlength=num_days)
+        index = pd.DatetimeIndex(np.datetime64(EPOCH, "D") + first_day + np.arange(num_days), name="date")
+        daily = pd.DataFrame(counts, index=index).astype("float")
+        return daily[daily["num_posts"] > 0]
+
+    def sample(self, query, n=10, start=None, end=None, subcorpus=None, seed=42):
+        """
+        A method to retrieve a random sample of posts matching a query.
+        :param query: A comma-separated list of terms or prefixes.
+        :param n: The sample size.
+        :param start: Optional first day (YYYY-MM-DD) of the window.
+        :param end: Optional last day (YYYY-MM-DD) of the window.
+        :param subcorpus: Optional subcorpus name of SUBCORPORA.
+        :param seed: The random seed.
+        :return: A pandas DataFrame with the columns "ID", "date", "text" and "occurrences" ordered by date.
+        """
+        posts, occurrences = self.lookup(query)
+        # Posts are numbered by date, so the window is a contiguous range of the matching posts
+        post_days = np.asarray(self.days[posts])
+        first = 0 if start is None else np.searchsorted(post_days, day_numbers(start))
+        last = len(posts) if end is None else np.searchsorted(post_days, day_numbers(end), side="right")
+        posts, occurrences = posts[first:last], occurrences[first:last]
+        if subcorpus is not None:
+            keep = np.isin(self.outlets[posts], [OUTLET_NAMES.index(o) for o in metrics.SUBCORPORA[subcorpus][1]])
+            posts, occurrences = posts[keep], occurrences[keep]
+        rng = np.random.default_rng(seed)
+        chosen = np.sort(rng.choice(len(posts), min(n, len(posts)), replace=False))
+        rows = []
+        with open(self.index_dir / "posts.jsonl", "rb") as f:
+            for i in chosen:
+                f.seek(int(self.post_offsets[posts[i]]))
+                row = json.loads(f.readline())
+                row["occurrences"] = int(occurrences[i])
+                rows.append(row)
+        return pd.DataFrame(rows, columns=["ID", "date", "text", "occurrences"])
+
+
+def query_label(query):
+    """A method to derive a label usable in column and file names from a query."""
+    return query.replace("*", "").replace(",", "_").strip()
+
+
+def term_metrics(index, queries, fn_rtsi, time_slice, path, alignment="calendar"):
+    """
+    A method to calculate post and word level metrics for queries and save them in the layout of the country metrics.
+    :param index: An InvertedIndex.
+    :param queries: A list of queries.
+    :param fn_rtsi: Path to the RTSI Excel file.
+    :param time_slice: The length of a time slice in days.
+    :param path: The output directory.
+    :param alignment: The alignment policy of the time slices, "calendar" or "trading".
+    """
+    labels = {query_label(query): query for query in queries}
+    rtsi = metrics.load_rtsi(fn_rtsi)
+    calendar = metrics.SliceCalendar(rtsi, time_slice, alignment)
+    res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+    results = {}
+    for name in metrics.SUBCORPORA:
+        daily = index.daily_counts(labels, name)
+        counts = metrics.slice_counts(daily, calendar)
+        results[name] = metrics.slice_metrics(counts, res_rtsi, list(labels))
+    Path(path).mkdir(parents=True, exist_ok=True)
+    metrics.save_results(results, calendar, path, list(labels))
+
+
+def main(argv=None):
+    """
+    A method to build or query the inverted index from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Build and query an inverted index over preprocessed posts.")
+    parser.add_argument("command", choices=["build", "counts", "sample"], help="Action to perform")
+    parser.add_argument("--index", default=INDEX_DIR, help="Index directory")
+    parser.add_argument("--input", help="Final CSV file of merged posts (build)")
+    parser.add_argument("--column", default="text", help="Column of tokens to index (build)")
+    parser.add_argument("--query", nargs="+", default=[], help="Comma-separated terms, prefixes end with *")
+    parser.add_argument("--rtsi", help="RTSI Excel file (counts)")
+    parser.add_argument("--time-slice", type=int, default=7, help="Length of a time slice in days (counts)")
+    parser.add_argument("--start", help="First day YYYY-MM-DD of the window (sample)")
+    parser.add_argument("--end", help="Last day YYYY-MM-DD of the window (sample)")
+    parser.add_argument("--subcorpus", choices=list(metrics.SUBCORPORA), help="Subcorpus (sample)")
+    parser.add_argument("-n", type=int, default=10, help="Sample size (sample)")
+    parser.add_argument("--output", help="Output CSV file (sample)")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI (metrics)")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    if args.command == "build":
+        with span("build_index"):
+            num_posts = build_index(args.input, args.index, args.column)
+        print(str(num_posts) + " posts indexed in " + args.index)
+    elif args.command == "counts":
+        path = Path(RESULTS_DIR + str(args.time_slice) + "days/")
+        with span("term_metrics", rows=len(args.query)):
+            term_metrics(InvertedIndex(args.index), args.query, args.rtsi, args.time_slice, path, args.alignment)
+        print("Term metrics saved to " + str(path))
+    else:
+        with span("sample"):
+            sample = InvertedIndex(args.index).sample(",".join(args.query), args.n, args.start, args.end,
+                                                      args.subcorpus)
+        if args.output:
+            sample.to_csv(args.output, index=False)
+        else:
+            print(sample.to_string(index=False))
+
+    print("Time consumption inverted index: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to analyze which outlets lead the coverage of a country.
+
+In more detail, this module is used to study agenda-setting between outlets, e.g. whether TASS or RT coverage
+of a country leads Meduza or RBC coverage or the other way round. It complements the correlations of the
+subcorpora with the RTSI (<basic_corrs.R>) with correlations between outlets.
+
+For each country and outlet, the normalized post (or word) level coverage per day is computed from the daily
+counts per outlet stored by <calculate_metrics_prct_change.py>. The series are summed up into the time slices
+of the RTSI (calendar or trading days, see <slice_calendar.py>), optionally differenced, and standardized.
+For every pair of outlets and every country, the cross-correlation r(k) = 1/n * sum_t a[t] * b[t + k]
+(as computed by R's ccf()) is computed at all lags at once with a batched FFT. A positive lag k means that
+coverage of outlet a is followed by coverage of outlet b k time slices later. For each pair, the lag with
+the highest correlation within the lag range is reported, together with the approximate 95% significance
+bound 1.96 / sqrt(n).
+
+Example:
+python3 code/src/utils/calculations/lead_lag.py --rtsi code/data/rtsi_topics.xlsx --max-lag 14
+"""
+import argparse
+import sys
+import time
+from itertools import combinations
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+RESULTS_DIR = "code/data/metrics_percent_results/lead_lag/"
+# Daily counts are the same for all time slices, the counts of time slices of 7 days are used by default
+COUNTS_DIR = metrics.RESULTS_DIR + "7days/"
+MAX_LAG = 14
+# Counts of the covered and of all posts (or words) per measure
+MEASURES = {
+    "posts": ("_posts", "num_posts"),
+    "mentions": ("_mentions", "num_words"),
+}
+
+
+def coverage_series(daily, calendar, measure="posts", countries=None):
+    """
+    A method to compute the normalized coverage series of all outlets and countries.
+    :param daily: A dictionary mapping outlet names to pandas DataFrames of daily counts
+    as returned by metrics.daily_counts().
+    :param calendar: A SliceCalendar defining the time slices; counts are summed up per time slice.
+    :param measure: "posts" (share of posts covering a country) or "mentions" (share of country mentions among all words).
+    :param countries: Optional list of countries. Defaults to the countries in COUNTRY_GROUPS.
+    :return: A tuple of a pandas DatetimeIndex of the first days of the time slices and
+    a numpy array of shape (outlets, countries, time slices). Time slices without posts have a coverage of 0.
+    """
+    suffix, total = MEASURES[measure]
+    countries = countries or metrics.COUNTRIES
+    series = []
+    for counts in daily.values():
+        counts = metrics.slice_counts(counts, calendar)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coverage = counts[[country + suffix for country in countries]].to_numpy() / counts[[total]].to_numpy()
+        series.append(np.nan_to_num(coverage).T)
+    return calendar.edges, np.stack(series)
+
+
+def standardize(series, difference=False):
+    """
+    A method to standardize series along the last axis, optionally after differencing.
+    Constant series are set to 0.
+    :param series: A numpy array of series.
+    :param difference: Whether to use the differences of consecutive values.
+    :return: A numpy array of standardized series.
+    """
+    if difference:
+        series = np.diff(series, axis=-1)
+    centered = series - series.mean(axis=-1, keepdims=True)
+    std = series.std(axis=-1, keepdims=True)
+    return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+
+
+def cross_correlations(series, pairs, max_lag):
+    """
+    A method to compute the cross-correlations of pairs of standardized series with a batched FFT.
+    :param series: A numpy array of standardized series of shape (outlets, countries, n).
+    :param pairs: A list of (a, b) tuples of outlet indices.
+    :param max_lag: The maximum lag.
+    :return: A numpy array of shape (pairs, countries, 2 * max_lag + 1) with the cross-correlations
+    at the lags -max_lag, ..., max_lag.
+    """
+    n = series.shape[-1]
+    max_lag = min(max_lag, n - 1)
+    # Zero padding to at least 2n - 1 avoids circular overlap
+    size = 1 << int(np.ceil(np.log2(2 * n - 1)))
+    spectra = np.fft.rfft(series, size, axis=-1)
+    first = np.array([a for a, _ in pairs])
+    second = np.array([b for _, b in pairs])
+    circular = np.fft.irfft(np.conj(spectra[first]) * spectra[second], size, axis=-1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    return circular[..., lags % size] / n
+
+
+def lead_lag(series, outlets, countries, max_lag=MAX_LAG):
+    """
+    A method to find the lag of the highest cross-correlation for every pair of outlets and every country.
+    :param series: A numpy array of standardized series of shape (outlets, countries, n).
+    :param outlets: A list of outlet names.
+    :param countries: A list of countries.
+    :param max_lag: The maximum lag.
+    :return: A tuple of
+    - a pandas DataFrame with the columns "country", "outlet_a", "outlet_b", "peak_lag", "peak_correlation",
+      "lag0_correlation", "significant" and "leader" (the outlet leading at the peak lag, "" for lag 0)
+    - a pandas DataFrame with the cross-correlations at all lags
+    """
+    pairs = list(combinations(range(len(outlets)), 2))
+    correlations = cross_correlations(series, pairs, max_lag)
+    max_lag = correlations.shape[-1] // 2
+    lags = np.arange(-max_lag, max_lag + 1)
+    peak = lags[correlations.argmax(axis=-1)]
+    bound = 1.96 / np.sqrt(series.shape[-1])
+
+    a = np.repeat([outlets[i] for i, _ in pairs], len(countries))
+    b = np.repeat([outlets[j] for _, j in pairs], len(countries))
+    peak = peak.ravel()
+    strength = correlations.max(axis=-1).ravel()
+    summary = pd.DataFrame({
+        "country": np.tile(countries, len(pairs)),
+        "outlet_a": a,
+        "outlet_b": b,
+        "peak_lag": peak,
+        "peak_correlation": strength,
+        "lag0_correlation": correlations[..., max_lag].ravel(),
+        "significant": strength > bound,
+        "leader": np.where(peak > 0, a, np.where(peak < 0, b, "")),
+    })
+    curves = pd.DataFrame({
+        "country": np.repeat(summary["country"].to_numpy(), len(lags)),
+        "outlet_a": np.repeat(a, len(lags)),
+        "outlet_b": np.repeat(b, len(lags)),
+        "lag": np.tile(lags, len(summary)),
+        "correlation": correlations.ravel(),
+    })
+    return summary, curves
+
+
+def main(argv=None):
+    """
+    A method to run the lead-lag analysis from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Analyze which outlets lead the coverage of a country.")
+    parser.add_argument("--counts", default=COUNTS_DIR,
+                        help="Metrics output directory of a time slice containing the stored daily counts")
+    parser.add_argument("--input", help="Final CSV file of merged posts, used instead of the stored daily counts")
+    parser.add_argument("--rtsi", required=True, help="RTSI Excel file defining the time slices")
+    parser.add_argument("--measure", choices=list(MEASURES), default="posts", help="Coverage measure")
+    parser.add_argument("--time-slice", type=int, default=1, help="Length of a time slice in days")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI")
+    parser.add_argument("--max-lag", type=int, default=MAX_LAG, help="Maximum lag in time slices")
+    parser.add_argument("--difference", action="store_true",
+                        help="Correlate the changes between consecutive time slices to remove trends")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Output directory")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    if args.time_slice < 1:
+        sys.exit("Invalid time slice: " + str(args.time_slice) + ".\nPlease enter a valid time slice > 0.")
+
+    with span("load"):
+        outlets = list(metrics.OUTLETS)
+        if args.input:
+            data_all = metrics.load_posts(args.input)
+            names = metrics.post_outlets(data_all)
+            daily = {outlet: metrics.daily_counts(data_all[names == outlet]) for outlet in outlets}
+        else:
+            daily = {outlet: metrics.load_daily_counts(args.counts, outlet) for outlet in outlets}
+            if any(counts is None for counts in daily.values()):
+                sys.exit("No daily counts per outlet stored in " + args.counts
+                         + ". Run <calculate_metrics_prct_change.py> first or use --input.")
+        calendar = metrics.SliceCalendar(metrics.load_rtsi(args.rtsi), args.time_slice, args.alignment)
+        _, series = coverage_series(daily, calendar, args.measure)
+
+    with span("cross_correlation", rows=series.shape[0] * series.shape[1]):
+        summary, curves = lead_lag(standardize(series, args.difference), outlets, metrics.COUNTRIES, args.max_lag)
+
+    path = Path(args.output)
+    path.mkdir(parents=True, exist_ok=True)
+    name = args.measure + str(args.time_slice) + ("_diff" if args.difference else "")
+    summary.to_csv(path / ("lead_lag_" + name + ".csv"), index=False, encoding="utf-8")
+    curves.to_csv(path / ("cross_correlations_" + name + ".csv"), index=False, encoding="utf-8")
+    metrics.save_alignment(calendar, path)
+    significant = summary[summary["significant"] & (summary["peak_lag"] != 0)]
+    print(str(len(significant)) + " significant lead-lag relations:")
+    print(significant.to_string(index=False))
+    print("Results saved to " + str(path))
+    print("Time consumption lead-lag analysis: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
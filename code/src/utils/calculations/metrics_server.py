@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to serve the metrics of <calculate_metrics_prct_change.py> over a local HTTP interface.
+
+In more detail, the metrics output (code/data/metrics_percent_results/<N>days/) is loaded once and
+queries by country, subcorpus, time slice and date range are answered as JSON or CSV.
+Computed responses are kept in a bounded LRU cache. Before each request, the modification times
+of the metrics files are checked (at most every RELOAD_INTERVAL seconds); if files changed,
+the metrics are reloaded and the cache is cleared.
+
+Only the Python standard library and pandas are used.
+
+Endpoints (GET, all parameters except country are optional):
+- /: available time slices, countries and subcorpora
+- /series?country=ukraine&subcorpus=free&slice=7&start=2018-01-20&end=2018-03-01&format=csv:
+  the country table of the metrics output
+- /pct_change?country=ukraine&measure=post: percent change of post or word level coverage or of the RTSI (measure=rtsi)
+- /normalized?country=ukraine&measure=post&scale=zscore: normalized post or word level coverage,
+  optionally standardized (zscore) or scaled to [0, 1] (minmax)
+- /correlation?country=ukraine&measure=word&method=spearman&lag=1: correlation of normalized coverage
+  with the RTSI close value lagged by lag time slices, cf. <basic_corrs.R>
+
+Example:
+python3 code/src/utils/calculations/metrics_server.py --port 8000
+curl "http://127.0.0.1:8000/correlation?country=ukraine&subcorpus=free&slice=7&lag=1"
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from lazy_imports import lazy_import  # noqa: E402
+
+pd = lazy_import("pandas")
+
+RESULTS_DIR = "code/data/metrics_percent_results/"
+CACHE_SIZE = 1024  # Maximum number of cached responses
+RELOAD_INTERVAL = 2.0  # Minimum number of seconds between checks for changed files
+COUNTRY_FILE = re.compile(r"^(?P<country>.+)_(?P<subcorpus>control|free)(?P<slice>\d+)\.csv$")
+
+
+class MetricsStore:
+    """The metrics output of all time slices, reloaded when the files change."""
+
+    def __init__(self, results_dir=RESULTS_DIR):
+        self.results_dir = Path(results_dir)
+        self.lock = threading.Lock()
+        self.signature = None
+        self.checked = 0.0
+        self.generation = 0
+        self.countries = {}
+        self.words = {}
+
+    def files(self):
+        """A method to list the metrics files with their modification time and size."""
+        files = []
+        for path in sorted(self.results_dir.glob("*days/countries/*.csv")) + sorted(
+                self.results_dir.glob("*days/*_wrd_all*.csv")):
+            stat = path.stat()
+            files.append((str(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(files)
+
+    def refresh(self):
+        """
+        A method to reload the metrics if files were added, removed or changed.
+        :return: True if the metrics were reloaded.
+        """
+        with self.lock:
+            if self.signature is not None and time.time() - self.checked < RELOAD_INTERVAL:
+                return False
+            self.checked = time.time()
+            signature = self.files()
+            if signature == self.signature:
+                return False
+            countries, words = {}, {}
+            for fn, _, _ in signature:
+                path = Path(fn)
+                match = COUNTRY_FILE.match(path.name)
+                if path.parent.name == "countries" and match:
+                    key = (int(match["slice"]), match["country"], match["subcorpus"])
+                    countries[key] = pd.read_csv(path, encoding="utf-8", index_col=["date"], parse_dates=["date"])
+                elif "_wrd_all" in path.name:
+                    subcorpus, time_slice = path.stem.split("_wrd_all")
+                    words[(int(time_slice), subcorpus)] = pd.read_csv(path, encoding="utf-8", index_col=["date"],
+                                                                      parse_dates=["date"])
+            self.countries, self.words = countries, words
+            self.signature = signature
+            self.generation += 1
+            query.cache_clear()
+            return True
+
+    def available(self):
+        """A method to list the available time slices, countries and subcorpora."""
+        return {
+            "slices": sorted({key[0] for key in self.countries}),
+            "countries": sorted({key[1] for key in self.countries}),
+            "subcorpora": sorted({key[2] for key in self.countries}),
+            "generation": self.generation,
+        }
+
+    def table(self, time_slice, country, subcorpus):
+        """
+        A method to get the country table of a subcorpus with the normalized word level coverage.
+        :return: A pandas DataFrame indexed by date.
+        """
+        key = (time_slice, country, subcorpus)
+        if key not in self.countries:
+            raise KeyError("No metrics for country " + country + ", subcorpus " + subcorpus
+                           + " and time slice " + str(time_slice) + ".")
+        table = self.countries[key].copy()
+        words = self.words.get((time_slice, subcorpus))
+        if words is not None and country + "_wrds" in words:
+            table["abs_words"] = words[country + "_wrds"]
+        return table
+
+
+STORE = MetricsStore()
+
+
+def parse_date(value, name):
+    """
+    A method to parse the start or end parameter of a query.
+    :param value: The parameter value or None.
+    :param name: The parameter name used in the error message.
+    :return: A pandas Timestamp or None.
+    """
+    if value is None:
+        return None
+    try:
+        return pd.Timestamp(value)
+    except (TypeError, ValueError):
+        raise ValueError("Parameter " + name + " must be a date YYYY-MM-DD.")
+
+
+def select(table, start, end):
+    """A method to select the rows of a table in a date range."""
+    return table.loc[start:end] if start is not None or end is not None else table
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def query(generation, endpoint, time_slice, country, subcorpus, start, end, measure, scale, method, lag):
+    """
+    A method to compute a response. Responses are cached per generation of the metrics store.
+    :return: A pandas DataFrame or a dictionary.
+    """
+    table = STORE.table(time_slice, country, subcorpus)
+    column = {"post": "abs_posts", "word": "abs_words"}.get(measure)
+    if endpoint == "series":
+        return select(table, start, end)
+    if endpoint == "pct_change":
+        if measure not in ["post", "word", "rtsi"]:
+            raise ValueError("measure must be post, word or rtsi.")
+        return select(table[[measure if measure != "rtsi" else "rtsi_pct"]], start, end)
+    if column is None or column not in table:
+        raise ValueError("measure must be post or word.")
+    series = select(table[column], start, end)
+    if endpoint == "normalized":
+        if scale == "zscore":
+            series = (series - series.mean()) / series.std()
+        elif scale == "minmax":
+            series = (series - series.min()) / (series.max() - series.min())
+        elif scale != "none":
+            raise ValueError("scale must be none, zscore or minmax.")
+        return series.to_frame(measure)
+    if endpoint == "correlation":
+        if method not in ["pearson", "spearman", "kendall"]:
+            raise ValueError("method must be pearson, spearman or kendall.")
+        # As in <basic_corrs.R>, the RTSI close value is lagged and missing values are filled with 0
+        close = select(table["rtsi"], start, end).shift(lag).fillna(0)
+        return {
+            "country": country, "subcorpus": subcorpus, "slice": time_slice, "measure": measure,
+            "method": method, "lag": lag, "n": int(len(series)),
+            "correlation": float(series.corr(close, method=method)),
+        }
+    raise KeyError("Unknown endpoint " + endpoint + ".")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """A request handler answering metrics queries."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.strip("/")
+        try:
+            STORE.refresh()
+            if endpoint == "":
+                return self.send_json(STORE.available())
+            if "country" not in params:
+                raise ValueError("Parameter country is required.")
+            result = query(
+                STORE.generation, endpoint, int(params.get("slice", 7)), params["country"],
+                params.get("subcorpus", "control"), parse_date(params.get("start"), "start"),
+                parse_date(params.get("end"), "end"), params.get("measure", "post"), params.get("scale", "none"),
+                params.get("method", "spearman"), int(params.get("lag", 0)),
+            )
+            if isinstance(result, dict):
+                return self.send_json(result)
+            if params.get("format") == "csv":
+                return self.send(result.to_csv(date_format="%Y-%m-%d").encode("utf-8"),
+                                 "text/csv; charset=utf-8")
+            result = result.reset_index()
+            result["date"] = result["date"].dt.strftime("%Y-%m-%d")
+            return self.send(result.to_json(orient="records", force_ascii=False).encode("utf-8"),
+                             "application/json; charset=utf-8")
+        except KeyError as error:
+            return self.send_json({"error": str(error.args[0])}, 404)
+        except ValueError as error:
+            return self.send_json({"error": str(error)}, 400)
+        except Exception as error:
+            # Never leave a request unanswered
+            return self.send_json({"error": "Internal error: " + repr(error)}, 500)
+
+    def send_json(self, data, status=200):
+        """A method to send a dictionary as JSON response."""
+        self.send(json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8", status)
+
+    def send(self, body, content_type, status=200):
+        """A method to send a response."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if os.environ.get("METRICS_SERVER_LOG"):
+            super().log_message(format, *args)
+
+
+def main(argv=None):
+    """
+    A method to start the metrics server.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Serve metrics over a local HTTP interface.")
+    parser.add_argument("--results", default=RESULTS_DIR, help="Metrics output directory")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    args = parser.parse_args(argv)
+
+    STORE.results_dir = Path(args.results)
+    start_time = time.time()
+    STORE.refresh()
+    print("Metrics of " + str(len(STORE.countries)) + " country tables loaded in %s seconds."
+          % (time.time() - start_time))
+    server = ThreadingHTTPServer((args.host, args.port), MetricsHandler)
+    print("Serving metrics on http://" + args.host + ":" + str(args.port) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
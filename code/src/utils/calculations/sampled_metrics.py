@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to calculate approximate post and word level metrics from a stratified sample of posts.
+
+In more detail, this module is used for exploratory runs that do not need the full corpus:
+1. A reproducible sample is drawn from each stratum of outlet x day. Each stratum keeps
+   ceil(fraction * N) of its N posts, so that every outlet and day stays covered; each sampled post
+   is weighted with its inverse sampling probability.
+2. The weighted daily counts are summed up into time slices and the metrics are calculated as by
+   <calculate_metrics_prct_change.py>. The results are saved in the same layout, so that the
+   correlation analysis (<basic_corrs.R>) can be run on them.
+3. Confidence intervals of the normalized post and word level metrics are estimated from the variance
+   within the strata of the sample (linearized ratio estimator with finite population correction) as
+   Clopper-Pearson intervals with the effective sample size (Korn & Graubard, 1998), so that time slices
+   without sampled mentions of a country get an upper bound above zero as well. They are saved in separate
+   files "<subcorpus>_pst_ci<N>.csv" and "<subcorpus>_wrd_ci<N>.csv".
+4. With --compare, the estimates are compared with the full-corpus metrics of <calculate_metrics_prct_change.py>.
+
+With --save-sample, the sample is saved with a column "sample_weight". Later runs on the saved sample
+skip loading and sampling the full corpus; near-duplicates have to be dropped (--dedup) when the sample is drawn.
+
+Example:
+python3 code/src/utils/calculations/sampled_metrics.py code/data/media_posts_processed_final.csv code/data/rtsi_topics.xlsx 7 --fraction 0.05 --compare
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+stats = lazy_import("scipy.stats")
+
+RESULTS_DIR = "code/data/metrics_percent_results/sample/"
+FRACTION = 0.05  # Share of posts sampled per outlet and day
+LEVEL = 0.95  # Confidence level
+SEED = 42
+WEIGHT_COLUMN = "sample_weight"
+# Normalized metrics with the counts of covered and of all posts (or words), cf. slice_metrics()
+NORMALIZED = {
+    "pst": ("_psts", "_posts", "num_posts"),
+    "wrd": ("_wrds", "_mentions", "num_words"),
+}
+
+
+def strata_codes(corpus):
+    """
+    A method to number the strata (outlet x day) of posts.
+    :param corpus: A pandas DataFrame with a DatetimeIndex containing at least a column "ID".
+    :return: A numpy array with the stratum of each post.
+    """
+    strata = pd.DataFrame({"outlet": metrics.post_outlets(corpus), "day": corpus.index.normalize()})
+    return strata.groupby(["outlet", "day"]).ngroup().to_numpy()
+
+
+def stratified_sample(data_all, fraction=FRACTION, seed=SEED):
+    """
+    A method to draw a stratified sample of posts by outlet and day.
+    :param data_all: A pandas DataFrame with a DatetimeIndex containing at least a column "ID".
+    :param fraction: The share of posts sampled per stratum. At least one post is sampled per stratum.
+    :param seed: The random seed.
+    :return: The sampled rows of data_all with a column "sample_weight" (inverse sampling probability).
+    """
+    rng = np.random.default_rng(seed)
+    strata = pd.DataFrame({"stratum": strata_codes(data_all), "key": rng.random(len(data_all))})
+    groups = strata.groupby("stratum")
+    rank = groups["key"].rank(method="first").to_numpy()
+    size = groups["key"].transform("size").to_numpy()
+    sampled_size = np.ceil(fraction * size)
+    keep = rank <= sampled_size
+    sample = data_all[keep].copy()
+    sample[WEIGHT_COLUMN] = (size / sampled_size)[keep]
+    return sample
+
+
+def stratified_variances(values, weights, strata, slices, num):
+    """
+    A method to estimate the variance of weighted totals per time slice from a stratified sample.
+    Each stratum adds N^2 * (1 - n / N) * s^2 / n, where N is its number of posts, n its number of sampled posts
+    and s^2 the sample variance of the values. Strata with a single sampled post add no variance.
+    :param values: A numpy array of values per sampled post.
+    :param weights: A numpy array of inverse sampling probabilities per sampled post (N / n of its stratum).
+    :param strata: A numpy array of stratum codes per sampled post. Each stratum lies within one time slice.
+    :param slices: A numpy array of time slice indices per sampled post.
+    :param num: The number of time slices.
+    :return: A numpy array of variances per time slice.
+    """
+    strata = np.unique(strata, return_inverse=True)[1]
+    size = np.bincount(strata)
+    weight = np.bincount(strata, weights=weights) / size
+    stratum_slices = np.zeros(len(size), dtype=np.int64)
+    stratum_slices[strata] = slices
+    sums = np.bincount(strata, weights=values)
+    squares = np.bincount(strata, weights=values ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(size > 1, np.maximum(squares - sums ** 2 / size, 0) / (size - 1), 0)
+    return np.bincount(stratum_slices, weights=size * weight ** 2 * (1 - 1 / weight) * variance, minlength=num)
+
+
+def ratio_intervals(ratios, variances, sizes, level=LEVEL):
+    """
+    A method to calculate Clopper-Pearson intervals of shares with the effective sample size
+    n* = r * (1 - r) / variance, at most the number of sampled units (Korn & Graubard, 1998).
+    :param ratios: A numpy array of estimated shares.
+    :param variances: A numpy array of their variances.
+    :param sizes: A numpy array of the numbers of sampled units (posts or words).
+    :param level: The confidence level.
+    :return: A tuple of numpy arrays of the lower and upper bounds, NaN for undefined shares.
+    """
+    tail = (1 - level) / 2
+    ratios = np.clip(ratios, 0, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        effective = np.minimum(np.where(variances > 0, ratios * (1 - ratios) / variances, sizes), sizes)
+        hits = ratios * effective
+        low = np.where(hits > 0, stats.beta.ppf(tail, hits, effective - hits + 1), 0.0)
+        high = np.where(hits < effective, stats.beta.ppf(1 - tail, hits + 1, effective - hits), 1.0)
+    undefined = np.isnan(ratios) | (sizes == 0)
+    low[undefined], high[undefined] = np.nan, np.nan
+    return low, high
+
+
+def confidence_intervals(corpus, calendar, res_rtsi, level=LEVEL):
+    """
+    A method to estimate confidence intervals of the normalized post and word level metrics of a subcorpus.
+    :param corpus: A pandas DataFrame of sampled posts with a column "sample_weight".
+    :param calendar: A SliceCalendar defining the time slices.
+    :param res_rtsi: A pandas DataFrame of RTSI values per time slice as returned by metrics.rtsi_slices().
+    :param level: The confidence level.
+    :return: A dictionary mapping "pst" and "wrd" to pandas DataFrames indexed by date with the columns
+    "<country>_psts_low" and "<country>_psts_high" (or "_wrds_").
+    """
+    counts = metrics.post_counts(corpus)
+    # Only time slices with RTSI values are part of the results, cf. rtsi_slices()
+    num = len(res_rtsi)
+    slices = calendar.slice_ids(corpus.index.normalize())
+    selected = (slices >= 0) & (slices < num)
+    slices, strata = slices[selected], strata_codes(corpus)[selected]
+    weights = corpus[WEIGHT_COLUMN].to_numpy()[selected]
+    counts = counts[selected]
+
+    intervals = {}
+    for kind, (suffix, covered, total) in NORMALIZED.items():
+        units = counts[total].to_numpy()
+        sizes = np.bincount(slices, weights=units, minlength=num)
+        totals = np.bincount(slices, weights=units * weights, minlength=num)
+        bounds = {}
+        for country in metrics.COUNTRIES:
+            values = counts[country + covered].to_numpy()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratios = np.bincount(slices, weights=values * weights, minlength=num) / totals
+                # Linearization of the ratio estimator: variance of the total of values - ratio * units
+                residuals = values - np.nan_to_num(ratios)[slices] * units
+                variances = stratified_variances(residuals, weights, strata, slices, num) / totals ** 2
+            low, high = ratio_intervals(ratios, variances, sizes, level)
+            bounds[country + suffix + "_low"] = low
+            bounds[country + suffix + "_high"] = high
+        intervals[kind] = pd.DataFrame(bounds, index=res_rtsi.index)
+    return intervals
+
+
+def compare_with_full(estimates, intervals, time_slice, full_dir):
+    """
+    A method to compare sampled estimates with the full-corpus metrics.
+    :param estimates: A dictionary mapping subcorpus names to the tuples returned by metrics.slice_metrics().
+    :param intervals: A dictionary mapping subcorpus names to the dictionaries returned by bootstrap_intervals().
+    :param time_slice: The length of a time slice in days.
+    :param full_dir: The directory of the full-corpus metrics of the time slice.
+    :return: A pandas DataFrame with the mean and maximum absolute error, the mean interval width and
+    the share of time slices with an interval whose full-corpus value lies in it per subcorpus, country and metric.
+    """
+    rows = []
+    for name, (_, cov_psts, cov_wrds) in estimates.items():
+        for kind, estimate in [("pst", cov_psts), ("wrd", cov_wrds)]:
+            fn = Path(full_dir) / (name + "_" + kind + "_all" + str(time_slice) + ".csv")
+            full = pd.read_csv(fn, encoding="utf-8", index_col=["date"], parse_dates=["date"])
+            suffix = NORMALIZED[kind][0]
+            for country in metrics.COUNTRIES:
+                column = country + suffix
+                exact = full[column].reindex(estimate.index)
+                low = intervals[name][kind][column + "_low"]
+                high = intervals[name][kind][column + "_high"]
+                error = (estimate[column] - exact).abs()
+                # Time slices without sampled posts (or words) have no interval and are not part of the coverage
+                defined = low.notna() & high.notna()
+                rows.append({
+                    "subcorpus": name, "country": country, "metric": kind,
+                    "mean_abs_error": error.mean(), "max_abs_error": error.max(),
+                    "mean_ci_width": (high - low).mean(),
+                    "ci_coverage": ((exact >= low - 1e-12) & (exact <= high + 1e-12))[defined].mean(),
+                })
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    """
+    A method to calculate sampled metrics with confidence intervals for a time slice.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Calculate approximate metrics from a stratified sample.")
+    parser.add_argument("input", help="Final CSV file of merged posts or a sample saved with --save-sample")
+    parser.add_argument("rtsi", help="RTSI Excel file")
+    parser.add_argument("time_slice", type=int, help="Length of a time slice in days")
+    parser.add_argument("--fraction", type=float, default=FRACTION, help="Share of posts sampled per outlet and day")
+    parser.add_argument("--level", type=float, default=LEVEL, help="Confidence level")
+    parser.add_argument("--seed", type=int, default=SEED, help="Random seed")
+    parser.add_argument("--dedup", metavar="CLUSTERS",
+                        help="Near-duplicate clusters CSV file to count each cluster once per outlet")
+    parser.add_argument("--save-sample", help="Output CSV file for the sample")
+    parser.add_argument("--compare", action="store_true",
+                        help="Compare the estimates with the full-corpus metrics of the time slice")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    time_slice = args.time_slice
+    if time_slice < 1:
+        sys.exit("Invalid time slice: " + str(time_slice) + ".\nPlease enter a valid time slice > 0.")
+
+    path = Path(RESULTS_DIR + str(time_slice) + "days/")
+    path.mkdir(parents=True, exist_ok=True)
+
+    with span("sampled_metrics", time_slice=time_slice):
+        with span("load") as load:
+            data_all = metrics.load_posts(args.input)
+            rtsi = metrics.load_rtsi(args.rtsi)
+            load.rows = len(data_all)
+        if WEIGHT_COLUMN in data_all:
+            if args.dedup:
+                sys.exit("Near-duplicates cannot be dropped from a saved sample, as the sample weights refer to "
+                         "all posts.\nPlease draw the sample with --dedup from the final CSV file.")
+            sample = data_all
+            print("Using the saved sample of " + str(len(sample)) + " posts.")
+        else:
+            if args.dedup:
+                with span("dedup", rows=len(data_all)):
+                    data_all = metrics.drop_near_duplicates(data_all, args.dedup)
+            with span("sample", rows=len(data_all)):
+                sample = stratified_sample(data_all, args.fraction, args.seed)
+            print("Sampled " + str(len(sample)) + " of " + str(len(data_all)) + " posts.")
+            if args.save_sample:
+                saved = sample.copy()
+                saved.index = saved.index.astype("int64") // 10 ** 9
+                saved.to_csv(args.save_sample, encoding="utf-8")
+        calendar = metrics.SliceCalendar(rtsi, time_slice, args.alignment)
+        res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+
+        estimates, intervals = {}, {}
+        for name, corpus in metrics.split_subcorpora(sample).items():
+            with span("slice_metrics", rows=len(corpus), subcorpus=name):
+                daily = metrics.daily_counts(corpus, corpus[WEIGHT_COLUMN])
+                counts = metrics.slice_counts(daily, calendar)
+                estimates[name] = metrics.slice_metrics(counts, res_rtsi)
+            with span("intervals", rows=len(corpus), subcorpus=name):
+                intervals[name] = confidence_intervals(corpus, calendar, res_rtsi, args.level)
+
+        with span("write"):
+            metrics.save_results(estimates, calendar, path)
+            for name, bounds in intervals.items():
+                for kind, frame in bounds.items():
+                    frame.to_csv(path / (name + "_" + kind + "_ci" + str(time_slice) + ".csv"), encoding="utf-8")
+
+        if args.compare:
+            full_dir = metrics.RESULTS_DIR + str(time_slice) + "days/"
+            errors = compare_with_full(estimates, intervals, time_slice, full_dir)
+            errors.to_csv(path / ("sample_errors" + str(time_slice) + ".csv"), index=False, encoding="utf-8")
+            print(errors.groupby(["subcorpus", "metric"])[
+                      ["mean_abs_error", "max_abs_error", "mean_ci_width", "ci_coverage"]].mean().to_string())
+
+    print("Results saved to " + str(path))
+    print("Time consumption sampled metrics: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to align posts and RTSI values to the same time slices.
+
+In more detail, the edges (first days) of the time slices are computed once from the RTSI values
+and both the days of posts and the RTSI rows are mapped to time slices with a binary search
+(numpy.searchsorted), so that the media and the market windows of a time slice always cover the same days.
+Two alignment policies are supported:
+- calendar: a time slice spans time_slice calendar days, starting at the first day of the RTSI values
+- trading: a time slice spans time_slice trading days (days with an RTSI close value); posts published
+  on weekends or holidays belong to the time slice of the preceding trading day
+Days before the first edge get the index -1, days after the last time slice the number of time slices.
+The last time slice ends after time_slice calendar days (calendar) or on the last RTSI day (trading).
+The policy is stored next to the results in "alignment<N>.json".
+"""
+import json
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+ALIGNMENTS = ["calendar", "trading"]
+
+
+class SliceCalendar:
+    """The time slices of a time slice length and alignment policy."""
+
+    def __init__(self, rtsi, time_slice, alignment="calendar"):
+        """
+        :param rtsi: A pandas DataFrame with a DatetimeIndex of days and a column "close".
+        :param time_slice: The length of a time slice in (calendar or trading) days.
+        :param alignment: The alignment policy, "calendar" or "trading".
+        """
+        if alignment not in ALIGNMENTS:
+            raise ValueError("Unknown alignment: " + str(alignment) + ". Use one of " + ", ".join(ALIGNMENTS) + ".")
+        self.time_slice = time_slice
+        self.alignment = alignment
+        days = pd.DatetimeIndex(rtsi.index).normalize()
+        if alignment == "trading":
+            trading = days[rtsi["close"].notna().to_numpy()].unique().sort_values()
+            self.edges = trading[::time_slice]
+            self.end = days.max() + pd.Timedelta(days=1)
+        else:
+            num = -(-((days.max() - days.min()).days + 1) // time_slice)
+            self.edges = days.min() + pd.to_timedelta(np.arange(num) * time_slice, unit="D")
+            # The last time slice spans time_slice calendar days as well
+            self.end = days.min() + pd.Timedelta(days=num * time_slice)
+        self.edges = pd.DatetimeIndex(self.edges, name="date")
+
+    def __len__(self):
+        return len(self.edges)
+
+    def slice_ids(self, dates):
+        """
+        A method to map days to the index of the time slice they belong to.
+        :param dates: A pandas DatetimeIndex (or array) of days.
+        :return: A numpy array of time slice indices.
+        """
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        ids = np.searchsorted(self.edges.to_numpy(), dates, side="right") - 1
+        ids[dates >= self.end.to_datetime64()] = len(self)
+        return ids
+
+    def last_days(self):
+        """A method to get the last calendar day of each time slice as a pandas DatetimeIndex."""
+        ends = self.edges[1:].append(pd.DatetimeIndex([self.end]))
+        return ends - pd.Timedelta(days=1)
+
+    def policy(self):
+        """A method to describe the alignment policy as a dictionary."""
+        return {
+            "alignment": self.alignment,
+            "time_slice": self.time_slice,
+            "first_day": str(self.edges[0].date()) if len(self) else None,
+            "last_day": str((self.end - pd.Timedelta(days=1)).date()),
+            "slices": len(self),
+        }
+
+
+def alignment_file(path, time_slice):
+    """A method to get the file name of the stored alignment policy of a time slice."""
+    return Path(path) / ("alignment" + str(time_slice) + ".json")
+
+
+def save_alignment(calendar, path):
+    """
+    A method to store the alignment policy and the first day of each time slice next to the results.
+    :param calendar: A SliceCalendar.
+    :param path: The output directory.
+    """
+    with open(alignment_file(path, calendar.time_slice), "w", encoding="utf-8") as f:
+        json.dump(dict(calendar.policy(), first_days=[str(day.date()) for day in calendar.edges]), f, indent=4)
+
+
+def load_alignment(path, time_slice):
+    """
+    A method to load a stored alignment policy.
+    :param path: The output directory.
+    :param time_slice: The length of a time slice.
+    :return: A dictionary as written by save_alignment() or None if no policy is stored.
+    """
+    fn = alignment_file(path, time_slice)
+    if not fn.exists():
+        return None
+    with open(fn, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to calculate post and word level metrics for every level of hierarchical entity taxonomies.
+
+In more detail, this module generalizes the country groups of <merge_labels.py> to any NER entity type of
+<ner.py> (e.g. persons or organizations) and to multi-level hierarchies (e.g. city -> country -> country group
+-> region). The taxonomies are declared in <taxonomies.py> or in a JSON file with the same structure (--config).
+
+Each taxonomy is compiled once into integer code tables:
+- the names of the finest level with the code of their node, in matching order,
+- for each level, the code of the ancestor of each node of the finest level.
+The distinct entities of the NER results are matched against the names once, which yields a sparse
+post x node matrix of mentions on the finest level of all taxonomies. A single sparse product with the
+block-diagonal roll-up matrix (finest nodes x nodes of all levels) yields the mentions of all levels,
+and a second product with the (subcorpus, day) x post indicator matrix yields the daily counts of all
+levels at once. The metrics are then calculated as by <calculate_metrics_prct_change.py> and saved in the
+layout of the country metrics in <RESULTS_DIR>/<taxonomy>/<level>/<N>days/, together with the daily counts.
+
+With the default taxonomies, the level "country_group" of the taxonomy "countries" yields the same
+values as the country metrics.
+
+Example:
+python3 code/src/utils/calculations/taxonomy_metrics.py code/data/media_posts_processed_final.csv code/data/media_posts_ner.json code/data/rtsi_topics.xlsx --time-slices 7 5 3 1
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from taxonomies import TAXONOMIES  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+
+RESULTS_DIR = "code/data/metrics_percent_results/taxonomy/"
+
+
+class Taxonomy:
+    """A taxonomy of <taxonomies.py> compiled into integer code tables."""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.entity_types = list(spec["entity_types"])
+        self.levels = list(spec["levels"])
+        parents = list(spec.get("parents", []))
+        if len(parents) != len(self.levels) - 1:
+            raise ValueError("Taxonomy " + name + ": one parent mapping is needed per level except the finest one.")
+        nodes = list(spec["names"])
+        # Names in matching order with the code of their node on the finest level
+        self.names = [entity.lower() for node in nodes for entity in sorted(spec["names"][node])]
+        self.name_nodes = np.array([code for code, node in enumerate(nodes) for _ in spec["names"][node]],
+                                   dtype=np.int32)
+        # Labels per level and the code of the ancestor of each node of the finest level per level
+        self.labels = [nodes]
+        self.ancestors = [np.arange(len(nodes), dtype=np.int32)]
+        for level, mapping in zip(self.levels[1:], parents):
+            missing = [node for node in self.labels[-1] if node not in mapping]
+            if missing:
+                raise ValueError("Taxonomy " + name + ": no " + level + " for " + ", ".join(missing) + ".")
+            codes, labels = pd.factorize(np.array([mapping[node] for node in self.labels[-1]], dtype=object))
+            self.labels.append(list(labels))
+            self.ancestors.append(codes[self.ancestors[-1]].astype(np.int32))
+
+    @property
+    def num_nodes(self):
+        """The number of nodes of all levels."""
+        return sum(len(labels) for labels in self.labels)
+
+    def rollup(self):
+        """
+        A method to build the roll-up matrix of the taxonomy.
+        :return: A scipy CSR matrix of shape (nodes of the finest level, nodes of all levels) with a 1 for each
+        node and its ancestor on each level. The columns of the levels follow each other from the finest level on.
+        """
+        offsets = np.cumsum([0] + [len(labels) for labels in self.labels[:-1]])
+        num_leaves = len(self.labels[0])
+        rows = np.tile(np.arange(num_leaves), len(self.levels))
+        columns = np.concatenate([codes + offset for codes, offset in zip(self.ancestors, offsets)])
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(num_leaves, self.num_nodes))
+
+    def match(self, entities):
+        """
+        A method to map entities to the nodes of the finest level.
+        :param entities: A list of lowercased entities, each matched once.
+        :return: A numpy array with the node code of each entity (-1 if no name matches).
+        """
+        entities = pd.Series(entities, dtype=object)
+        codes = np.full(len(entities), -1, dtype=np.int32)
+        for name, node in zip(self.names, self.name_nodes):
+            codes[entities.str.contains(name, regex=True, flags=re.IGNORECASE, na=False).to_numpy()] = node
+        return codes
+
+
+def load_taxonomies(fn_config=None):
+    """
+    A method to compile the taxonomies.
+    :param fn_config: Optional path to a JSON file of taxonomies. Defaults to TAXONOMIES of <taxonomies.py>.
+    :return: A list of Taxonomy objects.
+    """
+    specs = TAXONOMIES
+    if fn_config:
+        with open(fn_config, encoding="utf-8") as f:
+            specs = json.load(f)
+    return [Taxonomy(name, spec) for name, spec in specs.items()]
+
+
+def load_entities(fn_ner, entity_types):
+    """
+    A method to load the entities of the given types from NER results.
+    :param fn_ner: Path to the JSON file created by <ner.py>.
+    :param entity_types: A list of entity types, e.g. ["GPE_COUNTRY", "PERSON"].
+    :return: A pandas DataFrame with one row per entity and the columns "ID" (integer post ID as in
+    the final CSV file), "type" and "entity" (lowercased).
+    """
+    with open(fn_ner, encoding="utf-8") as f:
+        ner = json.load(f)
+    ids, types, entities = [], [], []
+    for post_id, results in ner.items():
+        for entity_type in entity_types:
+            for entity in results.get(entity_type) or []:
+                ids.append(post_id)
+                types.append(entity_type)
+                entities.append(entity)
+    return pd.DataFrame({
+        "ID": pd.Series(ids, dtype=str).str.replace("_", "", regex=False).astype("int64"),
+        "type": types,
+        "entity": pd.Series(entities, dtype=object).str.lower(),
+    })
+
+
+def mention_matrix(post_ids, entities, taxonomies):
+    """
+    A method to build the sparse matrix of mentions of the nodes of the finest level of all taxonomies.
+    :param post_ids: A pandas Series of the integer IDs of the posts.
+    :param entities: A pandas DataFrame as returned by load_entities().
+    :param taxonomies: A list of Taxonomy objects.
+    :return: A scipy CSR matrix of shape (posts, nodes of the finest levels) with the number of mentions.
+    """
+    rows = pd.Index(post_ids.to_numpy()).get_indexer(entities["ID"].to_numpy())
+    num_columns = sum(len(taxonomy.labels[0]) for taxonomy in taxonomies)
+    matrix = sparse.csr_matrix((len(post_ids), num_columns))
+    offset = 0
+    for taxonomy in taxonomies:
+        selected = entities["type"].isin(taxonomy.entity_types).to_numpy() & (rows >= 0)
+        # Each distinct entity is matched once
+        codes, distinct = pd.factorize(entities["entity"].to_numpy()[selected])
+        nodes = taxonomy.match(distinct)[codes] if len(distinct) else np.zeros(0, dtype=np.int32)
+        matched = nodes >= 0
+        matrix = matrix + sparse.csr_matrix(
+            (np.ones(matched.sum()), (rows[selected][matched], nodes[matched] + offset)),
+            shape=matrix.shape,
+        )
+        offset += len(taxonomy.labels[0])
+    return matrix
+
+
+def taxonomy_daily_counts(data_all, entities, taxonomies, words=None):
+    """
+    A method to count posts, words and the coverage of all nodes of all taxonomies per day and subcorpus.
+    :param data_all: A pandas DataFrame of posts as returned by metrics.load_posts().
+    :param entities: A pandas DataFrame as returned by load_entities().
+    :param taxonomies: A list of Taxonomy objects.
+    :param words: Optional column with the number of words per post, see metrics.daily_counts().
+    :return: A dictionary mapping (taxonomy, level) tuples to dictionaries mapping subcorpus names to
+    pandas DataFrames in the layout of metrics.daily_counts() with the node labels in place of the countries.
+    """
+    with span("mentions", rows=len(entities)):
+        mentions = mention_matrix(data_all["ID"], entities, taxonomies)
+    with span("rollup", rows=mentions.shape[0]):
+        nodes = (mentions @ sparse.block_diag([taxonomy.rollup() for taxonomy in taxonomies], format="csr")).tocsr()
+        covered = nodes.copy()
+        covered.data = (covered.data > 0).astype(np.float64)
+
+    # Indicator matrix of (subcorpus, day) groups x posts
+    has_id = data_all["ID"].notna().to_numpy()
+    outlets = metrics.post_outlets(data_all)
+    subcorpora = np.full(len(data_all), -1)
+    for code, (_, names) in enumerate(metrics.SUBCORPORA.values()):
+        subcorpora[np.isin(outlets, names)] = code
+    days, dates = pd.factorize(data_all.index.normalize(), sort=True)
+    selected = np.flatnonzero((subcorpora >= 0) & has_id)
+    groups = sparse.csr_matrix(
+        (np.ones(len(selected)), (subcorpora[selected] * len(dates) + days[selected], selected)),
+        shape=(len(metrics.SUBCORPORA) * len(dates), len(data_all)),
+    )
+    num_words = data_all["text"].str.split().str.len() if words is None else data_all[words]
+    with span("aggregate", rows=len(selected)):
+        totals = groups @ np.column_stack([has_id.astype(np.float64), num_words.fillna(0).to_numpy(np.float64)])
+        posts = (groups @ covered).toarray()
+        mentions = (groups @ nodes).toarray()
+
+    daily = {}
+    offset = 0
+    for taxonomy in taxonomies:
+        for level, labels in zip(taxonomy.levels, taxonomy.labels):
+            columns = slice(offset, offset + len(labels))
+            daily[(taxonomy.name, level)] = {}
+            for code, name in enumerate(metrics.SUBCORPORA):
+                rows = slice(code * len(dates), (code + 1) * len(dates))
+                counts = {"num_posts": totals[rows, 0], "num_words": totals[rows, 1]}
+                for i, label in enumerate(labels):
+                    counts[label + "_posts"] = posts[rows, columns][:, i]
+                    counts[label + "_mentions"] = mentions[rows, columns][:, i]
+                frame = pd.DataFrame(counts, index=pd.DatetimeIndex(dates, name="date"))
+                # Only days with posts, as in metrics.daily_counts()
+                daily[(taxonomy.name, level)][name] = frame[frame["num_posts"] > 0]
+            offset += len(labels)
+    return daily
+
+
+def main(argv=None):
+    """
+    A method to calculate the taxonomy metrics for time slices.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Calculate metrics for every level of entity taxonomies.")
+    parser.add_argument("input", help="Final CSV file of merged posts")
+    parser.add_argument("ner", help="NER results JSON file of <ner.py>")
+    parser.add_argument("rtsi", help="RTSI Excel file")
+    parser.add_argument("--time-slices", type=int, nargs="+", default=[7], help="Lengths of time slices in days")
+    parser.add_argument("--config", help="JSON file of taxonomies. Defaults to the taxonomies of <taxonomies.py>")
+    parser.add_argument("--dedup", metavar="CLUSTERS",
+                        help="Near-duplicate clusters CSV file to count each cluster once per outlet")
+    parser.add_argument("--words", metavar="COLUMN",
+                        help="Column with the number of words per post, e.g. num_lemmas of <lemmatize.py>")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Output directory")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    if min(args.time_slices) < 1:
+        sys.exit("Invalid time slice: " + str(min(args.time_slices)) + ".\nPlease enter a valid time slice > 0.")
+
+    with span("taxonomy_metrics"):
+        with span("compile"):
+            taxonomies = load_taxonomies(args.config)
+        with span("load") as load:
+            data_all = metrics.load_posts(args.input)
+            entities = load_entities(args.ner, sorted({t for taxonomy in taxonomies for t in taxonomy.entity_types}))
+            rtsi = metrics.load_rtsi(args.rtsi)
+            load.rows = len(data_all)
+        if args.dedup:
+            with span("dedup", rows=len(data_all)):
+                data_all = metrics.drop_near_duplicates(data_all, args.dedup)
+        daily = taxonomy_daily_counts(data_all, entities, taxonomies, args.words)
+        calendars = {time_slice: metrics.SliceCalendar(rtsi, time_slice, args.alignment)
+                     for time_slice in args.time_slices}
+        res_rtsi = {time_slice: metrics.rtsi_slices(rtsi, calendar) for time_slice, calendar in calendars.items()}
+
+        labels = {(taxonomy.name, level): nodes for taxonomy in taxonomies
+                  for level, nodes in zip(taxonomy.levels, taxonomy.labels)}
+        for (name, level), counts in daily.items():
+            path = Path(args.output) / name / level
+            for subcorpus, frame in counts.items():
+                metrics.save_daily_counts(frame, path, subcorpus)
+            for time_slice in args.time_slices:
+                with span("slice_metrics", taxonomy=name, level=level, time_slice=time_slice):
+                    calendar = calendars[time_slice]
+                    results = {subcorpus: metrics.slice_metrics(metrics.slice_counts(frame, calendar),
+                                                                res_rtsi[time_slice], labels[(name, level)])
+                               for subcorpus, frame in counts.items()}
+                    path_slice = path / (str(time_slice) + "days")
+                    path_slice.mkdir(parents=True, exist_ok=True)
+                    metrics.save_results(results, calendar, path_slice, labels[(name, level)])
+            print("Metrics of " + str(len(labels[(name, level)])) + " nodes saved to " + str(path))
+
+    print("Time consumption taxonomy metrics: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
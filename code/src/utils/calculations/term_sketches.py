@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to collect streaming term statistics per time slice and subcorpus.
+
+In more detail, this module is used to query term frequencies, emerging terms and word totals of the
+time slices without keeping the vocabulary of each time slice and without splitting all stored texts again.
+The preprocessed posts of <preprocess_text.py> are read in chunks and, for each time slice and subcorpus,
+the following state is updated:
+- a Count-Min sketch (Cormode & Muthukrishnan, 2005) of width ceil(e / EPSILON) and depth ceil(ln(1 / DELTA)):
+  the estimated count of a term is never below its exact count and, with probability 1 - DELTA,
+  at most EPSILON * (number of words of the time slice) above it
+- the TOP_K terms with the highest estimated counts (heavy hitters)
+- the exact number of posts and words
+The memory of a time slice does not depend on the number of posts or distinct terms. Terms are hashed with
+a keyed BLAKE2 digest, so the states of different runs, deliveries or shards with the same parameters can be
+merged by adding their counters. The states are stored as NumPy archive (.npz) in STATE_DIR.
+
+A state records a fingerprint (number of rows, size and SHA-256 digest) of each input file it has ingested.
+If an input file is updated again, e.g. a cumulative file that new deliveries are appended to, only the rows
+after the ingested rows are added. A file that was changed otherwise since it was added, or a file starting with
+the content of another added file (e.g. a copy of a cumulative file), is refused; the state has to be rebuilt.
+
+Time slices are the time slices of <calculate_metrics_prct_change.py> (see <slice_calendar.py>);
+posts outside the days of the RTSI values are skipped. Emerging terms are the terms of a time slice
+occurring most often above their expected count given their share of the words of the previous time slice.
+With the command check, the estimates of a state built from the input posts (or of a stored state with --state)
+are compared with the exact counts of the input posts, and the state is compared with the merged states of two
+halves of the posts after storing and loading all states.
+
+Examples:
+python3 code/src/utils/calculations/term_sketches.py update --input code/data/media_posts_processed.csv --rtsi code/data/rtsi_topics.xlsx --time-slice 7
+python3 code/src/utils/calculations/term_sketches.py counts --query санкции нефть --time-slice 7
+python3 code/src/utils/calculations/term_sketches.py emerging -n 20 --time-slice 7
+python3 code/src/utils/calculations/term_sketches.py check --input code/data/media_posts_processed.csv --rtsi code/data/rtsi_topics.xlsx --epsilon 0.001 --delta 0.01
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+STATE_DIR = "code/data/term_sketches/"
+RESULTS_DIR = "code/data/metrics_percent_results/term_sketches/"
+CHUNK_SIZE = 100000
+EPSILON = 0.001  # Relative error of the estimated counts
+DELTA = 0.01  # Probability of exceeding the error
+TOP_K = 100  # Number of heavy hitters kept per time slice and subcorpus
+SEED = 42
+# Parameters of the time slices that must agree to merge states
+POLICY_KEYS = ["alignment", "time_slice", "first_day"]
+
+
+def read_posts(fn, column="text", skip=0):
+    """
+    A method to read preprocessed posts in chunks.
+    :param fn: Path to the CSV file created by <preprocess_text.py> (or <merge_ner_and_posts.py>).
+    :param column: The column of space-separated tokens, e.g. "text" or "lemmas".
+    :param skip: The number of rows to skip, e.g. rows already added to a state.
+    :return: A generator of pandas DataFrames with the columns "ID", "date" and the token column.
+    Posts without ID are kept, but belong to no subcorpus.
+    """
+    for chunk in pd.read_csv(fn, encoding="utf-8", sep=",", usecols=["ID", "date", column],
+                             dtype={"ID": str, column: str}, chunksize=CHUNK_SIZE):
+        if skip >= len(chunk):
+            skip -= len(chunk)
+            continue
+        chunk = chunk.iloc[skip:].reset_index(drop=True)
+        skip = 0
+        chunk["date"] = pd.to_datetime(chunk["date"])
+        chunk[column] = chunk[column].fillna("")
+        yield chunk
+
+
+def term_columns(terms, width, depth, seed=SEED):
+    """
+    A method to hash terms to one counter in each row of a Count-Min sketch.
+    The row hashes are derived from one keyed 128 bit BLAKE2 digest per term by double hashing (h1 + i * h2),
+    so that they do not depend on the process (unlike hash()).
+    :param terms: A sequence of terms.
+    :param width: The number of counters per row.
+    :param depth: The number of rows.
+    :param seed: The key of the hash function.
+    :return: A numpy array of shape (terms, depth) with the counter of each term in each row.
+    """
+    key = seed.to_bytes(8, "little")
+    digests = b"".join(hashlib.blake2b(term.encode("utf-8"), digest_size=16, key=key).digest() for term in terms)
+    hashes = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+    with np.errstate(over="ignore"):
+        columns = hashes[:, :1] + np.arange(depth, dtype=np.uint64) * (hashes[:, 1:] | np.uint64(1))
+    return (columns % np.uint64(width)).astype(np.int64)
+
+
+class CountMinSketch:
+    """A Count-Min sketch of term counts."""
+
+    def __init__(self, width, depth, seed=SEED):
+        """
+        :param width: The number of counters per row.
+        :param depth: The number of rows.
+        :param seed: The key of the hash function.
+        """
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.counts = np.zeros((depth, width), dtype=np.int64)
+
+    @classmethod
+    def dimensions(cls, epsilon=EPSILON, delta=DELTA):
+        """A method to get the width and depth of a sketch with the given error bounds."""
+        return int(np.ceil(np.e / epsilon)), int(np.ceil(np.log(1 / delta)))
+
+    @property
+    def total(self):
+        """The number of counted words."""
+        return int(self.counts[0].sum())
+
+    @property
+    def epsilon(self):
+        """The relative error of the estimated counts."""
+        return np.e / self.width
+
+    def add(self, columns, counts):
+        """
+        A method to add term counts.
+        :param columns: A numpy array of counters as returned by term_columns().
+        :param counts: A numpy array of the count of each term.
+        """
+        for row in range(self.depth):
+            self.counts[row] += np.bincount(columns[:, row], weights=counts, minlength=self.width).astype(np.int64)
+
+    def query(self, columns):
+        """
+        A method to estimate term counts.
+        :param columns: A numpy array of counters as returned by term_columns().
+        :return: A numpy array of estimated counts.
+        """
+        if len(columns) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return self.counts[np.arange(self.depth), columns].min(axis=1)
+
+    def merge(self, other):
+        """A method to add the counts of a sketch with the same width, depth and seed."""
+        if (self.width, self.depth, self.seed) != (other.width, other.depth, other.seed):
+            raise ValueError("Only sketches with the same width, depth and seed can be merged.")
+        self.counts += other.counts
+
+
+class SliceStats:
+    """The term statistics of a time slice and subcorpus."""
+
+    def __init__(self, sketch, k=TOP_K):
+        """
+        :param sketch: An empty CountMinSketch.
+        :param k: The number of heavy hitters to keep.
+        """
+        self.sketch = sketch
+        self.k = k
+        self.num_posts = 0
+        self.top = {}
+
+    @property
+    def num_words(self):
+        """The number of words of the posts."""
+        return self.sketch.total
+
+    def columns(self, terms):
+        """A method to hash terms to the counters of the sketch."""
+        return term_columns(terms, self.sketch.width, self.sketch.depth, self.sketch.seed)
+
+    def add(self, terms, columns, counts, num_posts):
+        """
+        A method to add the term counts of new posts.
+        :param terms: A list of distinct terms.
+        :param columns: A numpy array of the counters of the terms as returned by term_columns().
+        :param counts: A numpy array of the count of each term.
+        :param num_posts: The number of new posts.
+        """
+        self.sketch.add(columns, counts)
+        self.num_posts += num_posts
+        self.update_top(terms, self.sketch.query(columns))
+
+    def update_top(self, terms, estimates):
+        """A method to add candidates with their estimated counts and keep the k most frequent candidates."""
+        self.top.update(zip(terms, estimates.tolist()))
+        if len(self.top) > self.k:
+            self.top = dict(heapq.nlargest(self.k, self.top.items(), key=lambda item: item[1]))
+
+    def merge(self, other):
+        """A method to add the statistics of the same time slice and subcorpus, e.g. of another shard."""
+        self.sketch.merge(other.sketch)
+        self.num_posts += other.num_posts
+        terms = list(set(self.top) | set(other.top))
+        self.top = {}
+        self.update_top(terms, self.sketch.query(self.columns(terms)))
+
+    def top_terms(self, n=None):
+        """
+        A method to get the heavy hitters with their current estimated counts.
+        :param n: Optional number of terms. Defaults to all kept terms.
+        :return: A pandas DataFrame with the columns "term" and "count" ordered by count.
+        """
+        terms = list(self.top)
+        top = pd.DataFrame({"term": terms, "count": self.sketch.query(self.columns(terms))}, dtype=object)
+        top["count"] = top["count"].astype(np.int64)
+        top = top.sort_values(["count", "term"], ascending=[False, True], kind="stable")
+        return top.head(n).reset_index(drop=True) if n is not None else top.reset_index(drop=True)
+
+
+class TermSketches:
+    """The term statistics of all time slices and subcorpora."""
+
+    def __init__(self, policy, width, depth, seed=SEED, k=TOP_K):
+        """
+        :param policy: A dictionary with the POLICY_KEYS of the time slices as returned by SliceCalendar.policy().
+        :param width: The number of counters per row of the sketches.
+        :param depth: The number of rows of the sketches.
+        :param seed: The key of the hash function.
+        :param k: The number of heavy hitters kept per time slice and subcorpus.
+        """
+        self.policy = {key: policy[key] for key in POLICY_KEYS}
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.k = k
+        # (subcorpus, first day of the time slice) -> SliceStats
+        self.stats = {}
+        # Resolved path of each ingested input file -> {"rows", "size", "digest"}
+        self.inputs = {}
+
+    def parameters(self):
+        """A method to get the parameters that must agree to merge states."""
+        return dict(self.policy, width=self.width, depth=self.depth, seed=self.seed, k=self.k)
+
+    def slice_stats(self, key):
+        """A method to get the statistics of a (subcorpus, first day) key, new statistics are created."""
+        if key not in self.stats:
+            self.stats[key] = SliceStats(CountMinSketch(self.width, self.depth, self.seed), self.k)
+        return self.stats[key]
+
+    def add_posts(self, posts, calendar, column="text"):
+        """
+        A method to add the terms of posts.
+        The terms of a chunk are hashed once for all time slices and subcorpora.
+        :param posts: A pandas DataFrame as returned by read_posts().
+        :param calendar: A SliceCalendar with the policy of the state.
+        :param column: The column of space-separated tokens.
+        :return: The number of skipped posts outside the time slices or subcorpora.
+        """
+        groups, keys = slice_groups(posts, calendar)
+        words = posts[column].str.lower().str.split().explode().dropna()
+        word_groups = groups[words.index.to_numpy()]
+        codes, terms = pd.factorize(words[word_groups >= 0])
+        word_groups = word_groups[word_groups >= 0]
+        columns = term_columns(terms, self.width, self.depth, self.seed)
+        pairs, counts = np.unique(word_groups * len(terms) + codes, return_counts=True)
+        pair_groups, term_ids = pairs // max(len(terms), 1), pairs % max(len(terms), 1)
+        post_groups, num_posts = np.unique(groups[groups >= 0], return_counts=True)
+        for group, n in zip(post_groups, num_posts):
+            first = np.searchsorted(pair_groups, group, side="left")
+            last = np.searchsorted(pair_groups, group, side="right")
+            ids = term_ids[first:last]
+            self.slice_stats(keys[group]).add(terms[ids].tolist(), columns[ids], counts[first:last], int(n))
+        return int((groups < 0).sum())
+
+    def merge(self, other):
+        """A method to add the statistics of a state with the same parameters, e.g. of another shard."""
+        if self.parameters() != other.parameters():
+            raise ValueError("Only states with the same parameters can be merged: "
+                             + str(self.parameters()) + " != " + str(other.parameters()))
+        ingested = set(self.inputs) & set(other.inputs)
+        if ingested:
+            raise ValueError("Both states contain the posts of " + ", ".join(sorted(ingested)) + ".")
+        for key, stats in other.stats.items():
+            if key in self.stats:
+                self.stats[key].merge(stats)
+            else:
+                self.stats[key] = stats
+        self.inputs.update(other.inputs)
+
+    def keys(self, subcorpus):
+        """A method to get the keys of a subcorpus ordered by time slice."""
+        return sorted(key for key in self.stats if key[0] == subcorpus)
+
+    def term_counts(self, subcorpus, terms=()):
+        """
+        A method to estimate the counts of terms per time slice.
+        :param subcorpus: A subcorpus name of SUBCORPORA.
+        :param terms: A list of terms.
+        :return: A pandas DataFrame indexed by the first day of the time slices with the columns "num_posts",
+        "num_words", "error_bound" (maximum overestimation with probability 1 - delta) and one column per term.
+        """
+        terms = [term.lower() for term in terms]
+        columns = term_columns(terms, self.width, self.depth, self.seed)
+        rows = []
+        for key in self.keys(subcorpus):
+            stats = self.stats[key]
+            row = {"date": key[1], "num_posts": stats.num_posts, "num_words": stats.num_words,
+                   "error_bound": stats.sketch.epsilon * stats.num_words}
+            row.update(zip(terms, stats.sketch.query(columns).tolist()))
+            rows.append(row)
+        table = pd.DataFrame(rows, columns=["date", "num_posts", "num_words", "error_bound"] + terms)
+        return table.set_index("date")
+
+    def emerging_terms(self, subcorpus, n=20):
+        """
+        A method to find the terms occurring most often above their expected count in each time slice.
+        The expected count is the share of the term among the words of the previous time slice with
+        posts times the number of words of the time slice.
+        :param subcorpus: A subcorpus name of SUBCORPORA.
+        :param n: The number of terms per time slice.
+        :return: A pandas DataFrame indexed by the first day of the time slices with the columns "term", "count",
+        "previous_count", "excess" and "pct_change" (of the share of the term).
+        """
+        tables = []
+        previous = None
+        for key in self.keys(subcorpus):
+            stats = self.stats[key]
+            top = stats.top_terms()
+            if previous is not None and previous.num_words > 0:
+                top["previous_count"] = previous.sketch.query(previous.columns(list(top["term"])))
+                ratio = stats.num_words / previous.num_words
+            else:
+                top["previous_count"] = 0
+                ratio = 0.0
+            top["excess"] = top["count"] - top["previous_count"] * ratio
+            with np.errstate(divide="ignore", invalid="ignore"):
+                top["pct_change"] = (top["count"] / (top["previous_count"] * ratio) - 1) * 100
+            top["pct_change"] = top["pct_change"].replace([np.inf, -np.inf], 100.0).fillna(0.0)
+            top = top[top["excess"] > 0].sort_values(["excess", "term"], ascending=[False, True], kind="stable")
+            tables.append(top.head(n).assign(date=key[1]))
+            previous = stats
+        columns = ["date", "term", "count", "previous_count", "excess", "pct_change"]
+        if not tables:
+            return pd.DataFrame(columns=columns).set_index("date")
+        return pd.concat(tables)[columns].set_index("date")
+
+
+def slice_groups(posts, calendar):
+    """
+    A method to assign posts to the time slices of each subcorpus.
+    :param posts: A pandas DataFrame with the columns "ID" and "date".
+    :param calendar: A SliceCalendar.
+    :return: A tuple of a numpy array with the group of each post (-1 for posts outside the time slices
+    or subcorpora) and a list of the (subcorpus, first day) key of each group.
+    """
+    ids = calendar.slice_ids(posts["date"].dt.normalize())
+    outlets = metrics.post_outlets(posts)
+    selected = (ids >= 0) & (ids < len(calendar))
+    groups = np.full(len(posts), -1, dtype=np.int64)
+    keys = []
+    for i, (name, (_, outlet_names)) in enumerate(metrics.SUBCORPORA.items()):
+        in_subcorpus = selected & np.isin(outlets, outlet_names)
+        groups[in_subcorpus] = i * len(calendar) + ids[in_subcorpus]
+        keys.extend((name, str(day.date())) for day in calendar.edges)
+    return groups, keys
+
+
+def exact_counts(posts, calendar, column="text"):
+    """
+    A method to count the terms of posts exactly, e.g. to check the error of the sketches.
+    :param posts: A pandas DataFrame as returned by read_posts().
+    :param calendar: A SliceCalendar.
+    :param column: The column of space-separated tokens.
+    :return: A dictionary mapping (subcorpus, first day) keys to pandas Series of term counts.
+    """
+    groups, keys = slice_groups(posts, calendar)
+    words = posts[column].str.lower().str.split().explode().dropna()
+    word_groups = groups[words.index.to_numpy()]
+    words = pd.Series(words.to_numpy()[word_groups >= 0], dtype=object)
+    counts = words.groupby([word_groups[word_groups >= 0], words]).size()
+    return {keys[group]: frame.droplevel(0) for group, frame in counts.groupby(level=0)}
+
+
+def check_bounds(sketches, exact, delta=DELTA):
+    """
+    A method to compare the estimated with the exact term counts of all time slices and subcorpora.
+    :param sketches: A TermSketches state.
+    :param exact: A dictionary mapping (subcorpus, first day) keys to pandas Series of exact term counts.
+    :param delta: The probability of exceeding the error bound.
+    :return: A pandas DataFrame with one row per time slice and subcorpus, among others with the share of
+    terms whose error exceeds the error bound ("exceeded", expected to be at most delta) and the share
+    of heavy hitters among the exact top k terms ("top_precision").
+    """
+    rows = []
+    for (name, day), counts in sorted(exact.items()):
+        stats = sketches.stats[(name, day)]
+        errors = stats.sketch.query(stats.columns(list(counts.index))) - counts.to_numpy()
+        bound = stats.sketch.epsilon * stats.num_words
+        top = stats.top_terms(sketches.k)
+        # Terms tied with the k-th most frequent term are part of the exact top k as well
+        threshold = counts.nlargest(sketches.k).min()
+        rows.append({
+            "subcorpus": name, "date": day, "num_words": stats.num_words, "exact_words": int(counts.sum()),
+            "terms": len(counts), "error_bound": bound, "mean_error": errors.mean(), "max_error": errors.max(),
+            "underestimated": int((errors < 0).sum()), "exceeded": (errors > bound).mean(),
+            "top_precision": (counts.reindex(top["term"]).fillna(0).to_numpy() >= threshold).mean(),
+        })
+    results = pd.DataFrame(rows)
+    results["delta"] = delta
+    return results
+
+
+def same_counts(first, second):
+    """A method to compare the counters, posts and time slices of two states (the heavy hitters are not compared)."""
+    return sorted(first.stats) == sorted(second.stats) and all(
+        np.array_equal(stats.sketch.counts, second.stats[key].sketch.counts)
+        and stats.num_posts == second.stats[key].num_posts for key, stats in first.stats.items())
+
+
+def check_sketches(fn_input, calendar, width, depth, seed=SEED, k=TOP_K, column="text", fn_state=None):
+    """
+    A method to check the guarantees of the sketches against the exact counts of posts:
+    - no estimated count is below the exact count and the word totals are exact,
+    - the share of terms whose error exceeds epsilon * (number of words) is at most delta = exp(-depth),
+    - merging the states of two halves of the posts gives the same counters as one state of all posts.
+    All states are stored and loaded again before they are compared.
+    :param fn_input: Path to the CSV file of preprocessed posts.
+    :param calendar: A SliceCalendar.
+    :param width: The number of counters per row of new sketches.
+    :param depth: The number of rows of new sketches.
+    :param seed: The key of the hash function of new sketches.
+    :param k: The number of heavy hitters of new sketches.
+    :param column: The column of space-separated tokens.
+    :param fn_state: Optional state file built from the input posts, checked instead of a new state.
+    :return: A tuple of a pandas DataFrame as returned by check_bounds() and a list of failed checks.
+    """
+    single = TermSketches(calendar.policy(), width, depth, seed, k)
+    halves = [TermSketches(calendar.policy(), width, depth, seed, k) for _ in range(2)]
+    exact = {}
+    for posts in read_posts(fn_input, column):
+        with span("add_posts", rows=len(posts)):
+            single.add_posts(posts, calendar, column)
+            for i, half in enumerate(halves):
+                half.add_posts(posts.iloc[i::2].reset_index(drop=True), calendar, column)
+        with span("exact_counts", rows=len(posts)):
+            for key, counts in exact_counts(posts, calendar, column).items():
+                exact[key] = counts.add(exact[key], fill_value=0).astype(np.int64) if key in exact else counts
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, sketches in [("single", single), ("first", halves[0]), ("second", halves[1])]:
+            save_state(sketches, Path(tmp) / (name + ".npz"))
+        single = load_state(Path(tmp) / "single.npz")
+        merged = load_state(Path(tmp) / "first.npz")
+        merged.merge(load_state(Path(tmp) / "second.npz"))
+    if not same_counts(single, merged):
+        failures.append("The merged states of two halves of the posts differ from the state of all posts.")
+
+    sketches = load_state(fn_state) if fn_state else single
+    missing = [key for key in exact if key not in sketches.stats]
+    if missing:
+        failures.append("Time slices of the input missing in the state: " + str(missing))
+    extra = [key for key, stats in sketches.stats.items() if key not in exact and stats.num_words > 0]
+    if extra:
+        failures.append("Words of time slices not in the input in the state: " + str(extra))
+    delta = float(np.exp(-sketches.depth))
+    errors = check_bounds(sketches, {key: counts for key, counts in exact.items() if key in sketches.stats}, delta)
+    if len(errors):
+        if errors["underestimated"].any():
+            failures.append("Estimated counts below the exact counts.")
+        if (errors["num_words"] != errors["exact_words"]).any():
+            failures.append("Word totals differ from the exact word totals.")
+        exceeded = (errors["exceeded"] * errors["terms"]).sum() / errors["terms"].sum()
+        if exceeded > delta:
+            failures.append("The error bound is exceeded for " + str(exceeded) + " of the terms (delta "
+                            + str(delta) + ").")
+    return errors, failures
+
+
+def state_file(time_slice):
+    """A method to get the default state file of a time slice."""
+    return Path(STATE_DIR) / ("sketches" + str(time_slice) + ".npz")
+
+
+def save_state(sketches, fn):
+    """
+    A method to store a state as NumPy archive.
+    :param sketches: A TermSketches state.
+    :param fn: The output file.
+    """
+    keys = sorted(sketches.stats)
+    stats = [sketches.stats[key] for key in keys]
+    meta = dict(sketches.parameters(), keys=keys, top=[list(s.top.items()) for s in stats], inputs=sketches.inputs)
+    Path(fn).parent.mkdir(parents=True, exist_ok=True)
+    with open(fn, "wb") as f:
+        np.savez_compressed(
+            f,
+            counts=np.stack([s.sketch.counts for s in stats]) if stats else np.zeros((0, sketches.depth,
+                                                                                      sketches.width), np.int64),
+            num_posts=np.array([s.num_posts for s in stats], dtype=np.int64),
+            meta=np.array(json.dumps(meta, ensure_ascii=False)),
+        )
+
+
+def load_state(fn):
+    """
+    A method to load a state stored with save_state().
+    :param fn: The state file.
+    :return: A TermSketches state.
+    """
+    with np.load(fn) as data:
+        meta = json.loads(str(data["meta"]))
+        counts, num_posts = data["counts"], data["num_posts"]
+    sketches = TermSketches(meta, meta["width"], meta["depth"], meta["seed"], meta["k"])
+    for i, key in enumerate(meta["keys"]):
+        stats = sketches.slice_stats(tuple(key))
+        stats.sketch.counts = counts[i].copy()
+        stats.num_posts = int(num_posts[i])
+        stats.top = dict((term, count) for term, count in meta["top"][i])
+    sketches.inputs = meta.get("inputs", {})
+    return sketches
+
+
+def file_digests(fn, sizes=()):
+    """
+    A method to compute the SHA-256 digests of prefixes and of all bytes of a file in one pass.
+    :param fn: The file.
+    :param sizes: The lengths of the prefixes in bytes.
+    :return: A tuple of a dictionary mapping the lengths of prefixes of the file to their hex digests
+    (lengths beyond the end of the file are left out) and the hex digest of the whole file.
+    """
+    digest, prefixes = hashlib.sha256(), {}
+    pending = sorted(set(sizes))
+    position = 0
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            offset = 0
+            while pending and pending[0] <= position + len(block):
+                size = pending.pop(0)
+                digest.update(block[offset:size - position])
+                offset = size - position
+                prefixes[size] = digest.hexdigest()
+            digest.update(block[offset:])
+            position += len(block)
+    prefixes.update((size, digest.hexdigest()) for size in pending if size <= position)
+    return prefixes, digest.hexdigest()
+
+
+def ingested_rows(sketches, fn_input):
+    """
+    A method to get the number of rows of an input file that were already added to a state.
+    :param sketches: A TermSketches state.
+    :param fn_input: Path to the CSV file.
+    :return: A tuple of the number of ingested rows and the fingerprint of the file.
+    :raise ValueError: If the file was changed other than by appending rows since it was added,
+    or if it starts with the content of another added file.
+    """
+    key = str(Path(fn_input).resolve())
+    # Files of which no rows were added, e.g. a header only, do not constrain later updates
+    ingested = {other: record for other, record in sketches.inputs.items() if record["rows"] > 0}
+    prefixes, digest = file_digests(fn_input, [record["size"] for record in ingested.values()])
+    fingerprint = {"size": Path(fn_input).stat().st_size, "digest": digest}
+    if key in ingested:
+        # The file still starts with the ingested rows, e.g. a cumulative file new posts are appended to
+        if prefixes.get(ingested[key]["size"]) == ingested[key]["digest"]:
+            return ingested[key]["rows"], fingerprint
+        raise ValueError(str(fn_input) + " was changed since its posts were added, not only appended to. "
+                         "Please rebuild the state from all input files.")
+    for other, record in ingested.items():
+        if prefixes.get(record["size"]) == record["digest"]:
+            raise ValueError("The posts of " + other + " were already added and " + str(fn_input)
+                             + " starts with them.")
+    return 0, fingerprint
+
+
+def update_state(fn_input, calendar, sketches, column="text"):
+    """
+    A method to add the preprocessed posts of a CSV file to a state.
+    Rows of the file that were already added are skipped, see ingested_rows().
+    :param fn_input: Path to the CSV file created by <preprocess_text.py>.
+    :param calendar: A SliceCalendar with the policy of the state.
+    :param sketches: A TermSketches state.
+    :param column: The column of space-separated tokens.
+    :return: A tuple of the number of added posts, skipped posts outside the time slices or subcorpora,
+    and rows that were already added before.
+    """
+    done, fingerprint = ingested_rows(sketches, fn_input)
+    rows, skipped = 0, 0
+    for posts in read_posts(fn_input, column, done):
+        with span("add_posts", rows=len(posts)):
+            skipped += sketches.add_posts(posts, calendar, column)
+        rows += len(posts)
+    sketches.inputs[str(Path(fn_input).resolve())] = dict(fingerprint, rows=done + rows)
+    return rows - skipped, skipped, done
+
+
+def main(argv=None):
+    """
+    A method to update, merge, query and check term sketches from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Streaming term statistics per time slice and subcorpus.")
+    parser.add_argument("command", choices=["update", "merge", "counts", "emerging", "check"],
+                        help="Action to perform")
+    parser.add_argument("--input", help="CSV file of preprocessed posts (update, check)")
+    parser.add_argument("--column", default="text", help="Column of tokens, e.g. lemmas of <lemmatize.py>")
+    parser.add_argument("--rtsi", help="RTSI Excel file defining the time slices (update, check)")
+    parser.add_argument("--time-slice", type=int, default=7, help="Length of a time slice in days")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI (new states)")
+    parser.add_argument("--state", help="State file. Defaults to " + STATE_DIR + "sketches<N>.npz "
+                                        "(check: a state built from the input, checked instead of a new state)")
+    parser.add_argument("--states", nargs="+", default=[], help="State files to merge into --state (merge)")
+    parser.add_argument("--epsilon", type=float, default=EPSILON,
+                        help="Relative error of the estimated counts (new states)")
+    parser.add_argument("--delta", type=float, default=DELTA,
+                        help="Probability of exceeding the error (new states)")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="Number of heavy hitters kept (new states)")
+    parser.add_argument("--seed", type=int, default=SEED, help="Key of the hash function (new states)")
+    parser.add_argument("--query", nargs="+", default=[], help="Terms to count (counts)")
+    parser.add_argument("-n", type=int, default=20, help="Number of emerging terms per time slice (emerging)")
+    parser.add_argument("--output", default=RESULTS_DIR, help="Output directory")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    time_slice = args.time_slice
+    if time_slice < 1:
+        sys.exit("Invalid time slice: " + str(time_slice) + ".\nPlease enter a valid time slice > 0.")
+    fn_state = Path(args.state) if args.state else state_file(time_slice)
+    path = Path(args.output) / (str(time_slice) + "days")
+    path.mkdir(parents=True, exist_ok=True)
+    width, depth = CountMinSketch.dimensions(args.epsilon, args.delta)
+
+    with span("term_sketches", command=args.command, time_slice=time_slice):
+        if args.command == "update":
+            calendar = metrics.SliceCalendar(metrics.load_rtsi(args.rtsi), time_slice, args.alignment)
+            if fn_state.exists():
+                sketches = load_state(fn_state)
+                if sketches.policy != {key: calendar.policy()[key] for key in POLICY_KEYS}:
+                    sys.exit("The state in " + str(fn_state) + " was created for other time slices: "
+                             + str(sketches.policy))
+            else:
+                sketches = TermSketches(calendar.policy(), width, depth, args.seed, args.top_k)
+            try:
+                added, skipped, done = update_state(args.input, calendar, sketches, args.column)
+            except ValueError as error:
+                sys.exit(str(error))
+            print("Added " + str(added) + " posts, skipped " + str(skipped) + " posts outside the time slices and "
+                  + str(done) + " posts added before.")
+            print(str(len(sketches.stats)) + " time slice sketches of " + str(sketches.depth) + " x "
+                  + str(sketches.width) + " counters")
+            with span("write"):
+                save_state(sketches, fn_state)
+            print("State saved to " + str(fn_state))
+        elif args.command == "merge":
+            sketches = load_state(args.states[0])
+            for fn in args.states[1:]:
+                with span("merge"):
+                    try:
+                        sketches.merge(load_state(fn))
+                    except ValueError as error:
+                        sys.exit(str(error))
+            with span("write"):
+                save_state(sketches, fn_state)
+            print(str(len(args.states)) + " states merged into " + str(fn_state))
+        elif args.command == "check":
+            calendar = metrics.SliceCalendar(metrics.load_rtsi(args.rtsi), time_slice, args.alignment)
+            errors, failures = check_sketches(args.input, calendar, width, depth, args.seed, args.top_k,
+                                              args.column, args.state)
+            errors.to_csv(path / ("sketch_errors" + str(time_slice) + ".csv"), index=False, encoding="utf-8")
+            if len(errors):
+                print(errors.groupby("subcorpus")[["terms", "error_bound", "mean_error", "max_error", "exceeded",
+                                                    "top_precision"]].mean().to_string())
+            if failures:
+                sys.exit("\n".join(failures))
+            print("All checks passed.")
+        else:
+            sketches = load_state(fn_state)
+            for name in metrics.SUBCORPORA:
+                if args.command == "counts":
+                    table = sketches.term_counts(name, args.query)
+                    fn = path / (name + "_term_counts" + str(time_slice) + ".csv")
+                else:
+                    table = sketches.emerging_terms(name, args.n)
+                    fn = path / (name + "_emerging_terms" + str(time_slice) + ".csv")
+                table["status"] = metrics.SUBCORPORA[name][0]
+                table.to_csv(fn, encoding="utf-8")
+            print("Results saved to " + str(path))
+
+    print("Time consumption term sketches: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
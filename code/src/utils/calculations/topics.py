@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to track the topics of posts per time slice with an online topic model.
+
+In more detail, this module complements the fixed COUNTRY_GROUPS with topics learned from the preprocessed posts:
+1. The vocabulary (the MAX_FEATURES most frequent terms occurring in at least MIN_DF posts) is counted once.
+2. The sparse document-term matrix is built in chunks and stored in a part directory as memory-mapped arrays,
+   together with the day, outlet and number of words of each post.
+3. An online topic model (LDA with online variational Bayes or mini-batch NMF) is updated with partial_fit()
+   on mini-batches of BATCH_SIZE posts, time slice by time slice in date order.
+4. The topic shares of each post are summed up per day and subcorpus into daily counts in the layout of
+   <calculate_metrics_prct_change.py>: "<topic>_posts" is the expected number of posts and "<topic>_mentions"
+   the expected number of words on a topic. The post and word level metrics are then calculated per time slice
+   and saved in the layout of the country metrics, with the topics "topic00", "topic01", ... in place of
+   the countries, so that they can be used by the correlation and regression analyses.
+
+While building the document-term matrix, only one chunk of posts and its sparse matrix are held in memory;
+the arrays of each chunk are appended to files on disk. Fitting and transforming only read one mini-batch
+at a time from the memory-mapped arrays. New posts are added with "update": they are stored as a new part,
+the model is updated with them and their topic shares are added to the daily counts. The topic shares of
+earlier posts are not changed by an update; "shares" recomputes the shares of all parts with the current
+model. The top terms of each topic are saved in "topic_terms.csv".
+
+Examples:
+python3 code/src/utils/calculations/topics.py fit --input code/data/media_posts_processed_final.csv --rtsi code/data/rtsi_topics.xlsx --time-slice 7
+python3 code/src/utils/calculations/topics.py update --input code/data/media_posts_new_final.csv --rtsi code/data/rtsi_topics.xlsx --time-slice 7
+"""
+import argparse
+import json
+import pickle
+import sys
+import time
+from pathlib import Path
+
+import calculate_metrics_prct_change as metrics
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+
+MODEL_DIR = "code/data/topics/"
+RESULTS_DIR = "code/data/metrics_percent_results/topics/"
+OUTLET_NAMES = list(metrics.OUTLETS)
+CHUNK_SIZE = 100000
+BATCH_SIZE = 4096  # Posts per mini-batch of partial_fit() and transform()
+NUM_TOPICS = 20
+MAX_FEATURES = 20000
+MIN_DF = 5
+MAX_DF = 0.5  # Terms occurring in more than this share of posts are not used
+MAX_TERM_LENGTH = 64
+BLOCK_SIZE = 1 << 22  # Array elements copied at once when a part is finalized
+# Arrays of a part and their types
+PART_ARRAYS = {
+    "data": "float32",
+    "indices": "int32",
+    "indptr": "int64",
+    "days": "int32",
+    "outlets": "int8",
+    "num_words": "int32",
+}
+NUM_TERMS = 15  # Top terms saved per topic
+# Placeholders introduced by <preprocess_text.py> carry no topic
+PLACEHOLDERS = ["number", "tag", "user", "cur"]
+SEED = 42
+
+
+def read_posts(fn_vk, column="text"):
+    """
+    A method to read the posts of the final CSV file in chunks.
+    :param fn_vk: Path to the CSV file created by <merge_ner_and_posts.py>.
+    :param column: The column of space-separated tokens, e.g. "text" or "lemmas".
+    :return: A generator of pandas DataFrames with the columns "ID", "date" and the token column.
+    Posts without ID are skipped.
+    """
+    for chunk in pd.read_csv(fn_vk, encoding="utf-8", sep=",", usecols=["ID", "date", column],
+                             dtype={column: str}, chunksize=CHUNK_SIZE):
+        chunk = chunk[chunk["ID"].notna()].reset_index(drop=True)
+        chunk["date"] = pd.to_datetime(chunk["date"])
+        chunk[column] = chunk[column].fillna("")
+        yield chunk
+
+
+def tokenize(texts):
+    """
+    A method to split texts into the tokens used by the topic model.
+    :param texts: A pandas Series of space-separated tokens.
+    :return: A pandas Series of tokens indexed by the position of their post.
+    """
+    tokens = texts.str.lower().str.split().explode().dropna()
+    return tokens[(tokens.str.len() <= MAX_TERM_LENGTH) & ~tokens.isin(PLACEHOLDERS)]
+
+
+def build_vocabulary(fn_vk, column="text", max_features=MAX_FEATURES, min_df=MIN_DF, max_df=MAX_DF):
+    """
+    A method to select the vocabulary of the topic model by document frequency.
+    :param fn_vk: Path to the CSV file created by <merge_ner_and_posts.py>.
+    :param column: The column of space-separated tokens.
+    :param max_features: The maximum size of the vocabulary.
+    :param min_df: The minimum number of posts a term occurs in.
+    :param max_df: The maximum share of posts a term occurs in.
+    :return: A sorted numpy array of terms.
+    """
+    frequencies = pd.Series(dtype="int64")
+    num_posts = 0
+    for chunk in read_posts(fn_vk, column):
+        tokens = tokenize(chunk[column])
+        # Count each term once per post
+        terms = pd.Series(tokens.to_numpy(), index=tokens.index).groupby(level=0).unique().explode()
+        frequencies = frequencies.add(terms.value_counts(), fill_value=0)
+        num_posts += len(chunk)
+    frequencies = frequencies[(frequencies >= min_df) & (frequencies <= max_df * num_posts)]
+    # Ties are broken alphabetically, so that the vocabulary does not depend on the order of the posts
+    frequencies = frequencies.sort_index().sort_values(ascending=False, kind="stable")
+    return np.sort(frequencies.index[:max_features].to_numpy(dtype=str))
+
+
+def document_term_matrix(texts, vocabulary):
+    """
+    A method to build the sparse document-term matrix of posts.
+    :param texts: A pandas Series of space-separated tokens.
+    :param vocabulary: A pandas Index of terms.
+    :return: A scipy CSR matrix of term frequencies of shape (posts, terms).
+    """
+    tokens = tokenize(texts.reset_index(drop=True))
+    columns = vocabulary.get_indexer(tokens.to_numpy())
+    known = columns >= 0
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum(), dtype=np.float32), (tokens.index.to_numpy()[known], columns[known])),
+        shape=(len(texts), len(vocabulary)),
+    )
+    matrix.sum_duplicates()
+    return matrix
+
+
+def build_part(fn_vk, vocabulary, part_dir, column="text"):
+    """
+    A method to store the document-term matrix and post attributes of an input file as a part.
+    :param fn_vk: Path to the CSV file created by <merge_ner_and_posts.py>.
+    :param vocabulary: A numpy array of terms as returned by build_vocabulary().
+    :param part_dir: The output directory of the part.
+    :param column: The column of space-separated tokens.
+    :return: The number of stored posts.
+    """
+    part_dir = Path(part_dir)
+    part_dir.mkdir(parents=True, exist_ok=True)
+    vocabulary = pd.Index(vocabulary)
+    files = {name: open(part_dir / (name + ".bin"), "wb") for name in PART_ARRAYS}
+    num_posts, offset = 0, 0
+    try:
+        files["indptr"].write(np.zeros(1, dtype=np.int64).tobytes())
+        for chunk in read_posts(fn_vk, column):
+            matrix = document_term_matrix(chunk[column], vocabulary)
+            outlets = metrics.post_outlets(chunk)
+            codes = np.full(len(outlets), -1, dtype=np.int8)
+            for code, name in enumerate(OUTLET_NAMES):
+                codes[outlets == name] = code
+            arrays = {
+                "data": matrix.data,
+                "indices": matrix.indices,
+                "indptr": matrix.indptr[1:].astype(np.int64) + offset,
+                "days": chunk["date"].dt.normalize().to_numpy().astype("datetime64[D]"),
+                "outlets": codes,
+                "num_words": chunk[column].str.split().str.len().to_numpy(),
+            }
+            for name, array in arrays.items():
+                files[name].write(array.astype(PART_ARRAYS[name]).tobytes())
+            num_posts += len(chunk)
+            offset += matrix.nnz
+    finally:
+        for f in files.values():
+            f.close()
+    for name, dtype in PART_ARRAYS.items():
+        finalize_array(part_dir / (name + ".bin"), part_dir / (name + ".npy"), dtype)
+    return num_posts
+
+
+def finalize_array(fn_raw, fn_npy, dtype):
+    """
+    A method to convert a file of raw array elements into a .npy file block by block and remove it.
+    :param fn_raw: The file of raw array elements.
+    :param fn_npy: The output .npy file.
+    :param dtype: The type of the array elements.
+    """
+    size = Path(fn_raw).stat().st_size // np.dtype(dtype).itemsize
+    array = np.lib.format.open_memmap(fn_npy, mode="w+", dtype=dtype, shape=(size,))
+    if size:
+        raw = np.memmap(fn_raw, dtype=dtype, mode="r", shape=(size,))
+        for start in range(0, size, BLOCK_SIZE):
+            array[start:start + BLOCK_SIZE] = raw[start:start + BLOCK_SIZE]
+        del raw
+    array.flush()
+    del array
+    Path(fn_raw).unlink()
+
+
+class Part:
+    """A memory-mapped part of the document-term matrix stored with build_part()."""
+
+    def __init__(self, part_dir, num_terms):
+        self.part_dir = Path(part_dir)
+        self.num_terms = num_terms
+        self.data = self.load("data")
+        self.indices = self.load("indices")
+        self.indptr = self.load("indptr")
+        self.days = self.load("days")
+        self.outlets = self.load("outlets")
+        self.num_words = self.load("num_words")
+
+    def __len__(self):
+        return len(self.days)
+
+    def load(self, name):
+        """A method to memory-map an array of the part."""
+        return np.load(self.part_dir / (name + ".npy"), mmap_mode="r")
+
+    def rows(self, start, end):
+        """
+        A method to read a contiguous range of rows of the document-term matrix.
+        :param start: The first row.
+        :param end: The last row + 1.
+        :return: A scipy CSR matrix of shape (end - start, terms).
+        """
+        first, last = int(self.indptr[start]), int(self.indptr[end])
+        return sparse.csr_matrix(
+            (np.asarray(self.data[first:last]), np.asarray(self.indices[first:last]),
+             np.asarray(self.indptr[start:end + 1]) - first),
+            shape=(end - start, self.num_terms),
+        )
+
+    def take(self, rows):
+        """
+        A method to read arbitrary rows of the document-term matrix.
+        :param rows: A sorted numpy array of rows.
+        :return: A scipy CSR matrix of shape (len(rows), terms).
+        """
+        starts = np.asarray(self.indptr[rows])
+        lengths = np.asarray(self.indptr[rows + 1]) - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return sparse.csr_matrix(
+            (np.asarray(self.data[positions]), np.asarray(self.indices[positions]), indptr),
+            shape=(len(rows), self.num_terms),
+        )
+
+    def batches(self, batch_size=BATCH_SIZE):
+        """A method to iterate over (start, end) row ranges of at most batch_size rows."""
+        for start in range(0, len(self), batch_size):
+            yield start, min(start + batch_size, len(self))
+
+
+def create_model(method, num_topics=NUM_TOPICS, seed=SEED):
+    """
+    A method to create an online topic model.
+    :param method: "lda" (LDA with online variational Bayes) or "nmf" (mini-batch NMF).
+    :param num_topics: The number of topics.
+    :param seed: The random seed.
+    :return: A scikit-learn estimator providing partial_fit() and transform().
+    """
+    # Imported here, so that the command line interface starts without loading scikit-learn
+    if method == "lda":
+        from sklearn.decomposition import LatentDirichletAllocation
+
+        return LatentDirichletAllocation(n_components=num_topics, learning_method="online",
+                                         batch_size=BATCH_SIZE, random_state=seed)
+    from sklearn.decomposition import MiniBatchNMF
+
+    return MiniBatchNMF(n_components=num_topics, batch_size=BATCH_SIZE, init="nndsvda", random_state=seed)
+
+
+def fit_part(model, part, time_slice=1, passes=1):
+    """
+    A method to update a topic model with the posts of a part, time slice by time slice in date order.
+    :param model: A topic model as returned by create_model().
+    :param part: A Part.
+    :param time_slice: The length of the time slices in days.
+    :param passes: The number of passes over the part.
+    :return: The number of mini-batches.
+    """
+    days = np.asarray(part.days)
+    if len(days) == 0:
+        return 0
+    slices = (days - days.min()) // time_slice
+    order = np.argsort(slices, kind="stable")
+    _, starts = np.unique(slices[order], return_index=True)
+    bounds = list(starts) + [len(order)]
+    num_batches = 0
+    for _ in range(passes):
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            # Rows of a time slice are read in file order
+            rows = np.sort(order[first:last])
+            for start in range(0, len(rows), BATCH_SIZE):
+                matrix = part.take(rows[start:start + BATCH_SIZE])
+                model.partial_fit(matrix)
+                num_batches += 1
+    return num_batches
+
+
+def topic_shares(model, matrix):
+    """
+    A method to get the topic shares of posts.
+    :param model: A fitted topic model.
+    :param matrix: A scipy sparse document-term matrix.
+    :return: A numpy array of shape (posts, topics) with rows summing to 1
+    (or 0 for posts without any term of the vocabulary).
+    """
+    weights = model.transform(matrix)
+    totals = weights.sum(axis=1, keepdims=True)
+    shares = np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+    shares[np.asarray(matrix.sum(axis=1)).ravel() == 0] = 0
+    return shares
+
+
+def topic_labels(num_topics):
+    """A method to get the labels "topic00", "topic01", ... of the topics."""
+    width = len(str(num_topics - 1))
+    return ["topic" + str(k).zfill(width) for k in range(num_topics)]
+
+
+def part_daily_counts(model, part, labels):
+    """
+    A method to sum up the topic shares of the posts of a part per day and subcorpus.
+    :param model: A fitted topic model.
+    :param part: A Part.
+    :param labels: A list of topic labels as returned by topic_labels().
+    :return: A dictionary mapping subcorpus names to pandas DataFrames in the layout of
+    metrics.daily_counts() with the columns "num_posts", "num_words", "<topic>_posts" and "<topic>_mentions".
+    """
+    subcorpus_codes = np.full(len(OUTLET_NAMES) + 1, -1, dtype=np.int8)
+    for code, name in enumerate(metrics.SUBCORPORA):
+        for outlet in metrics.SUBCORPORA[name][1]:
+            subcorpus_codes[OUTLET_NAMES.index(outlet)] = code
+    columns = ["num_posts", "num_words"] + [label + "_posts" for label in labels] + \
+        [label + "_mentions" for label in labels]
+    frames = []
+    for start, end in part.batches():
+        shares = topic_shares(model, part.rows(start, end))
+        num_words = np.asarray(part.num_words[start:end], dtype="float")
+        counts = pd.DataFrame(np.hstack([np.ones((end - start, 1)), num_words[:, None], shares,
+                                         shares * num_words[:, None]]), columns=columns)
+        counts["subcorpus"] = subcorpus_codes[np.asarray(part.outlets[start:end])]
+        counts["date"] = np.asarray(part.days[start:end]).astype("datetime64[D]")
+        frames.append(counts.groupby(["subcorpus", "date"]).sum())
+    counts = pd.concat(frames).groupby(level=[0, 1]).sum() if frames else \
+        pd.DataFrame(columns=columns, index=pd.MultiIndex.from_arrays([[], []], names=["subcorpus", "date"]))
+    # Columns in the order of metrics.daily_counts()
+    order = ["num_posts", "num_words"] + [label + suffix for label in labels for suffix in ["_posts", "_mentions"]]
+    daily = {}
+    for code, name in enumerate(metrics.SUBCORPORA):
+        frame = counts[counts.index.get_level_values("subcorpus") == code].droplevel("subcorpus")
+        frame.index = pd.DatetimeIndex(frame.index, name="date")
+        daily[name] = frame[order].astype("float")
+    return daily
+
+
+def top_terms(model, vocabulary, labels, num_terms=NUM_TERMS):
+    """
+    A method to get the top terms of each topic.
+    :param model: A fitted topic model.
+    :param vocabulary: A numpy array of terms.
+    :param labels: A list of topic labels.
+    :param num_terms: The number of terms per topic.
+    :return: A pandas DataFrame with the columns "topic", "rank", "term" and "weight".
+    """
+    weights = model.components_ / model.components_.sum(axis=1, keepdims=True)
+    top = np.argsort(-weights, axis=1)[:, :num_terms]
+    return pd.DataFrame({
+        "topic": np.repeat(labels, top.shape[1]),
+        "rank": np.tile(np.arange(1, top.shape[1] + 1), len(labels)),
+        "term": vocabulary[top].ravel(),
+        "weight": np.take_along_axis(weights, top, axis=1).ravel(),
+    })
+
+
+def save_model(model_dir, model, meta):
+    """A method to store the topic model and its settings."""
+    with open(Path(model_dir) / "model.pickle", "wb") as f:
+        pickle.dump(model, f)
+    with open(Path(model_dir) / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def load_model(model_dir):
+    """
+    A method to load the topic model and its settings stored with save_model().
+    :param model_dir: The model directory.
+    :return: A tuple of the model, a dictionary of settings and the numpy array of terms.
+    """
+    model_dir = Path(model_dir)
+    if not (model_dir / "model.pickle").exists():
+        sys.exit("No topic model stored in " + str(model_dir) + ". Run the command fit first.")
+    with open(model_dir / "model.pickle", "rb") as f:
+        model = pickle.load(f)
+    with open(model_dir / "meta.json", encoding="utf-8") as f:
+        meta = json.load(f)
+    return model, meta, np.load(model_dir / "vocabulary.npy")
+
+
+def part_dirs(model_dir):
+    """A method to list the part directories of a model directory in order."""
+    return sorted(path for path in (Path(model_dir) / "parts").glob("*") if path.is_dir())
+
+
+def topic_metrics(daily, labels, fn_rtsi, time_slice, path, alignment="calendar"):
+    """
+    A method to calculate post and word level metrics of topics and save them in the layout of the country metrics.
+    :param daily: A dictionary mapping subcorpus names to pandas DataFrames of daily counts.
+    :param labels: A list of topic labels.
+    :param fn_rtsi: Path to the RTSI Excel file.
+    :param time_slice: The length of a time slice in days.
+    :param path: The output directory.
+    :param alignment: The alignment policy of the time slices, "calendar" or "trading".
+    """
+    rtsi = metrics.load_rtsi(fn_rtsi)
+    calendar = metrics.SliceCalendar(rtsi, time_slice, alignment)
+    res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+    results = {}
+    for name, counts in daily.items():
+        counts = metrics.slice_counts(counts, calendar)
+        results[name] = metrics.slice_metrics(counts, res_rtsi, labels)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    metrics.save_results(results, calendar, path, labels)
+
+
+def main(argv=None):
+    """
+    A method to fit, update or apply the topic model from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Track the topics of posts per time slice.")
+    parser.add_argument("command", choices=["fit", "update", "shares"],
+                        help="fit a new model, update it with new posts or recompute the topic shares of all posts")
+    parser.add_argument("--input", help="Final CSV file of merged posts (fit, update)")
+    parser.add_argument("--model", default=MODEL_DIR, help="Model directory")
+    parser.add_argument("--column", default="text", help="Column of tokens, e.g. lemmas of <lemmatize.py> (fit)")
+    parser.add_argument("--method", choices=["lda", "nmf"], default="lda", help="Topic model (fit)")
+    parser.add_argument("--topics", type=int, default=NUM_TOPICS, help="Number of topics (fit)")
+    parser.add_argument("--max-features", type=int, default=MAX_FEATURES, help="Maximum vocabulary size (fit)")
+    parser.add_argument("--min-df", type=int, default=MIN_DF, help="Minimum number of posts of a term (fit)")
+    parser.add_argument("--passes", type=int, default=1, help="Number of passes over the posts (fit)")
+    parser.add_argument("--rtsi", help="RTSI Excel file; if given, the topic metrics are calculated")
+    parser.add_argument("--time-slice", type=int, default=7, help="Length of a time slice in days")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI (metrics)")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+    model_dir = Path(args.model)
+
+    if args.command == "fit":
+        model_dir.mkdir(parents=True, exist_ok=True)
+        for path in part_dirs(model_dir):
+            for fn in path.glob("*.npy"):
+                fn.unlink()
+            path.rmdir()
+        with span("vocabulary"):
+            vocabulary = build_vocabulary(args.input, args.column, args.max_features, args.min_df)
+            np.save(model_dir / "vocabulary.npy", vocabulary)
+        print("Vocabulary of " + str(len(vocabulary)) + " terms.")
+        meta = {"method": args.method, "topics": args.topics, "column": args.column, "terms": len(vocabulary)}
+        model = create_model(args.method, args.topics)
+    else:
+        model, meta, vocabulary = load_model(model_dir)
+    labels = topic_labels(meta["topics"])
+
+    daily = {name: None for name in metrics.SUBCORPORA}
+    if args.command in ["fit", "update"]:
+        part_dir = model_dir / "parts" / str(len(part_dirs(model_dir))).zfill(3)
+        with span("document_term_matrix") as build:
+            build.rows = build_part(args.input, vocabulary, part_dir, meta["column"])
+        part = Part(part_dir, len(vocabulary))
+        with span("partial_fit", rows=len(part)) as fit:
+            fit.args["batches"] = fit_part(model, part, args.time_slice, args.passes if args.command == "fit" else 1)
+        save_model(model_dir, model, meta)
+        parts = [part]
+        if args.command == "update":
+            daily = {name: metrics.load_daily_counts(model_dir, name) for name in metrics.SUBCORPORA}
+    else:
+        parts = [Part(path, len(vocabulary)) for path in part_dirs(model_dir)]
+
+    for part in parts:
+        with span("topic_shares", rows=len(part)):
+            for name, counts in part_daily_counts(model, part, labels).items():
+                daily[name] = metrics.add_daily_counts(daily[name], counts)
+    for name, counts in daily.items():
+        metrics.save_daily_counts(counts, model_dir, name)
+    top_terms(model, vocabulary, labels).to_csv(model_dir / "topic_terms.csv", index=False, encoding="utf-8")
+
+    if args.rtsi:
+        path = Path(RESULTS_DIR + str(args.time_slice) + "days/")
+        with span("topic_metrics", rows=len(labels)):
+            topic_metrics(daily, labels, args.rtsi, args.time_slice, path, args.alignment)
+        print("Topic metrics saved to " + str(path))
+    print("Topic model saved to " + str(model_dir))
+    print("Time consumption topic model: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to ingest a live stream of VK posts and keep the daily counts per outlet up to date.
+
+In more detail, this module is used for near-live agenda monitoring. It runs as a long-running daemon:
+1. A reader thread tails a JSONL file of new posts (one post per line with the columns of the raw corpus,
+   e.g. {"ID": "-26284064_13875", "from_id": -26284064, "owner_id": -26284064, "text": "...",
+   "date": 1516147730}) or accepts posts on a Unix socket. The posts are put into a bounded queue;
+   when the queue is full, the reader blocks, so that a fast feed is slowed down instead of filling the memory.
+2. The main thread takes micro-batches of up to BATCH_SIZE posts (waiting at most BATCH_WAIT seconds),
+   preprocesses them as <preprocess_text.py> does, and tags their countries.
+3. The daily counts per outlet (cf. <calculate_metrics_prct_change.py>) are updated in memory. Their size
+   depends on the number of days and outlets only, not on the number of posts.
+4. Every CHECKPOINT_INTERVAL seconds and at shutdown, the state (daily counts and the offset in the input file)
+   is checkpointed atomically to state.pickle. The daily counts per outlet and subcorpus are exported
+   in the layout of the metrics (daily_counts/daily_counts_<name>.csv, e.g. for <lead_lag.py> with --counts),
+   and the normalized post and word level coverage of the latest day to coverage.csv.
+After a restart, the daemon continues at the checkpointed offset of the input file. Posts received on
+the socket after the last checkpoint are lost if the daemon is killed.
+
+NER is too slow for a live feed. Instead, countries are tagged by matching the names of COUNTRY_GROUPS
+against the preprocessed tokens: a name matches tokens starting with it, e.g. "украин" matches "украины",
+names of up to SHORT_NAME characters (e.g. "иг", "рф") only match whole tokens, and names of several words
+match consecutive tokens. Each match counts as one country mention. The live counts are therefore an
+approximation of the counts based on NER.
+
+Examples:
+python3 code/src/utils/ingestion_daemon.py --input code/data/media_posts_live.jsonl
+python3 code/src/utils/ingestion_daemon.py --socket /tmp/agenda-setting-ingest.sock
+"""
+import argparse
+import json
+import os
+import pickle
+import queue
+import re
+import signal
+import socketserver
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path[0:0] = [
+    str(Path(__file__).resolve().parent / "text_preprocessing"),
+    str(Path(__file__).resolve().parent / "calculations"),
+]
+import calculate_metrics_prct_change as metrics  # noqa: E402
+import preprocess_text  # noqa: E402
+from country_groups import COUNTRY_GROUPS  # noqa: E402
+from instrumentation import configure, count, gauge, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+pd = lazy_import("pandas")
+
+STATE_DIR = "code/data/live/"
+QUEUE_SIZE = 10000  # Maximum number of posts waiting to be processed
+BATCH_SIZE = 1000  # Maximum number of posts per micro-batch
+BATCH_WAIT = 1.0  # Maximum number of seconds to wait for a micro-batch to fill up
+CHECKPOINT_INTERVAL = 5.0  # Seconds between checkpoints
+POLL_INTERVAL = 0.5  # Seconds between checks for new lines of the input file
+SHORT_NAME = 2  # Names of up to this length only match whole tokens
+COLUMNS = ["ID", "from_id", "owner_id", "text", "date"]
+
+
+def country_pattern(groups=COUNTRY_GROUPS):
+    """
+    A method to compile the country names into a single regular expression.
+    :param groups: A dictionary mapping countries to sets of names as COUNTRY_GROUPS.
+    :return: A tuple of the compiled pattern, whose first group is the matched name, and
+    a dictionary mapping the lowercased names to their country.
+    """
+    names = {}
+    for country, group_names in groups.items():
+        for name in group_names:
+            # Hyphens are removed by the preprocessing. If a name belongs to several countries,
+            # the last one is used, as in merge_labels.collapse_labels()
+            names[name.lower().replace("-", " ")] = country
+    # Longer names are tried first, e.g. "российская федерация" before "росс"
+    alternatives = [re.escape(name) + (r"(?!\w)" if len(name) <= SHORT_NAME else "")
+                    for name in sorted(names, key=len, reverse=True)]
+    return re.compile(r"(?<!\w)(" + "|".join(alternatives) + r")\w*"), names
+
+
+def tag_countries(texts, pattern, names):
+    """
+    A method to count the country mentions in preprocessed texts.
+    :param texts: A pandas Series of preprocessed texts with a unique index.
+    :param pattern: A compiled pattern as returned by country_pattern().
+    :param names: A dictionary mapping names to countries as returned by country_pattern().
+    :return: A pandas DataFrame with the index of texts and a column with the number of mentions of each country.
+    """
+    mentions = texts.str.findall(pattern).explode().dropna().map(names)
+    counts = mentions.groupby([mentions.index, mentions.to_numpy()]).size().unstack(fill_value=0)
+    return counts.reindex(index=texts.index, columns=metrics.COUNTRIES, fill_value=0).astype("float")
+
+
+def parse_posts(lines):
+    """
+    A method to parse JSONL lines of raw posts.
+    :param lines: A list of JSON strings or bytes.
+    :return: A pandas DataFrame with the columns of the raw corpus and a datetime column "date".
+    Malformed lines and posts without ID, text or date are skipped.
+    """
+    posts = []
+    for line in lines:
+        try:
+            post = json.loads(line)
+            if all(post.get(column) is not None for column in ["ID", "text", "date"]):
+                posts.append(post)
+                continue
+        except (ValueError, AttributeError):
+            pass
+        count("malformed_posts")
+    df = pd.DataFrame(posts, columns=COLUMNS)
+    df["ID"] = df["ID"].astype(str)
+    df["date"] = pd.to_datetime(df["date"], unit="s")
+    return df
+
+
+def label_posts(df, nlp, pattern, names):
+    """
+    A method to preprocess posts and tag their countries.
+    :param df: A pandas DataFrame of raw posts as returned by parse_posts().
+    :param nlp: A spacy Language object as returned by preprocess_text.load_tokenizer().
+    :param pattern: A compiled pattern as returned by country_pattern().
+    :param names: A dictionary mapping names to countries as returned by country_pattern().
+    :return: A pandas DataFrame with a DatetimeIndex as described in metrics.daily_counts().
+    """
+    df = preprocess_text.preprocess(df.reset_index(drop=True), nlp)
+    with span("tag_countries", rows=len(df)):
+        corpus = pd.concat([df, tag_countries(df["text"], pattern, names)], axis=1)
+    return corpus.set_index("date")
+
+
+class LiveCounts:
+    """In-memory daily counts per outlet with atomic checkpoints."""
+
+    def __init__(self, state_dir=STATE_DIR):
+        self.state_dir = Path(state_dir)
+        self.daily = {outlet: None for outlet in metrics.OUTLETS}
+        self.input = None
+        self.offset = 0
+        self.posts = 0
+
+    def load(self):
+        """A method to restore the last checkpoint, if any."""
+        fn = self.state_dir / "state.pickle"
+        if fn.exists():
+            with open(fn, "rb") as f:
+                state = pickle.load(f)
+            self.daily, self.input, self.offset, self.posts = (state["daily"], state["input"], state["offset"],
+                                                               state["posts"])
+
+    def add(self, corpus):
+        """
+        A method to add the counts of labeled posts.
+        :param corpus: A pandas DataFrame as returned by label_posts().
+        """
+        outlets = metrics.post_outlets(corpus)
+        for name in self.daily:
+            selected = corpus[outlets == name]
+            if len(selected):
+                self.daily[name] = metrics.add_daily_counts(self.daily[name], metrics.daily_counts(selected))
+        self.posts += len(corpus)
+
+    def subcorpora(self):
+        """A method to sum up the daily counts of the outlets of each subcorpus."""
+        daily = {}
+        for name, (_, outlets) in metrics.SUBCORPORA.items():
+            daily[name] = None
+            for outlet in outlets:
+                if self.daily[outlet] is not None:
+                    daily[name] = metrics.add_daily_counts(daily[name], self.daily[outlet])
+        return daily
+
+    def coverage(self):
+        """
+        A method to calculate the normalized post and word level coverage of the latest day.
+        :return: A pandas DataFrame with one row per outlet and subcorpus and the columns "date", "name",
+        "num_posts", "<country>_psts" and "<country>_wrds".
+        """
+        rows = []
+        for name, daily in {**self.daily, **self.subcorpora()}.items():
+            if daily is None or not len(daily):
+                continue
+            latest = daily.iloc[-1]
+            row = {"date": daily.index[-1], "name": name, "num_posts": latest["num_posts"]}
+            for country in metrics.COUNTRIES:
+                row[country + "_psts"] = latest[country + "_posts"] / latest["num_posts"]
+                row[country + "_wrds"] = latest[country + "_mentions"] / latest["num_words"] \
+                    if latest["num_words"] else 0.0
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def checkpoint(self):
+        """
+        A method to write the state and export the daily counts and the latest coverage.
+        All files are replaced atomically, so that readers never see a partially written file.
+        """
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        state = {"daily": self.daily, "input": self.input, "offset": self.offset, "posts": self.posts}
+        replace_file(self.state_dir / "state.pickle", lambda f: pickle.dump(state, f), "wb")
+        for name, daily in {**self.daily, **self.subcorpora()}.items():
+            if daily is not None:
+                fn = metrics.daily_counts_file(self.state_dir, name)
+                fn.parent.mkdir(parents=True, exist_ok=True)
+                replace_file(fn, lambda f: daily.to_csv(f), "w")
+        coverage = self.coverage()
+        replace_file(self.state_dir / "coverage.csv", lambda f: coverage.to_csv(f, index=False), "w")
+
+
+def replace_file(fn, write, mode):
+    """
+    A method to write a file atomically, so that readers never see a partially written file.
+    :param fn: The path of the file.
+    :param write: A function writing the content to a file object.
+    :param mode: The file mode, "w" or "wb".
+    """
+    tmp = Path(str(fn) + ".tmp")
+    with open(tmp, mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fn)
+
+
+def put(posts, item, stop):
+    """
+    A method to put an item into the bounded queue, blocking while it is full.
+    :param posts: The queue.
+    :param item: A tuple of the offset after the line (None for the socket) and the line.
+    :param stop: A threading.Event set at shutdown.
+    :return: Whether the item was put before shutdown.
+    """
+    while not stop.is_set():
+        try:
+            posts.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def tail_file(fn, offset, posts, stop, done, once=False):
+    """
+    A method to put the lines of a growing JSONL file into the queue.
+    :param fn: Path to the JSONL file.
+    :param offset: The byte offset to start at.
+    :param posts: The queue.
+    :param stop: A threading.Event set at shutdown.
+    :param done: A threading.Event set when the reader has finished.
+    :param once: Whether to finish at the end of the file instead of waiting for new lines.
+    """
+    while not Path(fn).exists() and not stop.is_set():
+        time.sleep(POLL_INTERVAL)
+    with open(fn, "rb") as f:
+        f.seek(offset)
+        while not stop.is_set():
+            if os.fstat(f.fileno()).st_size < offset:
+                # The file was truncated, start again at its beginning
+                offset = 0
+                f.seek(0)
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                # Wait until the line is completely written
+                f.seek(offset)
+                if once:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            offset += len(line)
+            if line.strip() and not put(posts, (offset, line), stop):
+                break
+    done.set()
+
+
+class PostHandler(socketserver.StreamRequestHandler):
+    """A handler putting the JSON lines sent on a socket connection into the queue of the server."""
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() and not put(self.server.posts, (None, line), self.server.stop):
+                break
+
+
+def serve_socket(path, posts, stop):
+    """
+    A method to start accepting posts on a Unix socket in a background thread.
+    :param path: The path of the Unix socket.
+    :param posts: The queue.
+    :param stop: A threading.Event set at shutdown.
+    :return: The socketserver.ThreadingUnixStreamServer.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, PostHandler)
+    server.daemon_threads = True
+    server.posts, server.stop = posts, stop
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def next_batch(posts, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+    """
+    A method to take a micro-batch from the queue.
+    :param posts: The queue.
+    :param batch_size: The maximum number of posts.
+    :param batch_wait: The maximum number of seconds to wait after the first post.
+    :return: A list of (offset, line) tuples, empty if no post arrived within POLL_INTERVAL seconds.
+    """
+    try:
+        batch = [posts.get(timeout=POLL_INTERVAL)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + batch_wait
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(posts.get(timeout=remaining) if remaining > 0 else posts.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def main(argv=None):
+    """
+    A method to run the ingestion daemon from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Ingest a live stream of posts into daily counts.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="JSONL file of new posts to tail")
+    source.add_argument("--socket", help="Unix socket to accept JSONL posts on")
+    parser.add_argument("--state", default=STATE_DIR, help="Directory of the checkpoints and exported counts")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Maximum number of posts per micro-batch")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="Maximum number of waiting posts")
+    parser.add_argument("--checkpoint-interval", type=float, default=CHECKPOINT_INTERVAL,
+                        help="Seconds between checkpoints")
+    parser.add_argument("--once", action="store_true",
+                        help="Stop at the end of the input file instead of waiting for new posts")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    stop, done = threading.Event(), threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *_: stop.set())
+
+    counts = LiveCounts(args.state)
+    counts.load()
+    with span("load_model"):
+        nlp = preprocess_text.load_tokenizer()
+    pattern, names = country_pattern()
+    posts = queue.Queue(maxsize=args.queue_size)
+    server = None
+    if args.input:
+        if counts.input != str(args.input):
+            counts.input, counts.offset = str(args.input), 0
+        threading.Thread(target=tail_file, args=(args.input, counts.offset, posts, stop, done, args.once),
+                         daemon=True).start()
+        print("Tailing " + args.input + " from offset " + str(counts.offset) + ".")
+    else:
+        server = serve_socket(args.socket, posts, stop)
+        print("Accepting posts on " + args.socket + ".")
+
+    last_checkpoint = time.monotonic()
+    while not stop.is_set() and not (done.is_set() and posts.empty()):
+        batch = next_batch(posts, args.batch_size)
+        if batch:
+            gauge("queue_size", posts.qsize())
+            with span("batch", rows=len(batch)):
+                df = parse_posts([line for _, line in batch])
+                if len(df):
+                    counts.add(label_posts(df, nlp, pattern, names))
+            offsets = [offset for offset, _ in batch if offset is not None]
+            if offsets:
+                counts.offset = offsets[-1]
+        if time.monotonic() - last_checkpoint >= args.checkpoint_interval:
+            with span("checkpoint"):
+                counts.checkpoint()
+            last_checkpoint = time.monotonic()
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + ": " + str(counts.posts) + " posts ingested, "
+                  + str(posts.qsize()) + " waiting.", flush=True)
+
+    stop.set()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        os.unlink(args.socket)
+    with span("checkpoint"):
+        counts.checkpoint()
+    print(str(counts.posts) + " posts ingested. State saved to " + str(args.state))
+    print("Time consumption ingestion: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
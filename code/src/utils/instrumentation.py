@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to instrument the pipeline modules.
+
+In more detail, this module provides
+- nested timing spans, e.g. load, normalize, tokenize, API call, sleep, explode, join, write,
+- row counts per span to derive throughput (rows/sec),
+- the peak resident set size (RSS) at the end of each span, sampled at the end of top-level spans and
+  at most every 0.1 seconds otherwise, as reading it costs more than the rest of a span,
+- counters and gauges, e.g. the number of API requests and the remaining API quota.
+
+Aggregated statistics per span are always collected, as they only cost a few microseconds per span.
+Individual events are only kept if a trace file is configured, either with the --trace option of
+the pipeline modules or the environment variable AGENDA_SETTING_TRACE. At exit, the trace file is
+written in the Chrome trace event format (open with chrome://tracing or https://ui.perfetto.dev),
+together with a machine-readable summary of the aggregated statistics in the key "summary".
+
+Example:
+    with span("tokenize", rows=len(texts)):
+        tokenized = tokenize_texts(texts, nlp)
+"""
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+TRACE_ENV = "AGENDA_SETTING_TRACE"
+# Maximum number of events kept in memory for the trace file, later events are only aggregated
+MAX_EVENTS = 100000
+# Minimum time between two samples of the peak RSS at the end of nested spans in nanoseconds
+RSS_INTERVAL = 100000000
+
+
+def peak_rss_mb():
+    """A method to get the peak resident set size of the current process in MB."""
+    # On Linux, ru_maxrss survives exec and would include the memory of the parent process,
+    # whereas VmHWM is the peak of the current process image only
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class Span:
+    """A timing span, to be used as context manager. Set rows to report the throughput."""
+
+    __slots__ = ("tracer", "name", "path", "rows", "args", "start")
+
+    def __init__(self, tracer, name, rows, args):
+        self.tracer = tracer
+        self.name = name
+        self.rows = rows
+        self.args = args
+        self.path = name
+        self.start = 0
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if stack:
+            self.path = stack[-1].path + "/" + self.name
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        stack = self.tracer.stack()
+        stack.pop()
+        self.tracer.record(self, end, exc_type is not None, not stack)
+        return False
+
+
+class Tracer:
+    """A collector of spans, counters and gauges."""
+
+    def __init__(self):
+        self.trace = None
+        self.events = []
+        self.dropped = 0
+        self.stats = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+        # Last sample of the peak RSS and its time
+        self.rss = 0.0
+        self.rss_time = None
+
+    def configure(self, trace=None):
+        """
+        A method to enable writing a trace file at exit.
+        :param trace: Path of the trace file. Defaults to the environment variable AGENDA_SETTING_TRACE.
+        """
+        trace = trace or os.environ.get(TRACE_ENV)
+        if trace and self.trace is None:
+            atexit.register(self.write)
+        self.trace = trace
+
+    def reset(self):
+        """A method to discard all spans, counters and gauges, e.g. between commands of a long-running process."""
+        with self.lock:
+            self.events = []
+            self.dropped = 0
+            self.stats = {}
+            self.counters = {}
+            self.gauges = {}
+            self.origin = time.perf_counter_ns()
+        if self.trace is not None:
+            atexit.unregister(self.write)
+        self.trace = None
+
+    def stack(self):
+        """A method to get the stack of open spans of the current thread."""
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name, rows=None, **args):
+        """
+        A method to create a timing span.
+        :param name: The name of the span. Nested spans are aggregated by their path, e.g. "ner/api_call".
+        :param rows: Optional number of processed rows.
+        :param args: Optional additional values stored with the event in the trace file.
+        :return: A Span to be used as context manager.
+        """
+        return Span(self, name, rows, args)
+
+    def sample_rss(self, end, top_level):
+        """
+        A method to get the peak RSS at the end of a span.
+        :param end: The end of the span as returned by time.perf_counter_ns().
+        :param top_level: Whether the span is a top-level span, whose peak RSS is always sampled.
+        :return: A tuple of the peak RSS in MB and whether it was sampled now.
+        """
+        if top_level or self.rss_time is None or end - self.rss_time >= RSS_INTERVAL:
+            self.rss = peak_rss_mb()
+            self.rss_time = end
+            return self.rss, True
+        return self.rss, False
+
+    def record(self, span, end, failed, top_level=True):
+        """A method to aggregate a finished span and keep its event if a trace file is configured."""
+        duration = end - span.start
+        rss, sampled = self.sample_rss(end, top_level)
+        with self.lock:
+            stats = self.stats.get(span.path)
+            if stats is None:
+                stats = self.stats[span.path] = {"count": 0, "seconds": 0.0, "rows": 0, "peak_rss_mb": 0.0,
+                                                 "failed": 0}
+            stats["count"] += 1
+            stats["seconds"] += duration / 1e9
+            stats["rows"] += span.rows or 0
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], rss)
+            stats["failed"] += failed
+            if self.trace is None:
+                return
+            if len(self.events) >= MAX_EVENTS:
+                self.dropped += 1
+                return
+            args = dict(span.args, path=span.path)
+            if span.rows is not None:
+                args["rows"] = span.rows
+            self.events.append({
+                "name": span.name, "cat": span.path.split("/")[0], "ph": "X", "pid": self.pid,
+                "tid": threading.get_ident(), "ts": (span.start - self.origin) / 1e3, "dur": duration / 1e3,
+                "args": args,
+            })
+            if not sampled:
+                return
+            self.events.append({
+                "name": "peak_rss_mb", "ph": "C", "pid": self.pid, "ts": (end - self.origin) / 1e3,
+                "args": {"peak_rss_mb": rss},
+            })
+
+    def count(self, name, value=1):
+        """A method to increase a counter, e.g. the number of API requests."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """A method to set a gauge to its current value, e.g. the remaining API quota."""
+        with self.lock:
+            self.gauges[name] = value
+            if self.trace is not None and len(self.events) < MAX_EVENTS:
+                self.events.append({
+                    "name": name, "ph": "C", "pid": self.pid,
+                    "ts": (time.perf_counter_ns() - self.origin) / 1e3, "args": {name: value},
+                })
+
+    def summary(self):
+        """
+        A method to summarize all spans, counters and gauges.
+        :return: A dictionary with statistics per span path including the throughput in rows/sec.
+        """
+        with self.lock:
+            spans = {}
+            for path, stats in self.stats.items():
+                stats = dict(stats)
+                stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["rows"] and stats[
+                    "seconds"] else None
+                spans[path] = stats
+            return {
+                "command": " ".join(sys.argv),
+                "spans": spans,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "peak_rss_mb": peak_rss_mb(),
+                "dropped_events": self.dropped,
+            }
+
+    def write(self, fn=None):
+        """
+        A method to write the trace file with all kept events and the summary.
+        :param fn: Path of the trace file. Defaults to the configured trace file.
+        """
+        fn = fn or self.trace
+        if fn is None:
+            return
+        summary = self.summary()
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms", "summary": summary}
+        with open(fn, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+
+
+# Shared tracer of the current process
+TRACER = Tracer()
+configure = TRACER.configure
+span = TRACER.span
+count = TRACER.count
+gauge = TRACER.gauge
+summary = TRACER.summary
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to import the numerical libraries of the pipeline modules on first use.
+
+In more detail, this module is used to keep the start of the command line interface <agenda_setting.py> fast:
+the pipeline modules import numpy, pandas and scipy with lazy_import() instead of an import statement, so that
+e.g. "agenda-setting bursts --help" shows the options of a subcommand without loading them. A module is
+imported when one of its attributes is accessed for the first time, e.g. pd.read_csv.
+
+Example:
+pd = lazy_import("pandas")
+"""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """A placeholder of a module, which imports the module when one of its attributes is accessed."""
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not copied yet, i.e. on first use
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+def lazy_import(name):
+    """
+    A method to import a module on first use.
+    :param name: The name of the module, e.g. "pandas" or "scipy.sparse".
+    :return: The module if it was already imported, otherwise a LazyModule.
+    """
+    return sys.modules.get(name) or LazyModule(name)
@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+
+# A bash script to add a new delivery of raw media posts to the existing results.
+# The new posts are preprocessed, labeled, and appended to the final merged dataframe.
+# Posts already in the final merged dataframe, e.g. of overlapping deliveries, are skipped.
+# Afterwards, only the time slices touching the dates of the appended posts are recomputed.
+# Prerequisite: run_preprocessing.sh and run_calculations.sh have been run on the existing posts.
+
+python3 code/src/utils/text_preprocessing/preprocess_text.py --input "code/data/media_posts_new.csv" --output "code/data/media_posts_new_processed.csv"
+python3 code/src/utils/text_preprocessing/ner.py --input "code/data/media_posts_new.csv" --output "code/data/media_posts_new_ner.json"
+python3 code/src/utils/text_preprocessing/merge_labels.py --input "code/data/media_posts_new_ner.json" --output "code/data/media_posts_new_ner_collapsed.csv"
+python3 code/src/utils/text_preprocessing/merge_ner_and_posts.py --input "code/data/media_posts_new_processed.csv" "code/data/media_posts_new_ner_collapsed.csv" --output "code/data/media_posts_processed_final.csv" --append --new-output "code/data/media_posts_new_processed_final.csv"
+
+python3 code/src/utils/calculations/calculate_metrics_prct_change.py code/data/media_posts_new_processed_final.csv code/data/rtsi_topics.xlsx 7 --append
+python3 code/src/utils/calculations/calculate_metrics_prct_change.py code/data/media_posts_new_processed_final.csv code/data/rtsi_topics.xlsx 5 --append
+python3 code/src/utils/calculations/calculate_metrics_prct_change.py code/data/media_posts_new_processed_final.csv code/data/rtsi_topics.xlsx 3 --append
+python3 code/src/utils/calculations/calculate_metrics_prct_change.py code/data/media_posts_new_processed_final.csv code/data/rtsi_topics.xlsx 1 --append
+
+python3 code/src/utils/calculations/burst_detection.py --stream
+
+exit
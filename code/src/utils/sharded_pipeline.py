@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to run the pipeline on shards of the corpus in several processes or on several hosts.
+
+In more detail, this module is used to process multi-year VK dumps that a single process cannot keep up with.
+The corpus is partitioned by outlet and month on a (shared) file system and processed in three steps:
+1. split: the raw posts (or already preprocessed posts with --processed) and the NER results of <ner.py>
+   are partitioned into one directory per outlet and month, e.g. shards/tass_2018-01/. The shards of the
+   split are listed in shards.json; shards of earlier splits that are not listed are ignored by later steps.
+2. work: each shard is preprocessed (<preprocess_text.py>), its labels are collapsed and merged
+   (<merge_labels.py>, <merge_ner_and_posts.py>), and its daily counts per subcorpus and outlet are stored
+   (cf. <calculate_metrics_prct_change.py>). Any number of worker processes on any number of hosts can work
+   on the same shard directory: a worker claims a shard by creating its lock file exclusively and marks it
+   as done when all outputs are written. Workers skip shards that are locked or done. While a shard is
+   processed, its worker touches the lock every HEARTBEAT seconds. With --stale, a lock that was not touched
+   for longer, e.g. after a host crashed, is taken over by moving it aside atomically, so only one worker
+   succeeds; a worker that lost its lock does not mark the shard as done.
+3. reduce: the daily counts of all shards are summed up and the time slice metrics and percent change
+   values are calculated and saved as by <calculate_metrics_prct_change.py>. As the daily counts are
+   sums of counts, the results are identical to a single-process run.
+
+Near-duplicate detection (<near_duplicates.py>) needs all posts at once and is not supported on shards.
+
+Examples:
+python3 code/src/utils/sharded_pipeline.py split --input code/data/media_posts.csv --ner code/data/media_posts_ner.json
+python3 code/src/utils/sharded_pipeline.py work --processes 4
+python3 code/src/utils/sharded_pipeline.py reduce --rtsi code/data/rtsi_topics.xlsx --time-slices 7 5 3 1
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import shutil
+import threading
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path[0:0] = [
+    str(Path(__file__).resolve().parent / "text_preprocessing"),
+    str(Path(__file__).resolve().parent / "calculations"),
+]
+import calculate_metrics_prct_change as metrics  # noqa: E402
+import merge_labels  # noqa: E402
+import merge_ner_and_posts  # noqa: E402
+import preprocess_text  # noqa: E402
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+pd = lazy_import("pandas")
+
+SHARDS_DIR = "code/data/shards/"
+CHUNK_SIZE = 100000
+RAW_POSTS = "media_posts.csv"
+PROCESSED_POSTS = "media_posts_processed.csv"
+NER_RESULTS = "media_posts_ner.json"
+COLLAPSED_LABELS = "media_posts_ner_collapsed.csv"
+FINAL_POSTS = "media_posts_processed_final.csv"
+MANIFEST_FILE = "shards.json"
+LOCK_FILE = "lock"
+DONE_FILE = "done"
+ERROR_FILE = "error.txt"
+HEARTBEAT = 10  # Seconds between touches of the lock of a shard in progress
+
+
+def shard_keys(posts):
+    """
+    A method to get the shard of each post.
+    :param posts: A pandas DataFrame of posts with a column "ID" and a column "date"
+    (unix timestamps or dates).
+    :return: A pandas Series of shard names "<outlet>_<YYYY-MM>" ("other_<YYYY-MM>" for other owners).
+    """
+    outlets = pd.Series(metrics.post_outlets(posts), index=posts.index).replace("", "other")
+    dates = posts["date"]
+    dates = pd.to_datetime(dates, unit="s") if pd.api.types.is_numeric_dtype(dates) else pd.to_datetime(dates)
+    return outlets + "_" + dates.dt.strftime("%Y-%m")
+
+
+def split_corpus(fn_posts, fn_ner, shards_dir=SHARDS_DIR, processed=False):
+    """
+    A method to partition posts and NER results into shards by outlet and month.
+    The posts are read in chunks; all files of existing shards with the same name are removed, and only
+    the shards of this split are listed in the manifest.
+    :param fn_posts: Path to the raw posts (tab-separated) or, if processed, to the CSV file of <preprocess_text.py>.
+    :param fn_ner: Path to the JSON file created by <ner.py>.
+    :param shards_dir: The shard directory.
+    :param processed: Whether the posts are already preprocessed.
+    :return: A dictionary mapping shard names to their number of posts.
+    """
+    shards_dir = Path(shards_dir)
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    # Workers and the reduce step only see the shards of a complete split
+    (shards_dir / MANIFEST_FILE).unlink(missing_ok=True)
+    name, sep = (PROCESSED_POSTS, ",") if processed else (RAW_POSTS, "\t")
+    sizes, shard_of = {}, {}
+    for chunk in pd.read_csv(fn_posts, encoding="utf-8", sep=sep, dtype={"ID": str}, chunksize=CHUNK_SIZE):
+        keys = shard_keys(chunk)
+        shard_of.update(zip(chunk["ID"], keys))
+        for key, posts in chunk.groupby(keys, sort=False):
+            path = shards_dir / key
+            if key not in sizes:
+                # Outputs of an earlier split, e.g. daily counts of subcorpora without posts now, must not remain
+                shutil.rmtree(path, ignore_errors=True)
+                path.mkdir(parents=True)
+            posts.to_csv(path / name, sep=sep, index=False, mode="a", header=key not in sizes)
+            sizes[key] = sizes.get(key, 0) + len(posts)
+
+    with open(fn_ner, encoding="utf-8") as f:
+        ner = json.load(f)
+    ner_shards = {key: {} for key in sizes}
+    for post_id, entities in ner.items():
+        if post_id in shard_of:
+            ner_shards[shard_of[post_id]][post_id] = entities
+    for key, entities in ner_shards.items():
+        with open(shards_dir / key / NER_RESULTS, "w", encoding="utf-8") as f:
+            json.dump(entities, f, ensure_ascii=False)
+    with open(shards_dir / (MANIFEST_FILE + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(sorted(sizes), f)
+    os.replace(shards_dir / (MANIFEST_FILE + ".tmp"), shards_dir / MANIFEST_FILE)
+    return sizes
+
+
+def process_shard(path):
+    """
+    A method to preprocess, label and count the posts of a shard.
+    :param path: The directory of the shard.
+    """
+    path = Path(path)
+    if (path / RAW_POSTS).exists():
+        with span("preprocess"):
+            df = preprocess_text.load_posts(path / RAW_POSTS)
+            df = preprocess_text.preprocess(df, preprocess_text.load_tokenizer())
+            df.to_csv(path / PROCESSED_POSTS, index=False)
+    with span("merge_labels"):
+        merge_labels.collapse_labels(merge_labels.load_ner(path / NER_RESULTS)).to_csv(
+            path / COLLAPSED_LABELS, index=False)
+    with span("merge_ner_and_posts"):
+        vk = merge_ner_and_posts.merge_labels_and_posts(
+            merge_ner_and_posts.load_posts(path / PROCESSED_POSTS),
+            merge_ner_and_posts.load_labels(path / COLLAPSED_LABELS),
+        )
+        vk.to_csv(path / FINAL_POSTS, index=False)
+    with span("daily_counts"):
+        data_all = metrics.load_posts(path / FINAL_POSTS)
+        outlets = metrics.post_outlets(data_all)
+        corpora = dict(metrics.split_subcorpora(data_all))
+        corpora.update({name: data_all[outlets == name] for name in metrics.OUTLETS})
+        for name, corpus in corpora.items():
+            # Empty counts are not stored, so that only counts of posts are summed up
+            metrics.daily_counts_file(path, name).unlink(missing_ok=True)
+            if len(corpus):
+                metrics.save_daily_counts(metrics.daily_counts(corpus), path, name)
+
+
+def claim(path, stale=None):
+    """
+    A method to claim a shard by creating its lock file exclusively.
+    :param path: The directory of the shard.
+    :param stale: Optional number of seconds without heartbeat after which the lock of an unfinished shard
+    is taken over, e.g. after a host crashed.
+    :return: The token of the lock if the shard was claimed, otherwise None.
+    """
+    lock = Path(path) / LOCK_FILE
+    token = uuid.uuid4().hex
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            owner = lock.read_text(encoding="utf-8")
+            if stale is None or time.time() - lock.stat().st_mtime < stale:
+                return None
+            # Only one worker can move the stale lock aside
+            aside = lock.with_name(LOCK_FILE + "." + token)
+            os.rename(lock, aside)
+        except FileNotFoundError:
+            return None
+        if aside.read_text(encoding="utf-8") != owner:
+            # Another worker took over the lock in the meantime, put its lock back
+            try:
+                os.link(aside, lock)
+            except FileExistsError:
+                pass
+            aside.unlink()
+            return None
+        aside.unlink()
+        return claim(path)
+    with os.fdopen(fd, "w") as f:
+        f.write(socket.gethostname() + ":" + str(os.getpid()) + ":" + token)
+    return token
+
+
+def owns(path, token):
+    """
+    A method to check whether the lock of a shard still belongs to a worker.
+    :param path: The directory of the shard.
+    :param token: The token returned by claim().
+    :return: True if the lock file exists and was written with the token.
+    """
+    try:
+        return (Path(path) / LOCK_FILE).read_text(encoding="utf-8").endswith(":" + token)
+    except FileNotFoundError:
+        return False
+
+
+def heartbeat(path, token, stop, interval=HEARTBEAT):
+    """
+    A method to touch the lock of a shard until stop is set, so that other workers do not consider it stale.
+    :param path: The directory of the shard.
+    :param token: The token returned by claim().
+    :param stop: A threading.Event set when the shard is processed.
+    :param interval: The number of seconds between touches.
+    """
+    while not stop.wait(interval) and owns(path, token):
+        try:
+            os.utime(Path(path) / LOCK_FILE)
+        except FileNotFoundError:
+            return
+
+
+def list_shards(shards_dir=SHARDS_DIR):
+    """
+    A method to list the shard directories of the last split.
+    :param shards_dir: The shard directory.
+    :return: A sorted list of paths, empty if no split is complete.
+    """
+    manifest = Path(shards_dir) / MANIFEST_FILE
+    if not manifest.exists():
+        return []
+    with open(manifest, encoding="utf-8") as f:
+        return [Path(shards_dir) / key for key in json.load(f)]
+
+
+def work(shards_dir=SHARDS_DIR, stale=None, trace=None):
+    """
+    A method to process all unclaimed shards one after another.
+    A shard that fails is unlocked and its error is written to its directory, so that it can be retried.
+    A shard whose lock was taken over by another worker in the meantime is neither unlocked nor marked as done.
+    :param shards_dir: The shard directory.
+    :param stale: Optional number of seconds without heartbeat after which locks of unfinished shards are taken over.
+    :param trace: Optional path of a trace file of this worker.
+    :return: A tuple of the numbers of processed and failed shards.
+    """
+    configure(trace)
+    processed, failed = 0, 0
+    for path in list_shards(shards_dir):
+        token = None if (path / DONE_FILE).exists() else claim(path, stale)
+        if token is None:
+            continue
+        start_time = time.time()
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(path, token, stop), daemon=True)
+        beat.start()
+        try:
+            with span("shard", shard=path.name):
+                process_shard(path)
+        except Exception:
+            (path / ERROR_FILE).write_text(traceback.format_exc(), encoding="utf-8")
+            if owns(path, token):
+                (path / LOCK_FILE).unlink(missing_ok=True)
+            print("Shard " + path.name + " failed, see " + str(path / ERROR_FILE))
+            failed += 1
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        if not owns(path, token):
+            print("Lock of shard " + path.name + " was taken over by another worker, the shard is left to it.")
+            continue
+        (path / ERROR_FILE).unlink(missing_ok=True)
+        done = {"host": socket.gethostname(), "pid": os.getpid(), "seconds": time.time() - start_time}
+        (path / (DONE_FILE + ".tmp")).write_text(json.dumps(done), encoding="utf-8")
+        os.replace(path / (DONE_FILE + ".tmp"), path / DONE_FILE)
+        print("Shard " + path.name + " processed in %s seconds" % done["seconds"])
+        processed += 1
+    return processed, failed
+
+
+def reduce_shards(shards_dir, fn_rtsi, time_slices, fn_final=None, alignment="calendar"):
+    """
+    A method to combine the daily counts of all shards and calculate the metrics of all time slices.
+    :param shards_dir: The shard directory.
+    :param fn_rtsi: Path to the RTSI Excel file.
+    :param time_slices: A list of time slice lengths in days.
+    :param fn_final: Optional path to write the merged posts of all shards sorted by date.
+    :param alignment: The alignment policy of the time slices, "calendar" or "trading".
+    """
+    shards = list_shards(shards_dir)
+    if not shards:
+        sys.exit("No shards listed in " + str(Path(shards_dir) / MANIFEST_FILE) + ". Please run split first.")
+    pending = [path.name for path in shards if not (path / DONE_FILE).exists()]
+    if pending:
+        sys.exit("Shards not processed yet: " + ", ".join(pending))
+
+    daily = {}
+    for path in shards:
+        for name in list(metrics.SUBCORPORA) + list(metrics.OUTLETS):
+            counts = metrics.load_daily_counts(path, name)
+            if counts is not None:
+                daily[name] = metrics.add_daily_counts(daily.get(name), counts)
+    missing = [name for name in metrics.SUBCORPORA if name not in daily]
+    if missing:
+        sys.exit("No posts of subcorpus " + ", ".join(missing) + " in the shards.")
+
+    rtsi = metrics.load_rtsi(fn_rtsi)
+    for time_slice in time_slices:
+        path = Path(metrics.RESULTS_DIR + str(time_slice) + "days/")
+        path.mkdir(parents=True, exist_ok=True)
+        calendar = metrics.SliceCalendar(rtsi, time_slice, alignment)
+        res_rtsi = metrics.rtsi_slices(rtsi, calendar)
+        results = {}
+        for name in metrics.SUBCORPORA:
+            metrics.save_daily_counts(daily[name], path, name)
+            counts, _ = metrics.update_slice_counts(daily[name], None, calendar, path, name)
+            results[name] = metrics.slice_metrics(counts, res_rtsi)
+        for name in metrics.OUTLETS:
+            if name in daily:
+                metrics.save_daily_counts(daily[name], path, name)
+        metrics.save_results(results, calendar, path)
+        print("Metrics of time slice " + str(time_slice) + " saved to " + str(path))
+
+    if fn_final:
+        final = pd.concat(pd.read_csv(path / FINAL_POSTS, encoding="utf-8") for path in shards)
+        final.sort_values("date", kind="stable").to_csv(fn_final, index=False)
+        print(str(len(final)) + " merged posts saved to " + fn_final)
+
+
+def main(argv=None):
+    """
+    A method to run a step of the sharded pipeline from the terminal.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Run the pipeline on shards of the corpus.")
+    parser.add_argument("command", choices=["split", "work", "reduce"], help="Step to perform")
+    parser.add_argument("--shards", default=SHARDS_DIR, help="Shard directory (on a shared file system)")
+    parser.add_argument("--input", help="Raw posts CSV file (split)")
+    parser.add_argument("--processed", help="Preprocessed posts CSV file used instead of raw posts (split)")
+    parser.add_argument("--ner", help="NER results JSON file (split)")
+    parser.add_argument("--processes", type=int, default=1, help="Number of local worker processes (work)")
+    parser.add_argument("--stale", type=float, default=None,
+                        help="Seconds without heartbeat after which locks of unfinished shards are taken over, "
+                             "more than " + str(2 * HEARTBEAT) + " (work)")
+    parser.add_argument("--rtsi", help="RTSI Excel file (reduce)")
+    parser.add_argument("--time-slices", type=int, nargs="+", default=[7, 5, 3, 1],
+                        help="Lengths of time slices in days (reduce)")
+    parser.add_argument("--final", help="Output CSV file for the merged posts of all shards (reduce)")
+    parser.add_argument("--alignment", choices=metrics.ALIGNMENTS, default="calendar",
+                        help="Time slices of calendar days or of trading days of the RTSI (reduce)")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    if args.stale is not None and args.stale <= 2 * HEARTBEAT:
+        sys.exit("Invalid stale time: " + str(args.stale) + ".\nPlease enter more than " + str(2 * HEARTBEAT)
+                 + " seconds, so that locks of running shards are not taken over.")
+
+    if args.command == "split":
+        configure(args.trace)
+        with span("split"):
+            sizes = split_corpus(args.processed or args.input, args.ner, args.shards, args.processed is not None)
+        print(str(sum(sizes.values())) + " posts split into " + str(len(sizes)) + " shards in " + args.shards)
+    elif args.command == "work":
+        if args.processes > 1:
+            # Each process writes its own trace file
+            traces = [args.trace.replace(".json", "_" + str(i) + ".json") if args.trace else None
+                      for i in range(args.processes)]
+            with ProcessPoolExecutor(args.processes, mp_context=get_context("spawn")) as pool:
+                done = list(pool.map(work, [args.shards] * args.processes, [args.stale] * args.processes, traces))
+            processed, failed = sum(d[0] for d in done), sum(d[1] for d in done)
+        else:
+            processed, failed = work(args.shards, args.stale, args.trace)
+        print(str(processed) + " shards processed, " + str(failed) + " failed.")
+        if failed:
+            sys.exit(1)
+    else:
+        configure(args.trace)
+        with span("reduce"):
+            reduce_shards(args.shards, args.rtsi, args.time_slices, args.final, args.alignment)
+
+    print("Time consumption sharded pipeline: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Entity taxonomies used by <taxonomy_metrics.py>
+#
+# Each taxonomy declares
+# - "entity_types": the NER entity types of <ner.py> it applies to,
+# - "levels": the names of its hierarchy levels from the finest to the coarsest level,
+#   e.g. city -> country -> country_group -> region,
+# - "names": the nodes of the finest level with the names matched against the entities
+#   (case-insensitive; if an entity matches names of several nodes, the last node wins, as in <merge_labels.py>),
+# - "parents": one mapping per coarser level from each node of the previous level to its parent node.
+# A JSON file with the same structure (with lists instead of sets) can be passed with --config.
+from country_groups import COUNTRY_GROUPS
+
+# Regions of the country groups
+REGIONS = {
+    "russia": "post_soviet",
+    "usa": "west",
+    "ukraine": "post_soviet",
+    "south_and_east_asia": "asia",
+    "near_east": "middle_east_and_africa",
+    "de_facto_states": "post_soviet",
+    "korea": "asia",
+    "syria": "middle_east_and_africa",
+    "north_america": "west",
+    "south_america_carib": "latin_america",
+    "eu_and_neighbors": "west",
+    "china": "asia",
+    "australia_oceania": "west",
+    "cis": "post_soviet",
+    "africa": "middle_east_and_africa",
+}
+
+TAXONOMIES = {
+    "countries": {
+        "entity_types": ["GPE_COUNTRY"],
+        "levels": ["country_group", "region"],
+        "names": COUNTRY_GROUPS,
+        "parents": [REGIONS],
+    },
+    "persons": {
+        "entity_types": ["PERSON"],
+        "levels": ["person"],
+        "names": {
+            "putin": {"Путин"},
+            "trump": {"Трамп"},
+            "poroshenko": {"Порошенк"},
+            "merkel": {"Меркель"},
+            "macron": {"Макрон"},
+            "assad": {"Асад"},
+            "kim_jong_un": {"Ким Чен Ын"},
+            "xi_jinping": {"Си Цзиньпин"},
+        },
+        "parents": [],
+    },
+}
@@ -1,159 +0,0 @@
-# Country groups mapping
-COUNTRY_GROUPS = {
-    "russia": {
-        "росс",
-        "рус",
-        "СССР",
-        "Российская Федерация",
-        "РФ",
-        "Крым",
-        "Советск",
-        "чечн",
-        "чечен",
-        "Дагестан",
-        "Якут",
-    },
-    "usa": {"америк", "США", "Штаты", "Вашингтон", "Гавай", "Гуантанамо"},
-    "ukraine": {"Украин", "Донбасс"},
-    "south_and_east_asia": {
-        "Ази",
-        "мьянм",
-        "Папуа",
-        "Пакистан",
-        "Грузи",
-        "Афган",
-        "Таиланд",
-        "Тайван",
-        "Япон",
-        "Мальдив",
-        "Инди",
-        "Шри-Ланк",
-        "Сингал",
-        "Монгол",
-        "Западная Новая Гвинея",
-    },
-    "near_east": {
-        "Турц",
-        "турец",
-        "Анкар",
-        "Израил",
-        "Катар",
-        "Ливи",
-        "Йемен",
-        "Иордан",
-        "Македон",
-        "Палестин",
-        "Курд",
-        "Иран",
-        "Египет",
-        "египт",
-        "саудовск",
-        "иг",
-        "исламское государство",
-        "Ирак",
-    },
-    "de_facto_states": {
-        "Осети",
-        "Абхаз",
-        "Карабах",
-        "Приднестров",
-        "ПМР",
-        "Арцах",
-        "Косов",
-    },
-    "korea": {"Коре", "КНДР", "Пхеньян"},
-    "syria": {"Сири", "Гута", "Восточной Гуте"},
-    "north_america": {"Мексик", "канад"},
-    "south_america_carib": {
-        "Гаити",
-        "Чили",
-        "Эквадор",
-        "куб",
-        "Аргентин",
-        "Бразил",
-        "латинск",
-        "Перу",
-        "Венесуэл",
-    },
-    "eu_and_neighbors": {
-        "Герман",
-        "Немец",
-        "Федеративная Республика Германия",
-        "ФРГ",
-        "гдр",
-        "Словак",
-        "Чешск",
-        "Чехи",
-        "серб",
-        "Поль",
-        "Словен",
-        "Испан",
-        "Каталон",
-        "Швейцар",
-        "Швец",
-        "швед",
-        "Нидерланд",
-        "Голланд",
-        "велико",
-        "Брит",
-        "Англи",
-        "Австр",
-        "Дани",
-        "Финлянд",
-        "Финск",
-        "финк",
-        "финн",
-        "Франц",
-        "Итал",
-        "Латви",
-        "Латышск",
-        "Литв",
-        "Литовск",
-        "Прибалтийск",
-        "Эстон",
-        "Норве",
-        "бельг",
-        "Хорват",
-        "Мальт",
-        "Кипр",
-        "венг",
-        "Европ",
-        "португал",
-        "Лихтенштейн",
-        "Люксембург",
-        "Греческий",
-        "Греци",
-        "Ирланд",
-        "Болгар",
-        "Евросоюз",
-        "Черногори",
-        "Албани",
-        "Северная Македония",
-    },
-    "china": {"Кита", "Гонконг", "кнр", "юань"},
-    "australia_oceania": {"Австрал", "Зеланд", "Тонг"},
-    "cis": {
-        "СНГ",
-        "Азербайджан",
-        "Армен",
-        "Армян",
-        "Белорус",
-        "Казах",
-        "Киргиз",
-        "Молдав",
-        "Таджик",
-        "Узбекист",
-        "Туркмен",
-        "Молдав",
-    },
-    "africa": {
-        "Нигери",
-        "Ангол",
-        "Эфиоп",
-        "Южно-Африканская Республика",
-        "ЮАР",
-        "Алжир",
-        "Африк",
-        "Гвине",
-    },
-}
\ No newline at end of file
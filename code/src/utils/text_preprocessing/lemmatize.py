@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to lemmatize preprocessed posts.
+
+In more detail, this module is used after <preprocess_text.py> so that inflected forms of a word,
+e.g. "украины", "украине" and "украину", can be counted together. It adds two columns to the preprocessed posts:
+- lemmas: the space-separated lemma of each token
+- num_lemmas: the number of word lemmas per post (without the placeholders NUMBER, TAG, USER and CUR)
+The columns are kept by <merge_ner_and_posts.py>. They can be indexed with <inverted_index.py> (--column lemmas)
+and num_lemmas can be used as number of words by <calculate_metrics_prct_change.py> (--words num_lemmas).
+
+The morphological analyzer (pymorphy2) is called once per distinct token, not once per token occurrence:
+the posts are processed in chunks, and only the token types of a chunk that are not yet in the
+type -> lemma cache are analyzed. The cache is stored as tab-separated file and reused by later runs,
+e.g. for new deliveries.
+
+Example:
+python3 code/src/utils/text_preprocessing/lemmatize.py --input code/data/media_posts_processed.csv --output code/data/media_posts_lemmatized.csv
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, count, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+pd = lazy_import("pandas")
+
+CACHE_FILE = "code/data/lemma_cache.tsv"
+CHUNK_SIZE = 100000
+# Placeholders introduced by <preprocess_text.py> are kept as they are
+PLACEHOLDERS = {"NUMBER", "TAG", "USER", "CUR"}
+
+
+def load_analyzer():
+    """
+    A method to create the analyzer mapping a token to its lemma.
+    :return: A function mapping a token to its lemma.
+    """
+    # Imported here, so that the command line interface starts without loading the dictionaries
+    import pymorphy2
+
+    morph = pymorphy2.MorphAnalyzer()
+    return lambda token: morph.parse(token)[0].normal_form
+
+
+def load_cache(fn):
+    """
+    A method to load the type -> lemma cache.
+    :param fn: Path of the tab-separated cache file.
+    :return: A dictionary mapping tokens to lemmas (empty if the file does not exist).
+    """
+    cache = {}
+    if Path(fn).exists():
+        with open(fn, encoding="utf-8") as f:
+            for line in f:
+                token, lemma = line.rstrip("\n").split("\t")
+                cache[token] = lemma
+    return cache
+
+
+def save_cache(cache, fn, new_tokens):
+    """
+    A method to append new entries to the type -> lemma cache file.
+    :param cache: A dictionary mapping tokens to lemmas.
+    :param fn: Path of the tab-separated cache file.
+    :param new_tokens: A list of tokens added to the cache since it was loaded.
+    """
+    Path(fn).parent.mkdir(parents=True, exist_ok=True)
+    with open(fn, "a", encoding="utf-8") as f:
+        f.writelines(token + "\t" + cache[token] + "\n" for token in new_tokens)
+
+
+def lemmatize_types(tokens, cache, analyzer):
+    """
+    A method to add the lemmas of token types missing in the cache.
+    :param tokens: An iterable of token types.
+    :param cache: A dictionary mapping tokens to lemmas, updated in place.
+    :param analyzer: A function mapping a token to its lemma as returned by load_analyzer().
+    :return: A list of the tokens added to the cache.
+    """
+    new_tokens = [token for token in set(tokens) if token not in cache]
+    for token in new_tokens:
+        cache[token] = token if token in PLACEHOLDERS else analyzer(token)
+    count("new_token_types", len(new_tokens))
+    return new_tokens
+
+
+def lemmatize_posts(df, cache, analyzer):
+    """
+    A method to lemmatize the texts of posts.
+    :param df: A pandas DataFrame containing at least a column "text" with preprocessed text.
+    :param cache: A dictionary mapping tokens to lemmas, updated in place.
+    :param analyzer: A function mapping a token to its lemma as returned by load_analyzer().
+    :return: A tuple of the pandas DataFrame with the columns "lemmas" and "num_lemmas" and
+    the list of tokens added to the cache.
+    """
+    tokens = df["text"].fillna("").str.split().explode().dropna()
+    count("tokens", len(tokens))
+    new_tokens = lemmatize_types(tokens.unique(), cache, analyzer)
+    lemmas = tokens.map(cache)
+    df["lemmas"] = lemmas.groupby(level=0).agg(" ".join).reindex(df.index, fill_value="")
+    words = ~lemmas.isin(PLACEHOLDERS)
+    df["num_lemmas"] = words.groupby(level=0).sum().reindex(df.index, fill_value=0).astype("int64")
+    return df, new_tokens
+
+
+def main(argv=None):
+    """
+    A method to lemmatize the posts of an input file.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Lemmatize preprocessed posts.")
+    parser.add_argument("--input", help="Input CSV file created by <preprocess_text.py>")
+    parser.add_argument("--output", help="Output CSV file")
+    parser.add_argument("--cache", default=CACHE_FILE, help="Tab-separated type -> lemma cache file")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    print("Processing input file: " + args.input)
+
+    # The posts are written to a temporary file next to the output first, so that the input is not
+    # overwritten while it is read if both are the same file
+    fn_tmp = Path(args.output).with_name(Path(args.output).name + ".tmp")
+    with span("lemmatize"):
+        cache = load_cache(args.cache)
+        cached = len(cache)
+        analyzer = None
+        num_tokens = 0
+        for chunk_id, df in enumerate(pd.read_csv(args.input, encoding="utf-8", sep=",", chunksize=CHUNK_SIZE)):
+            if analyzer is None:
+                with span("load_analyzer"):
+                    analyzer = load_analyzer()
+            with span("chunk", rows=len(df)):
+                df, new_tokens = lemmatize_posts(df, cache, analyzer)
+                save_cache(cache, args.cache, new_tokens)
+            num_tokens += int(df["lemmas"].str.split().str.len().sum())
+            df.to_csv(fn_tmp, index=False, mode="w" if chunk_id == 0 else "a", header=chunk_id == 0)
+        os.replace(fn_tmp, args.output)
+
+    print(str(num_tokens) + " tokens lemmatized, " + str(len(cache) - cached) + " new token types analyzed ("
+          + str(cached) + " token types cached before).")
+    print("Lemmatized posts saved to output file: " + args.output)
+    print("Time consumption lemmatization: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,16 @@ For a translation of the country groups, see Table 1 and Appendix A.1.
 """
 import argparse
 import re
+import sys
 import time
+from pathlib import Path
 
-import pandas as pd
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from country_groups import COUNTRY_GROUPS  # noqa: E402
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
 
-from country_groups import COUNTRY_GROUPS
+pd = lazy_import("pandas")
 
 
 def get_unique_names(df):
@@ -46,8 +51,52 @@ def get_country_mention_counts(df):
     return counts
 
 
-if __name__ == "__main__":
+def load_ner(fn):
+    """
+    A method to load NER results and prepare the country mentions.
+    :param fn: Path to the JSON file created by <ner.py>.
+    :return: A pandas DataFrame indexed by post ID with lists of lowercased
+    country mentions in column 'GPE_COUNTRY'.
+    """
+    ner = pd.read_json(fn, orient="index", dtype=False)
+    if "GPE_COUNTRY" not in ner:
+        # No post mentions a country, e.g. in a small delivery or shard
+        ner["GPE_COUNTRY"] = None
+    ner.GPE_COUNTRY = ner.GPE_COUNTRY.fillna("")
+    ner["GPE_COUNTRY"] = ner["GPE_COUNTRY"].map(lambda x: list(map(str.lower, x)))
+    return ner
+
+
+def collapse_labels(ner):
+    """
+    A method to collapse country mentions into country and country group labels.
+    :param ner: A pandas DataFrame as returned by load_ner().
+    :return: A pandas DataFrame with one row per post ID and country mention
+    containing the collapsed label in column 'COL_GPE_COUNTRY'.
+    """
+    # Prepare NER results
+    with span("explode", rows=len(ner)):
+        ner_exploded = ner.explode("GPE_COUNTRY")
+    # Group labels in NER results
+    with span("collapse", rows=len(ner_exploded)):
+        ner_exploded["COL_GPE_COUNTRY"] = None
+        for country in COUNTRY_GROUPS:  # Go through labels to collapse to
+            for name in COUNTRY_GROUPS.get(country):  # Iterate through corresponding named entities
+                ner_exploded.loc[ner_exploded["GPE_COUNTRY"].str.contains(name.lower(), regex=True,
+                    flags=re.IGNORECASE, na=False), "COL_GPE_COUNTRY",] = country
+
+    # Drop all posts with country mentions numbers < 2
+    ner_exploded.dropna(subset=["COL_GPE_COUNTRY"], inplace=True)
+    ner_exploded.reset_index(inplace=True)
+    ner_exploded.rename(columns={"index": "ID"}, inplace=True)
+    return ner_exploded
 
+
+def main(argv=None):
+    """
+    A method to collapse the NER results of an input file.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
     # Monitor time
     start_time = time.time()
 
@@ -56,29 +105,25 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
     parser.add_argument("--input", type=argparse.FileType("r"), help="Input JSON file")
     parser.add_argument("--output", type=argparse.FileType("wb"), help="Output CSV file")
-    args = parser.parse_args()
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
 
     print("Processing input file: " + args.input.name)
 
-    ner = pd.read_json(args.input.name, orient="index", dtype=False)
-    ner.GPE_COUNTRY = ner.GPE_COUNTRY.fillna("")
-    ner["GPE_COUNTRY"] = ner["GPE_COUNTRY"].map(lambda x: list(map(str.lower, x)))
-
-    # Prepare NER results
-    ner_exploded = ner.explode("GPE_COUNTRY")
-    # Group labels in NER results
-    for country in COUNTRY_GROUPS:  # Go through labels to collapse to
-        for name in COUNTRY_GROUPS.get(country):  # Iterate through corresponding named entities
-            ner_exploded.loc[ner_exploded["GPE_COUNTRY"].str.contains(name.lower(), regex=True, flags=re.IGNORECASE,
-                na=False), "COL_GPE_COUNTRY",] = country
-
-    # Drop all posts with country mentions numbers < 2
-    ner_exploded.dropna(subset=["COL_GPE_COUNTRY"], inplace=True)
-    ner_exploded.reset_index(inplace=True)
-    ner_exploded.rename(columns={"index": "ID"}, inplace=True)
+    with span("merge_labels"):
+        with span("load") as load:
+            ner = load_ner(args.input.name)
+            load.rows = len(ner)
+        ner_exploded = collapse_labels(ner)
 
-    # Save to CSV file
-    ner_exploded.to_csv(args.output.name, index=False)
+        # Save to CSV file
+        with span("write", rows=len(ner_exploded)):
+            ner_exploded.to_csv(args.output.name, index=False)
     print("Results saved to output file: " + args.output.name)
 
     print("Time consumption collapsing labels: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
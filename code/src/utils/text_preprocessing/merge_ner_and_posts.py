@@ -6,34 +6,30 @@ In more detail, this module is used to merge
 - the collapsed country labels from the module <merge_labels.py> and
 - the preprocessed posts from <preprocess_labels.py>
 to have all data together to study agenda-setting.
+
+With --append, the merged posts of a new delivery are appended to an existing final CSV file
+instead of writing a new one, see <run_daily_append.sh>. Posts whose IDs are already in the final CSV file
+are not appended again; the appended posts can be saved with --new-output to count only them.
 """
 import argparse
 import sys
 import time
+from pathlib import Path
 
-import pandas as pd
-import numpy as np
-
-from country_groups import COUNTRY_GROUPS
-
-start_time = time.time()
-print("Executing merge NER and posts")
-
-# Global variables
-global vk, ner
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from country_groups import COUNTRY_GROUPS  # noqa: E402
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
 
-# Load data
-parser = argparse.ArgumentParser(description="Merge country labels and posts.")
-parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
-parser.add_argument("--input", nargs= "+", type=argparse.FileType("r"), help="Input CSV files")
-parser.add_argument("--output", type=argparse.FileType("wb"), help="Output CSV file")
-args = parser.parse_args()
+pd = lazy_import("pandas")
 
-fn_vk = args.input[0].name
-fn_ner = args.input[1].name
-print("Processing input files: " + fn_vk + ", " + fn_ner)
 
-try:
+def load_posts(fn_vk):
+    """
+    A method to load preprocessed posts.
+    :param fn_vk: Path to the CSV file created by <preprocess_text.py>.
+    :return: A pandas DataFrame with integer post IDs in column "ID".
+    """
     vk = pd.read_csv(
         fn_vk,
         encoding="utf-8",
@@ -43,68 +39,134 @@ try:
     )
     vk["date"] = pd.to_datetime(vk["date"], unit="s")
     vk["ID"] = vk["ID"].str.replace("_", "", regex=True).astype("int64")
-except IOError as io_error:
-    print(io_error)
+    return vk
 
-try:
+
+def load_labels(fn_ner):
+    """
+    A method to load collapsed country labels.
+    :param fn_ner: Path to the CSV file created by <merge_labels.py>.
+    :return: A pandas DataFrame indexed by post ID.
+    """
     ner = pd.read_csv(fn_ner, encoding="utf-8", sep=",")
     ner.set_index("ID", inplace=True)
-except IOError as io_error:
-    print(io_error)
-
-# Prepare collapsed labels by imploding them back to frames with row of unique IDs
-collapsed_large = ner[["GPE_COUNTRY", "COL_GPE_COUNTRY"]]
-collapsed = pd.DataFrame(
-    collapsed_large.groupby(collapsed_large.index).GPE_COUNTRY.agg(list)
-)
-collapsed["COL_GPE_COUNTRY"] = collapsed_large.groupby(
-    collapsed_large.index
-).COL_GPE_COUNTRY.agg(list)
-
-# Merge the two DataFrames back into one
-collapsed = collapsed.reset_index()
-m1 = list(vk["ID"])
-m2 = list(collapsed["ID"])
-m3, m4 = [], []
-for ID in m1:
-    if ID in m2:
-        row_number = collapsed[collapsed["ID"] == ID].index[0]
-        m3.append(collapsed.at[row_number, "GPE_COUNTRY"])
-        m4.append(collapsed.at[row_number, "COL_GPE_COUNTRY"])
-    else:
-        m3.append(np.NaN)
-        m4.append(np.NaN)
-
-vk["GPE_COUNTRY"] = m3
-vk["COL_GPE_COUNTRY"] = m4
-
-# Monitor country mentions per post
-merged = pd.DataFrame(vk["COL_GPE_COUNTRY"])
-merged = merged.explode("COL_GPE_COUNTRY")
-for country in COUNTRY_GROUPS:
-    merged.loc[
-        merged["COL_GPE_COUNTRY"].str.contains(country, na=False), country,
-    ] = 1
-
-for country in COUNTRY_GROUPS:
-    vk[country] = merged.groupby(merged.index).agg({country: "sum"})
-
-# Set date as date time index and sort merged DataFrame in ascending order
-vk = vk.sort_values(by="date")
-vk = vk.set_index(pd.DatetimeIndex(vk["date"]))
-
-# Add a column "status" with value 0 if post comes from TASS or RT.
-# Add a column "status" with value 1 if post comes from RBC or Meduza
-# Note: -26284064: TASS, -403167058: RussiaToday, -76982440: Meduza, -25232578: RBC.
-vk.loc[vk.ID.astype(str).str.startswith("-26284064"), "status"] = 0
-vk.loc[vk.ID.astype(str).str.startswith("-40316705"), "status"] = 0
-vk.loc[vk.ID.astype(str).str.startswith("-76982440"), "status"] = 1
-vk.loc[vk.ID.astype(str).str.startswith("-25232578"), "status"] = 1
-
-# Save as CSV file
-vk.to_csv(args.output.name, index=False)
-
-print(
-    "Time consumption of final merging: --- %s seconds ---" % (time.time() - start_time)
-)
+    return ner
+
+
+def merge_labels_and_posts(vk, ner):
+    """
+    A method to merge collapsed country labels into preprocessed posts.
+    :param vk: A pandas DataFrame of preprocessed posts as returned by load_posts().
+    :param ner: A pandas DataFrame of collapsed country labels as returned by load_labels().
+    :return: A pandas DataFrame with a DatetimeIndex sorted by date containing the posts,
+    their country labels, a column with the number of mentions for each country, and the status.
+    """
+    # Prepare collapsed labels by imploding them back to frames with row of unique IDs
+    with span("join", rows=len(vk)):
+        collapsed_large = ner[["GPE_COUNTRY", "COL_GPE_COUNTRY"]]
+        collapsed = pd.DataFrame(
+            collapsed_large.groupby(collapsed_large.index).GPE_COUNTRY.agg(list)
+        )
+        collapsed["COL_GPE_COUNTRY"] = collapsed_large.groupby(
+            collapsed_large.index
+        ).COL_GPE_COUNTRY.agg(list)
+
+        # Merge the two DataFrames back into one
+        vk["GPE_COUNTRY"] = vk["ID"].map(collapsed["GPE_COUNTRY"])
+        vk["COL_GPE_COUNTRY"] = vk["ID"].map(collapsed["COL_GPE_COUNTRY"])
+
+    # Monitor country mentions per post
+    with span("explode", rows=len(vk)):
+        merged = pd.DataFrame(vk["COL_GPE_COUNTRY"])
+        merged = merged.explode("COL_GPE_COUNTRY")
+    with span("count_mentions", rows=len(merged)):
+        for country in COUNTRY_GROUPS:
+            merged.loc[
+                merged["COL_GPE_COUNTRY"].str.contains(country, na=False), country,
+            ] = 1
+
+        for country in COUNTRY_GROUPS:
+            vk[country] = merged.groupby(merged.index).agg({country: "sum"})
+
+    # Set date as date time index and sort merged DataFrame in ascending order
+    vk = vk.sort_values(by="date")
+    vk = vk.set_index(pd.DatetimeIndex(vk["date"]))
+
+    # Add a column "status" with value 0 if post comes from TASS or RT.
+    # Add a column "status" with value 1 if post comes from RBC or Meduza
+    # Note: -26284064: TASS, -403167058: RussiaToday, -76982440: Meduza, -25232578: RBC.
+    vk.loc[vk.ID.astype(str).str.startswith("-26284064"), "status"] = 0
+    vk.loc[vk.ID.astype(str).str.startswith("-40316705"), "status"] = 0
+    vk.loc[vk.ID.astype(str).str.startswith("-76982440"), "status"] = 1
+    vk.loc[vk.ID.astype(str).str.startswith("-25232578"), "status"] = 1
+    return vk
+
+
+def append_posts(vk, fn_final):
+    """
+    A method to append merged posts to an existing final CSV file.
+    Only the IDs of the existing file are read, so that posts of overlapping deliveries are appended once.
+    :param vk: A pandas DataFrame of merged posts as returned by merge_labels_and_posts().
+    :param fn_final: Path to an existing final CSV file.
+    :return: A pandas DataFrame of the appended posts.
+    """
+    columns = pd.read_csv(fn_final, encoding="utf-8", sep=",", nrows=0).columns
+    missing = set(columns) ^ set(vk.columns)
+    if missing:
+        raise ValueError("Columns do not match the existing final CSV file: " + ", ".join(sorted(missing)))
+    ingested = pd.read_csv(fn_final, encoding="utf-8", sep=",", usecols=["ID"])["ID"]
+    vk = vk.drop_duplicates(subset=["ID"], keep="last")
+    vk = vk[~vk["ID"].isin(ingested)]
+    vk[list(columns)].to_csv(fn_final, mode="a", header=False, index=False)
+    return vk
+
+
+def main(argv=None):
+    """
+    A method to merge the country labels and posts of input files.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    start_time = time.time()
+    print("Executing merge NER and posts")
+
+    # Load data
+    parser = argparse.ArgumentParser(description="Merge country labels and posts.")
+    parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
+    parser.add_argument("--input", nargs= "+", type=argparse.FileType("r"), help="Input CSV files")
+    parser.add_argument("--output", help="Output CSV file")
+    parser.add_argument("--append", action="store_true",
+                        help="Append the merged posts to the existing output CSV file")
+    parser.add_argument("--new-output", help="Output CSV file for the appended posts only (append)")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    fn_vk = args.input[0].name
+    fn_ner = args.input[1].name
+    print("Processing input files: " + fn_vk + ", " + fn_ner)
+
+    with span("merge_ner_and_posts"):
+        with span("load") as load:
+            vk = load_posts(fn_vk)
+            ner = load_labels(fn_ner)
+            load.rows = len(vk) + len(ner)
+        vk = merge_labels_and_posts(vk, ner)
+
+        # Save as CSV file
+        with span("write", rows=len(vk)):
+            if args.append:
+                appended = append_posts(vk, args.output)
+                print(str(len(appended)) + " posts appended to output file: " + args.output + ", "
+                      + str(len(vk) - len(appended)) + " posts were already in it.")
+                if args.new_output:
+                    appended.to_csv(args.new_output, index=False)
+            else:
+                vk.to_csv(args.output, index=False)
+
+    print(
+        "Time consumption of final merging: --- %s seconds ---" % (time.time() - start_time)
+    )
+
 
+if __name__ == "__main__":
+    main()
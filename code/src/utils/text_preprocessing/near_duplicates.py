@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A module to detect near-duplicate posts.
+
+In more detail, this module is used to find posts that republish wire copy or near-identical
+updates in the preprocessed posts from <preprocess_text.py>. Near-duplicate posts are labeled
+with a cluster ID, so that
+- NER is only run once per cluster (<ner.py> with --clusters) and
+- post level metrics can count each cluster only once per outlet (<calculate_metrics_prct_change.py> with --dedup).
+
+Near duplicates are found with MinHash and locality-sensitive hashing (LSH):
+1. Each post is represented by hashed word shingles (n-grams of k tokens).
+2. A MinHash signature of NUM_PERM values is computed per post; the share of equal values of two
+   signatures estimates the Jaccard similarity of their shingle sets. Signatures are computed
+   chunk-wise in parallel processes and stored in a memory-mapped file.
+3. Signatures are cut into bands. Posts with an identical band are candidate pairs, which are
+   kept if their estimated Jaccard similarity reaches the threshold.
+4. Connected components of the kept pairs form the clusters. The first post of a cluster
+   in the input file is its representative.
+
+Memory use is bounded by the chunk size, the number of processes and the memory-mapped signatures.
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+NUM_PERM = 128  # Number of MinHash values per post
+BANDS = 16  # Number of LSH bands, each band covers NUM_PERM // BANDS values
+SHINGLE_SIZE = 3  # Number of tokens per shingle
+THRESHOLD = 0.8  # Minimum estimated Jaccard similarity of near duplicates
+CHUNK_SIZE = 20000  # Number of posts per chunk
+PERM_BLOCK = 16  # Number of MinHash values computed at once to bound memory
+SEED = 42
+MAX_HASH = 0xFFFFFFFF
+
+
+def make_permutations(num_perm=NUM_PERM, seed=SEED):
+    """
+    A method to draw the parameters of the universal hash functions used as permutations.
+    :param num_perm: The number of MinHash values per post.
+    :param seed: The random seed.
+    :return: A tuple of two numpy arrays a (odd) and b of type uint64.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(texts, k=SHINGLE_SIZE):
+    """
+    A method to hash the word shingles of texts.
+    Posts with fewer than k tokens are represented by a single shingle of all their tokens.
+    :param texts: A list of strings of space-separated tokens.
+    :param k: The number of tokens per shingle.
+    :return: A tuple of a numpy array of uint64 shingle hashes ordered by post and
+    a numpy array with the number of shingles per post.
+    """
+    tokens = [text.split() if isinstance(text, str) else [] for text in texts]
+    lengths = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=len(tokens))
+    flat = np.array([token for t in tokens for token in t], dtype=object)
+    token_hashes = pd.util.hash_array(flat) if len(flat) else np.zeros(0, dtype=np.uint64)
+    starts = np.cumsum(lengths) - lengths
+
+    # Combine k consecutive token hashes into a shingle hash
+    num_shingles = np.where(lengths > 0, np.maximum(lengths - k + 1, 1), 0)
+    post = np.repeat(np.arange(len(texts)), num_shingles)
+    first = starts[post] + (np.arange(len(post)) - np.repeat(np.cumsum(num_shingles) - num_shingles, num_shingles))
+    end = starts[post] + lengths[post]
+    shingles = np.zeros(len(post), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j in range(k):
+            position = first + j
+            valid = position < end
+            shingles = shingles * np.uint64(0x100000001B3) + np.where(
+                valid, token_hashes[np.minimum(position, len(token_hashes) - 1)], np.uint64(0))
+    return shingles, num_shingles
+
+
+def minhash(texts, a, b, k=SHINGLE_SIZE):
+    """
+    A method to compute MinHash signatures of texts.
+    :param texts: A list of strings of space-separated tokens.
+    :param a: A numpy array of hash parameters as returned by make_permutations().
+    :param b: A numpy array of hash parameters as returned by make_permutations().
+    :param k: The number of tokens per shingle.
+    :return: A numpy array of shape (len(texts), len(a)) of type uint32. Empty posts
+    get the maximum value in all positions.
+    """
+    shingles, num_shingles = shingle_hashes(texts, k)
+    signatures = np.full((len(texts), len(a)), MAX_HASH, dtype=np.uint32)
+    non_empty = num_shingles > 0
+    if not non_empty.any():
+        return signatures
+    offsets = (np.cumsum(num_shingles) - num_shingles)[non_empty]
+    with np.errstate(over="ignore"):
+        for block in range(0, len(a), PERM_BLOCK):
+            # Multiply-shift hashing: (a * x + b) mod 2^64, keep the upper 32 bits
+            hashed = shingles[:, None] * a[None, block:block + PERM_BLOCK] + b[None, block:block + PERM_BLOCK]
+            hashed = (hashed >> np.uint64(32)).astype(np.uint32)
+            signatures[non_empty, block:block + PERM_BLOCK] = np.minimum.reduceat(hashed, offsets, axis=0)
+    return signatures
+
+
+def band_keys(signatures, bands=BANDS):
+    """
+    A method to hash each band of MinHash signatures into a single key.
+    :param signatures: A numpy array of MinHash signatures.
+    :param bands: The number of bands.
+    :return: A numpy array of shape (len(signatures), bands) of type uint64.
+    """
+    rows = signatures.shape[1] // bands
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for r in range(rows):
+            keys = keys * np.uint64(0x9E3779B97F4A7C15) + signatures[:, r::rows][:, :bands].astype(np.uint64)
+    return keys
+
+
+def _signature_worker(task):
+    """A helper method to compute signatures and band keys of a chunk in a worker process."""
+    start, texts, a, b, k, bands = task
+    signatures = minhash(texts, a, b, k)
+    return start, signatures, band_keys(signatures, bands)
+
+
+def connected_components(n, left, right):
+    """
+    A method to label the connected components of a graph given by its edges.
+    :param n: The number of nodes.
+    :param left: A numpy array of node indices.
+    :param right: A numpy array of node indices.
+    :return: A numpy array with the smallest node index of the component of each node.
+    """
+    labels = np.arange(n)
+    if len(left) == 0:
+        return labels
+    while True:
+        # Propagate the smaller label along each edge and compress paths
+        smaller = np.minimum(labels[left], labels[right])
+        np.minimum.at(labels, left, smaller)
+        np.minimum.at(labels, right, smaller)
+        compressed = labels[labels]
+        while not np.array_equal(compressed, labels):
+            labels = compressed
+            compressed = labels[labels]
+        if np.array_equal(labels[left], labels[right]):
+            return labels
+
+
+def find_near_duplicates(texts, threshold=THRESHOLD, num_perm=NUM_PERM, bands=BANDS, k=SHINGLE_SIZE,
+                         processes=None, work_dir=None):
+    """
+    A method to cluster near-duplicate texts.
+    :param texts: A list of strings of space-separated tokens.
+    :param threshold: The minimum estimated Jaccard similarity of near duplicates.
+    :param num_perm: The number of MinHash values per post.
+    :param bands: The number of LSH bands. num_perm must be divisible by bands.
+    :param k: The number of tokens per shingle.
+    :param processes: The number of worker processes. Defaults to the number of CPUs.
+    :param work_dir: Directory for the memory-mapped signatures. Defaults to a temporary directory.
+    :return: A numpy array with the cluster ID of each text, i.e. the index of its first near duplicate.
+    """
+    if num_perm % bands:
+        raise ValueError("The number of permutations must be divisible by the number of bands.")
+    n = len(texts)
+    a, b = make_permutations(num_perm)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        signatures = np.lib.format.open_memmap(Path(tmp) / "signatures.npy", mode="w+", dtype=np.uint32,
+                                               shape=(n, num_perm))
+        keys = np.lib.format.open_memmap(Path(tmp) / "bands.npy", mode="w+", dtype=np.uint64, shape=(bands, n))
+        tasks = ((start, texts[start:start + CHUNK_SIZE], a, b, k, bands) for start in range(0, n, CHUNK_SIZE))
+        with span("minhash", rows=n):
+            with multiprocessing.Pool(processes) as pool:
+                for start, chunk_signatures, chunk_keys in pool.imap_unordered(_signature_worker, tasks):
+                    signatures[start:start + len(chunk_signatures)] = chunk_signatures
+                    keys[:, start:start + len(chunk_keys)] = chunk_keys.T
+
+        # Empty posts are never near duplicates
+        empty = np.array([not (isinstance(text, str) and text.strip()) for text in texts])
+        left, right = [], []
+        with span("lsh", rows=n):
+            for band in range(bands):
+                band_key = np.asarray(keys[band])
+                order = np.argsort(band_key, kind="stable")
+                sorted_keys = band_key[order]
+                # Link each post to the first post with the same band key
+                run_start = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+                heads = np.repeat(order[run_start], np.diff(np.r_[run_start, n]))
+                candidate = (heads != order) & ~empty[order]
+                left.append(heads[candidate])
+                right.append(order[candidate])
+        left = np.concatenate(left)
+        right = np.concatenate(right)
+        with span("verify", rows=len(left)):
+            pairs = np.unique(np.stack([left, right], axis=1), axis=0) if len(left) else np.zeros((0, 2), int)
+            similar = np.zeros(len(pairs), dtype=bool)
+            for start in range(0, len(pairs), CHUNK_SIZE):
+                block = pairs[start:start + CHUNK_SIZE]
+                similar[start:start + len(block)] = (
+                    signatures[block[:, 0]] == signatures[block[:, 1]]
+                ).mean(axis=1) >= threshold
+            pairs = pairs[similar]
+        del signatures, keys
+    with span("components", rows=len(pairs)):
+        return connected_components(n, pairs[:, 0], pairs[:, 1])
+
+
+def cluster_table(ids, clusters):
+    """
+    A method to create the table of near-duplicate clusters.
+    :param ids: A list of post IDs.
+    :param clusters: A numpy array of cluster IDs as returned by find_near_duplicates().
+    :return: A pandas DataFrame with the columns "ID", "dup_cluster" (ID of the representative post),
+    "dup_representative" and "dup_cluster_size".
+    """
+    ids = np.asarray(ids)
+    sizes = np.bincount(clusters, minlength=len(clusters))
+    return pd.DataFrame({
+        "ID": ids,
+        "dup_cluster": ids[clusters],
+        "dup_representative": clusters == np.arange(len(clusters)),
+        "dup_cluster_size": sizes[clusters],
+    })
+
+
+def load_clusters(fn):
+    """
+    A method to load a table of near-duplicate clusters.
+    :param fn: Path to the CSV file created by this module.
+    :return: A pandas DataFrame as returned by cluster_table().
+    """
+    return pd.read_csv(fn, encoding="utf-8", sep=",", dtype={"ID": str, "dup_cluster": str})
+
+
+def main(argv=None):
+    """
+    A method to detect near duplicates in an input file.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Detect near-duplicate posts.")
+    parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
+    parser.add_argument("--input", help="Input CSV file of preprocessed posts")
+    parser.add_argument("--output", help="Output CSV file of near-duplicate clusters")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="Minimum Jaccard similarity")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    print("Processing input file: " + args.input)
+    with span("near_duplicates"):
+        with span("load") as load:
+            df = pd.read_csv(args.input, encoding="utf-8", sep=",", usecols=["ID", "text"], dtype={"ID": str})
+            load.rows = len(df)
+        clusters = find_near_duplicates(list(df["text"]), args.threshold, processes=args.processes)
+        table = cluster_table(df["ID"], clusters)
+        with span("write", rows=len(table)):
+            table.to_csv(args.output, index=False)
+
+    duplicates = int((~table["dup_representative"]).sum())
+    print(str(duplicates) + " near duplicates in " + str(table["dup_cluster"].nunique()) + " clusters found.")
+    print("Near-duplicate clusters saved to output file: " + args.output)
+    print("Time consumption near-duplicate detection: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
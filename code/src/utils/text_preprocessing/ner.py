@@ -12,15 +12,28 @@ to run this script for the ~15,000 posts of the VK corpus.
 For more information on the Texterra REST API see:
 https://www.ispras.ru/technologies/texterra/ (Russian only)
 (last accessed: 2022-27-04)
+
+To save API quota, near-duplicate posts found with <near_duplicates.py> can be skipped with
+--clusters. NER is then only applied to the representative post of each cluster and its results
+are copied to the other posts of the cluster.
 """
 import argparse
 import json
+import sys
 import time
-import pandas as pd
+from collections import deque
+from pathlib import Path
+
+from near_duplicates import load_clusters
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, count, gauge, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
 
-import texterra
+pd = lazy_import("pandas")
 
-from texterra_token import TOKEN
+# Number of API calls allowed per hour
+API_CALLS_PER_HOUR = 60
 
 
 def ner(data):
@@ -38,6 +51,10 @@ def ner(data):
     :return: A nested dictionary containing the NER results for each
     unique post ID.
     """
+    # Imported here, so that the command line interface starts without the Texterra client and token
+    import texterra
+    from texterra_token import TOKEN
+
     # Initialize variables
     texts = list(data["text"])
     ids = list(data["ID"])
@@ -46,6 +63,7 @@ def ner(data):
     id_batches = [ids[i * n: (i + 1) * n] for i in range((len(ids) + n - 1) // n)]
     ner_all = {}
     counter = 0
+    calls = deque()  # Start times of the API calls within the last hour
 
     # Access Texterra API
     ispras_texterra = texterra.API(TOKEN)
@@ -53,12 +71,22 @@ def ner(data):
     # Batch-wise call of API
     for batch in text_batches:
         if ispras_texterra is not None:
-            ner_helper = ner_api_call_helper(ispras_texterra, batch, id_batches[counter])
+            with span("api_call", rows=len(batch), batch=counter):
+                ner_helper = ner_api_call_helper(ispras_texterra, batch, id_batches[counter])
             ner_all.update(ner_helper)
+            # Monitor API quota usage
+            now = time.time()
+            calls.append(now)
+            while calls and calls[0] <= now - 3600:
+                calls.popleft()
+            count("api_calls")
+            count("api_texts", len(batch))
+            gauge("api_quota_remaining", API_CALLS_PER_HOUR - len(calls))
             print("Batch " + str(counter) + " done.")
             # Timer implemented to satisfy the requirements of API:
             # Number of calls per hour <= 60
-            time.sleep(61)
+            with span("sleep"):
+                time.sleep(61)
             counter = counter + 1
         else:
             print("An error occurred which is most likely due"
@@ -102,7 +130,38 @@ def ner_api_call_helper(texterra_api, data, ids):
     return ner_dict
 
 
-if __name__ == "__main__":
+def select_representatives(data, clusters):
+    """
+    A method to drop near-duplicate posts which are not the representative of their cluster.
+    :param data: A pandas DataFrame at least containing a column "ID".
+    :param clusters: A pandas DataFrame of near-duplicate clusters as returned by
+    near_duplicates.load_clusters().
+    :return: A pandas DataFrame with the representative posts and posts without cluster.
+    """
+    duplicates = set(clusters.loc[~clusters["dup_representative"], "ID"])
+    return data[~data["ID"].astype(str).isin(duplicates)]
+
+
+def copy_to_duplicates(ner_results, clusters):
+    """
+    A method to copy the NER results of representative posts to the other posts of their cluster.
+    :param ner_results: A dictionary of NER results as returned by ner().
+    :param clusters: A pandas DataFrame of near-duplicate clusters as returned by
+    near_duplicates.load_clusters().
+    :return: The dictionary of NER results including all posts of the clusters.
+    """
+    duplicates = clusters[~clusters["dup_representative"]]
+    for post_id, cluster in zip(duplicates["ID"], duplicates["dup_cluster"]):
+        if cluster in ner_results:
+            ner_results[post_id] = ner_results[cluster]
+    return ner_results
+
+
+def main(argv=None):
+    """
+    A method to apply NER to the posts of an input file.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
     # Monitor time
     start_time = time.time()
 
@@ -111,19 +170,36 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
     parser.add_argument("--input", type=argparse.FileType("r"), help="Input CSV file")
     parser.add_argument("--output", type=argparse.FileType("wb"), help="Output JSON file")
-    args = parser.parse_args()
+    parser.add_argument("--clusters", help="Near-duplicate clusters CSV file to apply NER once per cluster")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
     col_list = ["ID", "text"]
-    df = pd.read_csv(args.input, encoding="utf-8", sep="\t", usecols=col_list)
-    # df = df.truncate(before=2, after=19) # Uncomment to test API quickly
-    print("Processing input file: " + str(args.input.name) + "\nSend API requests and wait...")
-
-    # Check once again for empty strings and no NaNs as these are not allowed to be sent to the API
-    df = df.dropna(subset=["text"])
-    # Apply NER
-    ner_results = ner(df)
-    # Save to .json
-    with open(args.output.name, "w", encoding="utf-8") as f:
-        json.dump(ner_results, f, ensure_ascii=False, indent=4)
+    with span("ner"):
+        with span("load") as load:
+            df = pd.read_csv(args.input, encoding="utf-8", sep="\t", usecols=col_list)
+            load.rows = len(df)
+        clusters = None
+        if args.clusters:
+            clusters = load_clusters(args.clusters)
+            df = select_representatives(df, clusters)
+        # df = df.truncate(before=2, after=19) # Uncomment to test API quickly
+        print("Processing input file: " + str(args.input.name) + "\nSend API requests and wait...")
+
+        # Check once again for empty strings and no NaNs as these are not allowed to be sent to the API
+        df = df.dropna(subset=["text"])
+        # Apply NER
+        ner_results = ner(df)
+        if clusters is not None:
+            ner_results = copy_to_duplicates(ner_results, clusters)
+        # Save to .json
+        with span("write", rows=len(ner_results)):
+            with open(args.output.name, "w", encoding="utf-8") as f:
+                json.dump(ner_results, f, ensure_ascii=False, indent=4)
     print("NER results written to " + str(args.output.name) + ".")
     print("NER successfully completed.")
     print("Time consumption NER: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
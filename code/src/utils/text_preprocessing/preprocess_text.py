@@ -13,120 +13,197 @@ We do not provide the custom Russian spacy tokenizer, but provide an implementat
 """
 import argparse
 import re
+import sys
 import time
-from functools import reduce
+from functools import lru_cache, reduce
+from pathlib import Path
 
-import numpy as np
-import pandas as pd
-import spacy
-from textacy.preprocessing import normalize, remove, replace
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from instrumentation import configure, span  # noqa: E402
+from lazy_imports import lazy_import  # noqa: E402
 
-# Monitor time
-start_time = time.time()
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
-# Initialize variables
-global df
-tokens = []
-processed = []
-tokenized = []
-fn = ""
-
-# Load data
-parser = argparse.ArgumentParser(description="Preprocessing agenda-setting.")
-parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
-parser.add_argument("--input", type=argparse.FileType("r"), help="Input CSV file")
-parser.add_argument("--output", type=argparse.FileType("wb"), help="Output CSV file")
-args = parser.parse_args()
-
-print("Processing input file: " + args.input.name)
-
-try:
-    df = pd.read_csv(args.input, encoding="utf-8", sep="\t", parse_dates=[4], infer_datetime_format=True, )
 
+def load_posts(fn):
+    """
+    A method to load raw posts of the VK corpus.
+    :param fn: Path or file object of a tab-separated CSV file with the date in the fifth column.
+    :return: A pandas DataFrame with a datetime column "date".
+    """
+    df = pd.read_csv(fn, encoding="utf-8", sep="\t", parse_dates=[4], infer_datetime_format=True, )
     df["date"] = pd.to_datetime(df["date"], unit="s")
-except IOError as io_error:
-    print(io_error)
-
-# Unicode normalize
-df["text"] = df["text"].str.normalize("NFKC")
-# Remove empty posts
-df["text"] = df["text"].fillna("")
-# Remove URLS # COMMENT OUT FOR EXTENSION
-# df["text"] = df["text"].str.replace("http\S+|www.\S+", "", case=False)
-
-# Retrieve texts as list and prepare for NER, if applied
-texts = list(df["text"])
-for text in texts:
-    transforms = (
-        normalize.whitespace, remove.punctuation, replace.user_handles, replace.numbers, replace.currency_symbols,
-        replace.hashtags, replace.emojis,)
-    processed.append(reduce(lambda r, f: f(r), transforms, text))
-
-# Remove zero-width spaces and joiners
-# Remove a special emoji not captured by the above pipeline
-processed = [x.replace("\u200b", "") for x in processed]
-processed = [x.replace("\u200d", "") for x in processed]
-processed = [x.replace("\u200c", "") for x in processed]
-processed = [x.replace("\u2642", "_EMOJI_") for x in processed]
-
-processed = [x.replace("_EMOJI_", " ") for x in processed]
-processed = [x.replace("_NUMBER_", " NUMBER ") for x in processed]
-processed = [x.replace("_TAG_", " TAG ") for x in processed]
-processed = [x.replace("_EMAIL_", " ") for x in processed]
-processed = [x.replace("_USER_", " USER ") for x in processed]
-processed = [x.replace("_CUR_", " CUR ") for x in processed]
-
-# Uncomment if NER comparison is done
-# Assign text prepared for NER back to complete DataFrame and save to CSV
-# df["text"] = processed
-# fn = args.input + "_processed_NER_comparison.csv"
-# df.to_csv(fn, index=False)
-
-# Uncomment if a custom Russian tokenizer is used (as for our submission)
-# Note that we do not ship the modified custom Russian tokenizer
-
-# Tokenize text with custom Russian tokenizer
-# def create_russian_tokenizer(nlp,name):
-#     return RussianTokenizer(nlp, MERGE_PATTERNS + SYNTAGRUS_RARE_CASES, name)
-#
-# nlp = Russian()
-# name = "RussianTokenizer"
-# Language.factory("russian_tokenizer", func=create_russian_tokenizer(nlp,name))
-#
-# nlp.add_pipe('russian_tokenizer', last=True)
-
-nlp = spacy.load("ru_core_news_sm")
-for text in processed:
-    if type(text) == "":
-        text = np.NaN
-    else:
-        tokens = [token.text.lower() for token in nlp(text)]
-        post = " ".join(tokens)
-        tokenized.append(post)
-
-# Remove emojis, tags, user handles, and URLs
-tokenized = [x.replace("emoji", " ") for x in tokenized]
-tokenized = [x.replace("number", "NUMBER") for x in tokenized]
-tokenized = [x.replace("tag", " TAG ") for x in tokenized]
-tokenized = [x.replace("email", " ") for x in tokenized]
-tokenized = [x.replace("user", " USER ") for x in tokenized]
-tokenized = [x.replace("cur", "CUR") for x in tokenized]
-
-# Assign preprocessed text back to complete DataFrame
-df["text"] = tokenized
-
-# Remove whatever is left of special emojis
-df["text"] = df["text"].str.replace(r"[^\w\s]", "", flags=re.UNICODE, regex=True)
-
-# Wrap up cleaning
-df["text"] = df["text"].str.replace("ツ", "", regex=True)
-df["text"] = df["text"].replace("", np.NaN, regex=True)
-df["text"] = df["text"].str.replace(r"\s{2,}", " ", regex=True)
-df["text"] = df["text"].str.strip()
-df.dropna(subset=["text"], inplace=True)
-
-# Save to CSV file
-df.to_csv(args.output.name, index=False)
-print("Processed posts saved to output file: " + args.output.name)
-
-print("Time consumption of text prep: --- %s seconds ---" % (time.time() - start_time))
+    return df
+
+
+def normalize_texts(texts):
+    """
+    A method to normalize texts and replace user handles, numbers, currency symbols, hashtags and emojis.
+    The result is also suitable as input for NER.
+    :param texts: A list of strings.
+    :return: A list of normalized strings.
+    """
+    # Imported here, so that the command line interface starts without loading textacy
+    from textacy.preprocessing import normalize, remove, replace
+
+    processed = []
+    for text in texts:
+        transforms = (
+            normalize.whitespace, remove.punctuation, replace.user_handles, replace.numbers, replace.currency_symbols,
+            replace.hashtags, replace.emojis,)
+        processed.append(reduce(lambda r, f: f(r), transforms, text))
+
+    # Remove zero-width spaces and joiners
+    # Remove a special emoji not captured by the above pipeline
+    processed = [x.replace("\u200b", "") for x in processed]
+    processed = [x.replace("\u200d", "") for x in processed]
+    processed = [x.replace("\u200c", "") for x in processed]
+    processed = [x.replace("\u2642", "_EMOJI_") for x in processed]
+
+    processed = [x.replace("_EMOJI_", " ") for x in processed]
+    processed = [x.replace("_NUMBER_", " NUMBER ") for x in processed]
+    processed = [x.replace("_TAG_", " TAG ") for x in processed]
+    processed = [x.replace("_EMAIL_", " ") for x in processed]
+    processed = [x.replace("_USER_", " USER ") for x in processed]
+    processed = [x.replace("_CUR_", " CUR ") for x in processed]
+    return processed
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer():
+    """
+    A method to load the spacy pipeline used for tokenization.
+    The pipeline is loaded once per process and kept resident, e.g. in the warm worker of <agenda_setting.py>.
+    :return: A spacy Language object.
+    """
+    import spacy
+
+    # Uncomment if a custom Russian tokenizer is used (as for our submission)
+    # Note that we do not ship the modified custom Russian tokenizer
+
+    # Tokenize text with custom Russian tokenizer
+    # def create_russian_tokenizer(nlp,name):
+    #     return RussianTokenizer(nlp, MERGE_PATTERNS + SYNTAGRUS_RARE_CASES, name)
+    #
+    # nlp = Russian()
+    # name = "RussianTokenizer"
+    # Language.factory("russian_tokenizer", func=create_russian_tokenizer(nlp,name))
+    #
+    # nlp.add_pipe('russian_tokenizer', last=True)
+    return spacy.load("ru_core_news_sm")
+
+
+def tokenize_texts(processed, nlp):
+    """
+    A method to tokenize and lowercase normalized texts.
+    :param processed: A list of strings as returned by normalize_texts().
+    :param nlp: A spacy Language object as returned by load_tokenizer().
+    :return: A list of strings of space-separated tokens.
+    """
+    tokenized = []
+    for text in processed:
+        if type(text) == "":
+            text = np.NaN
+        else:
+            tokens = [token.text.lower() for token in nlp(text)]
+            post = " ".join(tokens)
+            tokenized.append(post)
+
+    # Remove emojis, tags, user handles, and URLs
+    tokenized = [x.replace("emoji", " ") for x in tokenized]
+    tokenized = [x.replace("number", "NUMBER") for x in tokenized]
+    tokenized = [x.replace("tag", " TAG ") for x in tokenized]
+    tokenized = [x.replace("email", " ") for x in tokenized]
+    tokenized = [x.replace("user", " USER ") for x in tokenized]
+    tokenized = [x.replace("cur", "CUR") for x in tokenized]
+    return tokenized
+
+
+def clean_text(text):
+    """
+    A method to remove what is left of special characters and whitespace from tokenized texts.
+    :param text: A pandas Series of strings as returned by tokenize_texts().
+    :return: A pandas Series of strings with NaN for empty texts.
+    """
+    # Remove whatever is left of special emojis
+    text = text.str.replace(r"[^\w\s]", "", flags=re.UNICODE, regex=True)
+
+    # Wrap up cleaning
+    text = text.str.replace("ツ", "", regex=True)
+    text = text.replace("", np.NaN, regex=True)
+    text = text.str.replace(r"\s{2,}", " ", regex=True)
+    text = text.str.strip()
+    return text
+
+
+def preprocess(df, nlp):
+    """
+    A method to preprocess the texts of posts.
+    :param df: A pandas DataFrame containing at least a column "text".
+    :param nlp: A spacy Language object as returned by load_tokenizer().
+    :return: The pandas DataFrame with preprocessed texts without empty posts.
+    """
+    # Unicode normalize
+    df["text"] = df["text"].str.normalize("NFKC")
+    # Remove empty posts
+    df["text"] = df["text"].fillna("")
+    # Remove URLS # COMMENT OUT FOR EXTENSION
+    # df["text"] = df["text"].str.replace("http\S+|www.\S+", "", case=False)
+
+    # Retrieve texts as list and prepare for NER, if applied
+    with span("normalize", rows=len(df)):
+        processed = normalize_texts(list(df["text"]))
+
+    # Uncomment if NER comparison is done
+    # Assign text prepared for NER back to complete DataFrame and save to CSV
+    # df["text"] = processed
+    # fn = args.input + "_processed_NER_comparison.csv"
+    # df.to_csv(fn, index=False)
+
+    # Assign preprocessed text back to complete DataFrame
+    with span("tokenize", rows=len(processed)):
+        df["text"] = tokenize_texts(processed, nlp)
+    with span("clean", rows=len(df)):
+        df["text"] = clean_text(df["text"])
+    df.dropna(subset=["text"], inplace=True)
+    return df
+
+
+def main(argv=None):
+    """
+    A method to preprocess the posts of an input file.
+    :param argv: Optional list of command line arguments. Defaults to sys.argv.
+    """
+    # Monitor time
+    start_time = time.time()
+
+    # Load data
+    parser = argparse.ArgumentParser(description="Preprocessing agenda-setting.")
+    parser.add_argument("-d", "--debug", help="Debugging output", action="store_true")
+    parser.add_argument("--input", type=argparse.FileType("r"), help="Input CSV file")
+    parser.add_argument("--output", type=argparse.FileType("wb"), help="Output CSV file")
+    parser.add_argument("--trace", help="Output JSON trace file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    configure(args.trace)
+
+    print("Processing input file: " + args.input.name)
+
+    with span("preprocess"):
+        with span("load") as load:
+            df = load_posts(args.input)
+            load.rows = len(df)
+        with span("load_model"):
+            nlp = load_tokenizer()
+        df = preprocess(df, nlp)
+
+        # Save to CSV file
+        with span("write", rows=len(df)):
+            df.to_csv(args.output.name, index=False)
+    print("Processed posts saved to output file: " + args.output.name)
+
+    print("Time consumption of text prep: --- %s seconds ---" % (time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
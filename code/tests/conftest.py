@@ -0,0 +1,8 @@
+"""Make the stage modules importable the way they import each other when run as scripts."""
+import sys
+from pathlib import Path
+
+UTILS_DIR = Path(__file__).resolve().parents[1] / "src" / "utils"
+for path in (UTILS_DIR, UTILS_DIR / "calculations", UTILS_DIR / "text_preprocessing"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,47 @@
+"""Tests of the inverted index over a small fixed corpus."""
+import pandas as pd
+import pytest
+
+from inverted_index import InvertedIndex, build_index
+
+POSTS = [
+    ("-26284064_1", "2018-01-01", "санкции против санкции"),
+    ("-26284064_2", "2018-01-02", "новые санкционные меры"),
+    ("-76982440_1", "2018-01-02", "эмбарго и санкции"),
+    ("-76982440_2", "2018-01-03", "погода"),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    fn = tmp_path / "final.csv"
+    pd.DataFrame(POSTS, columns=["ID", "date", "text"]).to_csv(fn, index=False)
+    build_index(fn, tmp_path / "index")
+    return InvertedIndex(tmp_path / "index")
+
+
+def occurrences(index, query):
+    posts, counts = index.lookup(query)
+    return dict(zip(posts.tolist(), counts.tolist()))
+
+
+def test_lookup_counts_terms(index):
+    assert occurrences(index, "санкции") == {0: 2, 2: 1}
+    assert occurrences(index, "санкци*") == {0: 2, 1: 1, 2: 1}
+    assert occurrences(index, "санкции,эмбарго") == {0: 2, 2: 2}
+
+
+@pytest.mark.parametrize("query, single", [
+    ("санкции,санкции", "санкции"),
+    ("санкци*,санкции", "санкци*"),
+    ("санкц*,санкци*", "санкц*"),
+    (" Санкции ,санкци*,эмбарго", "санкци*,эмбарго"),
+])
+def test_lookup_counts_overlapping_terms_once(index, query, single):
+    assert occurrences(index, query) == occurrences(index, single)
+
+
+def test_daily_counts_of_overlapping_query(index):
+    daily = index.daily_counts({"s": "санкци*,санкции"}, "control")
+    assert daily["s_mentions"].tolist() == [2.0, 1.0]
+    assert daily["s_posts"].tolist() == [1.0, 1.0]
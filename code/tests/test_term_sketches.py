@@ -0,0 +1,139 @@
+"""Tests of the error bounds, merging and updates of term sketches on a small fixed corpus."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import calculate_metrics_prct_change as metrics
+from term_sketches import (CountMinSketch, TermSketches, check_bounds, check_sketches, exact_counts, load_state,
+                           read_posts, same_counts, save_state, update_state)
+
+EPSILON = 0.02
+DELTA = 0.05
+TIME_SLICE = 7
+
+
+@pytest.fixture
+def calendar():
+    days = pd.date_range("2018-01-01", "2018-01-28", name="date")
+    rtsi = pd.DataFrame({"close": np.linspace(1100.0, 1200.0, len(days))}, index=days)
+    return metrics.SliceCalendar(rtsi, TIME_SLICE)
+
+
+def write_posts(fn, num_posts, seed=0):
+    """A method to write posts of Zipf-distributed terms of all outlets within and beyond the RTSI days."""
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(["term" + str(i) for i in range(300)])
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+    outlets = list(metrics.OUTLETS.values())
+    rows = []
+    for i in range(num_posts):
+        words = rng.choice(vocabulary, rng.integers(0, 30), p=weights / weights.sum())
+        rows.append((outlets[i % len(outlets)] + "_" + str(i),
+                     str(pd.Timestamp("2017-12-30") + pd.Timedelta(hours=int(rng.integers(0, 24 * 32)))),
+                     " ".join(words)))
+    pd.DataFrame(rows, columns=["ID", "date", "text"]).to_csv(fn, index=False)
+
+
+def new_state(calendar):
+    width, depth = CountMinSketch.dimensions(EPSILON, DELTA)
+    return TermSketches(calendar.policy(), width, depth)
+
+
+def exact(fn, calendar):
+    return exact_counts(next(read_posts(fn)), calendar)
+
+
+@pytest.fixture
+def posts(tmp_path):
+    fn = tmp_path / "posts.csv"
+    write_posts(fn, 2000)
+    return fn
+
+
+def test_estimates_within_error_bounds(posts, calendar):
+    sketches = new_state(calendar)
+    update_state(posts, calendar, sketches)
+    counts = exact(posts, calendar)
+    assert sorted(counts) == sorted(key for key, stats in sketches.stats.items() if stats.num_words > 0)
+    errors = check_bounds(sketches, counts)
+    assert (errors["underestimated"] == 0).all()
+    assert (errors["num_words"] == errors["exact_words"]).all()
+    assert (errors["error_bound"] <= EPSILON * errors["num_words"]).all()
+    exceeded = (errors["exceeded"] * errors["terms"]).sum() / errors["terms"].sum()
+    assert exceeded <= np.exp(-sketches.depth)
+    # Collisions do occur in sketches of this size, so the bound is not checked trivially
+    assert (errors["max_error"] > 0).any()
+
+
+def test_merged_halves_equal_single_state(posts, calendar, tmp_path):
+    single = new_state(calendar)
+    update_state(posts, calendar, single)
+    frame = pd.read_csv(posts)
+    halves = []
+    for i in range(2):
+        fn = tmp_path / ("half" + str(i) + ".csv")
+        frame.iloc[i::2].to_csv(fn, index=False)
+        half = new_state(calendar)
+        update_state(fn, calendar, half)
+        save_state(half, tmp_path / ("half" + str(i) + ".npz"))
+        halves.append(load_state(tmp_path / ("half" + str(i) + ".npz")))
+    halves[0].merge(halves[1])
+    save_state(single, tmp_path / "single.npz")
+    assert same_counts(load_state(tmp_path / "single.npz"), halves[0])
+
+
+def test_check_passes(posts, calendar, tmp_path):
+    width, depth = CountMinSketch.dimensions(EPSILON, DELTA)
+    sketches = new_state(calendar)
+    update_state(posts, calendar, sketches)
+    save_state(sketches, tmp_path / "state.npz")
+    for fn_state in [None, tmp_path / "state.npz"]:
+        _, failures = check_sketches(posts, calendar, width, depth, fn_state=fn_state)
+        assert failures == []
+
+
+def test_update_unchanged_file_adds_nothing(posts, calendar):
+    sketches = new_state(calendar)
+    added, _, done = update_state(posts, calendar, sketches)
+    assert added > 0 and done == 0
+    before = {key: stats.sketch.counts.copy() for key, stats in sketches.stats.items()}
+    added, skipped, done = update_state(posts, calendar, sketches)
+    assert (added, skipped, done) == (0, 0, 2000)
+    assert all(np.array_equal(stats.sketch.counts, before[key]) for key, stats in sketches.stats.items())
+
+
+def test_update_appended_file_adds_new_rows(tmp_path, calendar):
+    full = tmp_path / "full.csv"
+    write_posts(full, 3000)
+    cumulative = tmp_path / "cumulative.csv"
+    lines = full.read_bytes().splitlines(keepends=True)
+    cumulative.write_bytes(b"".join(lines[:2001]))
+    sketches = new_state(calendar)
+    update_state(cumulative, calendar, sketches)
+    cumulative.write_bytes(b"".join(lines))
+    assert update_state(cumulative, calendar, sketches)[2] == 2000
+    reference = new_state(calendar)
+    update_state(full, calendar, reference)
+    assert same_counts(sketches, reference)
+
+
+def test_update_rewritten_file_is_refused(posts, calendar, tmp_path):
+    sketches = new_state(calendar)
+    update_state(posts, calendar, sketches)
+    before = {key: stats.sketch.counts.copy() for key, stats in sketches.stats.items()}
+    # Rewritten in place, e.g. with corrected texts
+    frame = pd.read_csv(posts)
+    frame["text"] = frame["text"].fillna("") + " update"
+    frame.to_csv(posts, index=False)
+    with pytest.raises(ValueError):
+        update_state(posts, calendar, sketches)
+    assert all(np.array_equal(stats.sketch.counts, before[key]) for key, stats in sketches.stats.items())
+
+
+def test_update_grown_copy_is_refused(posts, calendar, tmp_path):
+    sketches = new_state(calendar)
+    update_state(posts, calendar, sketches)
+    copy = tmp_path / "copy.csv"
+    copy.write_bytes(posts.read_bytes() + b"-26284064_x,2018-01-03 10:00:00,term1 term2\n")
+    with pytest.raises(ValueError):
+        update_state(copy, calendar, sketches)